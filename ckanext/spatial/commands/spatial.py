@@ -1,5 +1,6 @@
 import sys
 import re
+import time
 from pprint import pprint
 import logging
 
@@ -17,9 +18,27 @@ class Spatial(CkanCommand):
             and configured in the database.
             You can provide the SRID of the geometry column. Default is 4326.
 
-        spatial extents
+        spatial migrate
+            Updates the tables created by previous versions of the
+            extension, creating the spatial index of the extents table if
+            it does not exist, and updates the table statistics. It also
+            shows how many times the indexes have been used.
+
+        spatial check-index
+            Checks that the spatial queries can use the spatial index,
+            showing the query plan.
+
+        spatial extents [rebuild]
             Creates or updates the extent geometry column for datasets with
             an extent defined in the 'spatial' extra.
+            With `rebuild`, the extents of all datasets are loaded in bulk,
+            which is much faster for large numbers of datasets, and the
+            extents of datasets without a 'spatial' extra are deleted.
+
+        spatial grid
+            Computes again the dataset counts of the grids listed on the
+            ckanext.spatial.grid.precomputed option, which is needed after
+            changing it or ckanext.spatial.grid.max_zoom.
       
     The commands should be run from the ckanext-spatial directory and expect
     a development.ini file to be present. Most of the time you will
@@ -44,8 +63,14 @@ class Spatial(CkanCommand):
         cmd = self.args[0]
         if cmd == 'initdb':
             self.initdb()    
+        elif cmd == 'migrate':
+            self.migrate()
+        elif cmd == 'check-index':
+            self.check_index()
         elif cmd == 'extents':
             self.update_extents()
+        elif cmd == 'grid':
+            self.rebuild_grid()
         else:
             print 'Command %s not recognized' % cmd
 
@@ -61,7 +86,41 @@ class Spatial(CkanCommand):
 
         print 'DB tables created'
 
+        self.migrate()
+
+    def migrate(self):
+        from ckanext.spatial.model import (setup as db_setup,
+                                           create_spatial_index,
+                                           get_spatial_index_usage)
+        db_setup()
+
+        if create_spatial_index():
+            print 'Spatial index created'
+        else:
+            print 'Spatial index already exists'
+        print 'Table statistics updated'
+
+        print 'Index usage:'
+        for index in get_spatial_index_usage():
+            print '  %(name)s (%(size)s): %(scans)i scans, %(tuples_read)i tuples read, %(tuples_fetched)i tuples fetched' % index
+
+    def check_index(self):
+        from ckanext.spatial.model import explain_spatial_query
+
+        uses_index, plan = explain_spatial_query()
+
+        print '\n'.join(plan)
+        print ''
+        if uses_index:
+            print 'OK: Spatial queries use the spatial index'
+        else:
+            print 'WARNING: Spatial queries do not use the spatial index, run the "spatial migrate" command to create it'
+            sys.exit(1)
+
     def update_extents(self):
+        if len(self.args) >= 2 and self.args[1] == 'rebuild':
+            return self.rebuild_extents()
+
         from ckan.model import PackageExtra, Package, Session
         conn = Session.connection()
         packages = [extra.package \
@@ -95,3 +154,36 @@ class Spatial(CkanCommand):
 
         print msg
 
+    def rebuild_extents(self):
+        from ckanext.spatial.lib import rebuild_package_extents
+
+        t0 = time.time()
+        def progress(read):
+            elapsed = time.time() - t0
+            print '%i extras read (%.0f per second)' % (read, read / elapsed if elapsed else 0)
+
+        count, read, errors = rebuild_package_extents(progress=progress)
+
+        if errors:
+            msg = 'Errors were found:\n%s' % '\n'.join(errors)
+            print msg
+
+        elapsed = time.time() - t0
+        msg = "Done. Extents generated for %i out of %i packages in %.1f seconds" % (count, read, elapsed)
+
+        print msg
+
+    def rebuild_grid(self):
+        from ckan.model import Session
+        from ckanext.spatial.lib.grid import get_precomputed_grids, rebuild_grid_counts
+
+        t0 = time.time()
+        rebuild_grid_counts()
+        Session.commit()
+
+        grids = get_precomputed_grids()
+        if grids:
+            print 'Done. Counts of the %s grids computed in %.1f seconds' % \
+                (', '.join(grids), time.time() - t0)
+        else:
+            print 'There are no precomputed grids, set them on ckanext.spatial.grid.precomputed'
@@ -21,6 +21,9 @@ class Validation(CkanCommand):
         validation report-csv <filename>.csv
             Performs validation on all the harvested metadata in the db and
             writes a report in CSV format to the given filepath.
+
+        The reports are validated in parallel using as many processes as
+        CPUs, use the -p / --processes option to change it.
       
         validation file <filename>.xml
             Performs validation on the given metadata file.
@@ -30,6 +33,12 @@ class Validation(CkanCommand):
     max_args = 3
     min_args = 0
 
+    def __init__(self, name):
+        super(Validation, self).__init__(name)
+        self.parser.add_option('-p', '--processes', dest='processes',
+                               type='int', default=None,
+                               help='Number of processes used to validate the records in reports')
+
     def command(self):
         if not self.args or self.args[0] in ['--help', '-h', 'help']:
             print self.usage
@@ -61,7 +70,8 @@ class Validation(CkanCommand):
         else:
             pkg = None
 
-        report = validation_report(package_id=pkg.id)
+        report = validation_report(package_id=pkg.id if pkg else None,
+                                   processes=self.options.processes)
         for row in report.get_rows_html_formatted():
             print
             for i, col_name in enumerate(report.column_names):
@@ -96,7 +106,7 @@ class Validation(CkanCommand):
         xml = etree.fromstring(xml_string)
 
         # XML validation
-        valid, errors = validators.is_valid(xml)
+        valid, profile, errors = validators.is_valid(xml)
 
         # CKAN read of values
         if valid:
@@ -113,6 +123,8 @@ class Validation(CkanCommand):
         print 'File: \'%s\'' % metadata_filepath
         print 'Valid: %s' % valid
         if not valid:
+            if profile:
+                print 'Failed profile: %s' % profile
             print 'Errors:'
             print pprint(errors)
         print '***************'
@@ -123,6 +135,6 @@ class Validation(CkanCommand):
             print 'Wrong number of arguments'
             sys.exit(1)
         csv_filepath = self.args[1]
-        report = validation_report()
+        report = validation_report(processes=self.options.processes)
         with open(csv_filepath, 'wb') as f:
-            f.write(report.get_csv())
+            report.write_csv(f)
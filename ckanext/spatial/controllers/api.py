@@ -11,9 +11,12 @@ from lxml import etree
 from ckan.lib.base import request, config, abort
 from ckan.controllers.api import ApiController as BaseApiController
 from ckan.model import Session
+from ckan.lib.helpers import json
 
 from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
-from ckanext.spatial.lib import get_srid, validate_bbox, bbox_query
+from ckanext.spatial.lib import get_srid, validate_bbox, bbox_query, iter_bbox_query
+from ckanext.spatial.lib.tiles import tile_cache
+from ckanext.spatial.lib.grid import GRIDS, aggregate_extents, get_cell_bounds, get_cell_id
 
 log = logging.getLogger(__name__)
 
@@ -33,19 +36,134 @@ class ApiController(BaseApiController):
 
         srid = get_srid(request.params.get('crs')) if 'crs' in request.params else None
 
-        extents = bbox_query(bbox,srid)
+        try:
+            limit = int(request.params['limit']) if 'limit' in request.params else None
+            offset = int(request.params.get('offset', 0))
+            simplify = float(request.params['simplify']) if 'simplify' in request.params else None
+        except ValueError:
+            abort(400, 'Wrong limit, offset or simplify parameter')
+        if (limit is not None and limit < 0) or offset < 0:
+            abort(400, 'Wrong limit or offset parameter')
+        cursor = request.params.get('cursor') or None
 
         format = request.params.get('format','')
 
-        return self._output_results(extents,format)
+        count = bbox_query(bbox,srid).count()
+        extents = iter_bbox_query(bbox, srid, limit=limit, offset=offset,
+                                  after=cursor, geojson=(format == 'geojson'),
+                                  simplify=simplify)
 
-    def _output_results(self,extents,format=None):
-
-        ids = [extent.package_id for extent in extents]
-
-        output = dict(count=len(ids),results=ids)
+        # The responses are streamed as the extents are read
+        response.headers['Content-Type'] = 'application/json;charset=utf-8'
+        if format == 'geojson':
+            output = self._output_geojson(extents, count, limit)
+        else:
+            output = self._output_results(extents,format,count,limit)
+
+        # JSONP, as supported by the rest of the API
+        if 'callback' in request.params and request.method == 'GET':
+            response.headers['Content-Type'] = 'text/javascript;charset=utf-8'
+            return self._wrap_jsonp_stream(request.params['callback'], output)
+
+        return output
+
+    def _wrap_jsonp_stream(self, callback, output):
+        yield '%s(' % callback
+        for chunk in output:
+            yield chunk
+        yield ');'
+
+    def _output_results(self,extents,format=None,count=None,limit=None):
+        '''
+        Streams the ids of the datasets as a JSON object, with the total
+        `count` of datasets within the bounding box and, if the results were
+        limited and there may be more, the `cursor` to get the next ones.
+        '''
+        yield '{"count": %i, "results": [' % count
+        returned, last_id = 0, None
+        for package_id, geometry in extents:
+            yield (', ' if returned else '') + json.dumps(package_id)
+            returned, last_id = returned + 1, package_id
+        yield ']'
+        if limit and returned == limit:
+            yield ', "cursor": %s' % json.dumps(last_id)
+        yield '}'
+
+    def _output_geojson(self,extents,count=None,limit=None):
+        '''
+        Streams the extents of the datasets as a GeoJSON FeatureCollection,
+        with the GeoJSON of the geometries generated by PostGIS.
+        '''
+        yield '{"type": "FeatureCollection", "count": %i, "features": [' % count
+        returned, last_id = 0, None
+        for package_id, geometry in extents:
+            yield '%s{"type": "Feature", "id": %s, "geometry": %s, "properties": {}}' % \
+                (', ' if returned else '', json.dumps(package_id), geometry or 'null')
+            returned, last_id = returned + 1, package_id
+        yield ']'
+        if limit and returned == limit:
+            yield ', "cursor": %s' % json.dumps(last_id)
+        yield '}'
+
+    def spatial_tile(self, z, x, y):
+        '''
+        Returns the vector tile (Mapbox Vector Tile) with the extents of the
+        datasets for a tile of the Web Mercator tiling scheme.
+        '''
+        try:
+            z, x, y = int(z), int(x), int(y)
+        except ValueError:
+            abort(400, 'Wrong tile coordinates')
+        if not 0 <= z <= 30 or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+            abort(400, 'Wrong tile coordinates')
+
+        tile = tile_cache.get(z, x, y)
+
+        response.headers['Content-Type'] = 'application/vnd.mapbox-vector-tile'
+        response.headers['Content-Length'] = len(tile)
+        return tile
+
+    def spatial_grid(self):
+        '''
+        Returns the number of datasets on each cell of a grid within a
+        lon/lat bounding box, with the grid level used for a map zoom level.
+        '''
+        error_400_msg = 'Please provide a suitable bbox parameter [minx,miny,maxx,maxy]'
 
-        return self._finish_ok(output)
+        bbox = validate_bbox(request.params.get('bbox', ''))
+        if not bbox:
+            abort(400, error_400_msg)
+
+        try:
+            zoom = int(request.params.get('zoom', 0))
+        except ValueError:
+            abort(400, 'Wrong zoom parameter')
+        grid = request.params.get('grid', 'lonlat')
+        if grid not in GRIDS:
+            abort(400, 'Wrong grid parameter, it must be one of: %s' % ', '.join(GRIDS))
+
+        level, cells = aggregate_extents(bbox, zoom, grid)
+
+        response.headers['Content-Type'] = 'application/json;charset=utf-8'
+        if request.params.get('format', '') == 'geojson':
+            features = []
+            for x, y, count in cells:
+                minx, miny, maxx, maxy = get_cell_bounds(grid, level, x, y)
+                features.append({'type': 'Feature',
+                                 'id': get_cell_id(grid, level, x, y),
+                                 'geometry': {'type': 'Polygon',
+                                              'coordinates': [[[minx, miny], [minx, maxy],
+                                                               [maxx, maxy], [maxx, miny],
+                                                               [minx, miny]]]},
+                                 'properties': {'count': count}})
+            return json.dumps({'type': 'FeatureCollection', 'grid': grid,
+                               'level': level, 'features': features})
+
+        return json.dumps({'grid': grid, 'level': level,
+                           'cells': [{'id': get_cell_id(grid, level, x, y),
+                                      'bbox': get_cell_bounds(grid, level, x, y),
+                                      'count': count}
+                                     for x, y, count in cells]})
 
 class HarvestMetadataApiController(BaseApiController):
 
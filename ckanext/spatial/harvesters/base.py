@@ -3,6 +3,7 @@ import cgitb
 import warnings
 import urllib2
 import sys
+import time
 import logging
 from string import Template
 from urlparse import urlparse
@@ -17,6 +18,7 @@ from pylons import config
 from owslib import wms
 import requests
 from lxml import etree
+from sqlalchemy import text
 
 from ckan import plugins as p
 from ckan import model
@@ -26,14 +28,20 @@ from ckan.lib.navl.validators import not_empty
 
 from ckanext.harvest.harvesters.base import HarvesterBase
 from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObjectExtra as HOExtra
 
-from ckanext.spatial.validation import Validators, all_validators
-from ckanext.spatial.model import ISODocument
+from ckanext.spatial.validation import Validators, all_validators, DEFAULT_VALIDATOR_PROFILES
+from ckanext.spatial.model import ISODocument, MappedXmlParseError
+from ckanext.spatial.lib.csw_client import CswRecordFetcher
 
 log = logging.getLogger(__name__)
 
-DEFAULT_VALIDATOR_PROFILES = ['iso19139']
+# Number of CSW records fetched at once when fetching them concurrently
+DEFAULT_FETCH_BATCH_SIZE = 100
 
+# Seconds a CswRecordFetcher is kept without being used (eg once its harvest
+# job is finished) before its threads and connections are closed
+FETCHER_MAX_IDLE_TIME = 300
 
 def text_traceback():
     with warnings.catch_warnings():
@@ -55,6 +63,33 @@ def guess_standard(content):
     return 'unknown'
 
 
+def content_digest(content):
+    '''
+    Returns a digest of a harvested document that only changes if its
+    content does, not its formatting.
+
+    XML documents are digested in their canonical form (C14N), without
+    comments and with the whitespace of their text normalized, so changes in
+    indentation, attributes order or quoting do not change the digest.
+    Content that can not be parsed as XML is digested with its whitespace
+    normalized.
+    '''
+    if isinstance(content, unicode):
+        content = re.sub(r'^\s*<\?xml[^>]*\?>', '', content).encode('utf-8')
+    try:
+        parser = etree.XMLParser(remove_blank_text=True, remove_comments=True)
+        tree = etree.fromstring(content, parser=parser)
+    except (etree.XMLSyntaxError, ValueError):
+        return hashlib.sha1(' '.join(content.split())).hexdigest()
+
+    for element in tree.iter():
+        if element.text:
+            element.text = ' '.join(element.text.split()) or None
+        if element.tail:
+            element.tail = ' '.join(element.tail.split()) or None
+    return hashlib.sha1(etree.tostring(tree, method='c14n')).hexdigest()
+
+
 def guess_resource_format(url, use_mimetypes=True):
     '''
     Given a URL try to guess the best format to assign to the resource
@@ -113,6 +148,16 @@ class SpatialHarvester(HarvesterBase):
 
     force_import = False
 
+    # Read the values of the ISO documents walking their XML tree only once
+    # (see SinglePassXmlReader). Can also be enabled per source with the
+    # `single_pass_reader` key of the source configuration.
+    single_pass_reader = False
+
+    # Read each of the ISO values only when it is first accessed (see
+    # LazyMappedXmlValues), which saves work when a custom get_package_dict
+    # only uses a few of them. The single pass reader is not used then.
+    lazy_iso_values = False
+
     extent_template = Template('''
     {"type": "Polygon", "coordinates": [[[$xmin, $ymin], [$xmax, $ymin], [$xmax, $ymax], [$xmin, $ymax], [$xmin, $ymin]]]}
     ''')
@@ -422,8 +467,36 @@ class SpatialHarvester(HarvesterBase):
 
             return True
 
-        # Check if it is a non ISO document
+        if status == 'unchanged':
+            # The remote document has not been modified since the previous
+            # harvest (the server answered 304 Not Modified), so there is no
+            # need to validate, parse or import it again
+            if not previous_object:
+                self._save_object_error('No previous object for unchanged object {0}'.format(harvest_object.id),
+                                        harvest_object, 'Import')
+                return False
+
+            self._log_skipped(harvest_object, 'not modified')
+            self._replace_previous_object(harvest_object, previous_object)
+            return True
+
+        # Compare the content with the one of the previous object, so
+        # documents that have not changed are not validated, parsed or
+        # imported again
         original_document = self._get_object_extra(harvest_object, 'original_document')
+        document = original_document or harvest_object.content
+        digest = content_digest(document) if document else None
+        previous_digest = None
+        if previous_object:
+            previous_digest = self._get_object_extra(previous_object, 'content_digest')
+
+        if status == 'change' and not self.force_import \
+                and previous_digest and digest == previous_digest:
+            self._log_skipped(harvest_object, 'same content')
+            self._replace_previous_object(harvest_object, previous_object)
+            return True
+
+        # Check if it is a non ISO document
         original_format = self._get_object_extra(harvest_object, 'original_format')
         if original_document and original_format:
             content = self.transform_to_iso(original_document, original_format, harvest_object)
@@ -449,7 +522,12 @@ class SpatialHarvester(HarvesterBase):
 
         # Parse ISO document
         try:
-            iso_values = ISODocument(harvest_object.content).read_values()
+            iso_values = ISODocument(harvest_object.content).read_values(
+                single_pass=self._use_single_pass_reader(),
+                lazy=self.lazy_iso_values)
+            # With lazy values, these are only read here
+            iso_guid = iso_values['guid']
+            metadata_date = iso_values['metadata-date']
         except Exception, e:
             self._save_object_error('Error parsing ISO document for object {0}: {1}'.format(harvest_object.id, str(e)),
                                     harvest_object, 'Import')
@@ -461,7 +539,6 @@ class SpatialHarvester(HarvesterBase):
             previous_object.add()
 
         # Update GUID with the one on the document
-        iso_guid = iso_values['guid']
         if iso_guid and harvest_object.guid != iso_guid:
             # First make sure there already aren't current objects
             # with the same guid
@@ -486,17 +563,26 @@ class SpatialHarvester(HarvesterBase):
 
         # Get document modified date
         try:
-            metadata_modified_date = dateutil.parser.parse(iso_values['metadata-date'], ignoretz=True)
+            metadata_modified_date = dateutil.parser.parse(metadata_date, ignoretz=True)
         except ValueError:
             self._save_object_error('Could not extract reference date for object {0} ({1})'
-                        .format(harvest_object.id, iso_values['metadata-date']), harvest_object, 'Import')
+                        .format(harvest_object.id, metadata_date), harvest_object, 'Import')
             return False
 
         harvest_object.metadata_modified_date = metadata_modified_date
         harvest_object.add()
 
+        if digest:
+            HOExtra(object=harvest_object, key='content_digest', value=digest).add()
+
         # Build the package dict
-        package_dict = self.get_package_dict(iso_values, harvest_object)
+        try:
+            package_dict = self.get_package_dict(iso_values, harvest_object)
+        except MappedXmlParseError, e:
+            # The lazy values are parsed as get_package_dict reads them
+            self._save_object_error('Error parsing ISO document for object {0}: {1}'.format(harvest_object.id, str(e)),
+                                    harvest_object, 'Import')
+            return False
         if not package_dict:
             log.error('No package dict returned, aborting import for object {0}'.format(harvest_object.id))
             return False
@@ -549,8 +635,12 @@ class SpatialHarvester(HarvesterBase):
 
         elif status == 'change':
 
-            # Check if the modified date is more recent
-            if not self.force_import and harvest_object.metadata_modified_date <= previous_object.metadata_modified_date:
+            # Check if the modified date is more recent (if the content of
+            # the previous object is known it has already been compared)
+            if not self.force_import and not previous_digest and \
+                    harvest_object.metadata_modified_date <= previous_object.metadata_modified_date:
+
+                self._log_skipped(harvest_object, 'same metadata date')
 
                 # Assign the previous job id to the new object to
                 # avoid losing history
@@ -559,8 +649,6 @@ class SpatialHarvester(HarvesterBase):
 
                 # Delete the previous object to avoid cluttering the object table
                 previous_object.delete()
-
-                log.info('Document with GUID %s unchanged, skipping...' % (harvest_object.guid))
             else:
                 package_schema = logic.schema.default_update_package_schema()
                 package_schema['tags'] = tag_schema
@@ -614,6 +702,140 @@ class SpatialHarvester(HarvesterBase):
             self.source_config = json.loads(config_str)
             log.debug('Using config: %r', self.source_config)
 
+    def _use_single_pass_reader(self):
+        '''
+        Whether the ISO values are read with the single pass reader, enabled
+        on the harvester or on the source configuration (but never with the
+        lazy values)
+        '''
+        if self.lazy_iso_values:
+            return False
+        return self.single_pass_reader or \
+            p.toolkit.asbool(self.source_config.get('single_pass_reader', False))
+
+    def _get_csw_fetcher(self, url, output_schema='gmd'):
+        '''
+        Returns the CswRecordFetcher for a CSW source, creating it only the
+        first time it is requested, so all the fetch stages of the source
+        share its connections and capabilities document.
+
+        It is configured with the following keys of the source configuration:
+
+        * `fetch_workers`: number of concurrent requests
+        * `fetch_rate_limit`: maximum number of requests per second
+        * `fetch_retries`: times a failed request is retried (default 2)
+
+        The fetchers not used for FETCHER_MAX_IDLE_TIME seconds are closed.
+        '''
+        if not hasattr(self, '_csw_fetchers'):
+            self._csw_fetchers = {}
+        now = time.time()
+        for old_key, (fetcher, last_used) in self._csw_fetchers.items():
+            if now - last_used > FETCHER_MAX_IDLE_TIME:
+                fetcher.close()
+                del self._csw_fetchers[old_key]
+
+        key = (url, output_schema,
+               self.source_config.get('fetch_workers', 1),
+               self.source_config.get('fetch_rate_limit'),
+               self.source_config.get('fetch_retries', 2))
+        if key in self._csw_fetchers:
+            fetcher = self._csw_fetchers[key][0]
+        else:
+            fetcher = CswRecordFetcher(
+                url, workers=key[2], rate_limit=key[3], retries=key[4],
+                outputschema=output_schema)
+        self._csw_fetchers[key] = (fetcher, now)
+        return fetcher
+
+    def _claim_csw_objects(self, harvest_object, limit):
+        '''
+        Returns up to `limit` other objects of the same job still waiting to
+        be fetched, setting their `fetch_started` so the fetch stages running
+        in other processes do not pick them too.
+
+        The objects are claimed with a single UPDATE, so when two processes
+        try to claim the same object only the first one gets it (the second
+        one finds `fetch_started` already set once the first one commits).
+        The claim is committed straight away on its own connection, leaving
+        the current transaction of the Session untouched.
+        '''
+        connection = model.meta.engine.connect()
+        try:
+            transaction = connection.begin()
+            result = connection.execute(text('''
+                UPDATE harvest_object SET fetch_started = :now
+                WHERE id IN (SELECT id FROM harvest_object
+                             WHERE harvest_job_id = :harvest_job_id
+                                AND id != :id
+                                AND content IS NULL
+                                AND fetch_started IS NULL
+                                AND NOT EXISTS (
+                                    SELECT 1 FROM harvest_object_extra
+                                    WHERE harvest_object_extra.harvest_object_id = harvest_object.id
+                                       AND harvest_object_extra.key = 'status'
+                                       AND harvest_object_extra.value = 'delete')
+                             LIMIT :limit)
+                   AND fetch_started IS NULL
+                RETURNING id'''),
+                {'now': datetime.now(), 'harvest_job_id': harvest_object.harvest_job_id,
+                 'id': harvest_object.id, 'limit': limit})
+            ids = [row[0] for row in result]
+            transaction.commit()
+        finally:
+            connection.close()
+        if not ids:
+            return []
+        return model.Session.query(HarvestObject) \
+            .filter(HarvestObject.id.in_(ids)) \
+            .all()
+
+    def _fetch_csw_records(self, harvest_object, output_schema='gmd'):
+        '''
+        Fetches the CSW record of a harvest object together with the ones of
+        other objects of the same job still waiting to be fetched (up to the
+        `fetch_batch_size` of the source configuration), making concurrent
+        requests with the source CswRecordFetcher.
+
+        The other objects are claimed first (see _claim_csw_objects), so
+        each record is only requested once even if several fetch stages run
+        at the same time. Their contents are added to the Session, to be
+        committed with the harvest object, so there is nothing left to do on
+        their fetch stage. Those that could not be fetched are left
+        as they were, to be fetched (and their errors recorded) on their own
+        fetch stage.
+
+        Returns the record dict for the harvest object, as returned by
+        CswService.getrecordbyid.
+        '''
+        fetcher = self._get_csw_fetcher(harvest_object.source.url, output_schema)
+        batch_size = self.source_config.get('fetch_batch_size', DEFAULT_FETCH_BATCH_SIZE)
+
+        pending = self._claim_csw_objects(harvest_object, batch_size - 1)
+
+        results = fetcher.getrecordsbyid(
+            [harvest_object.guid] + [obj.guid for obj in pending])
+        identifier, record, error = results.next()
+
+        for obj, (obj_identifier, obj_record, obj_error) in zip(pending, results):
+            if obj_record:
+                obj.content = self._get_record_content(obj_record)
+            else:
+                obj.fetch_started = None
+            obj.add()
+        log.debug('Fetched %i records concurrently', len(pending) + 1)
+
+        if error:
+            raise error
+        return record
+
+    def _get_record_content(self, record):
+        '''
+        Returns the content to store in a harvest object from a record dict
+        returned by CswService.getrecordbyid
+        '''
+        return record['xml']
+
     def _get_validator(self):
         '''
         Returns the validator object using the relevant profiles
@@ -623,6 +845,9 @@ class SpatialHarvester(HarvesterBase):
         1. 'validator_profiles' property of the harvest source config object
         2. 'ckan.spatial.validator.profiles' configuration option in the ini file
         3. Default value as defined in DEFAULT_VALIDATOR_PROFILES
+
+        If `ckanext.spatial.validator.parallel` is True, the profiles will be
+        checked concurrently.
         '''
         if not hasattr(self, '_validator'):
             if hasattr(self, 'source_config') and self.source_config.get('validator_profiles', None):
@@ -634,7 +859,8 @@ class SpatialHarvester(HarvesterBase):
                 ]
             else:
                 profiles = DEFAULT_VALIDATOR_PROFILES
-            self._validator = Validators(profiles=profiles)
+            parallel = p.toolkit.asbool(config.get('ckanext.spatial.validator.parallel', False))
+            self._validator = Validators(profiles=profiles, parallel=parallel)
         return self._validator
 
     def _get_user_name(self):
@@ -689,6 +915,13 @@ class SpatialHarvester(HarvesterBase):
         url = url.replace(' ', '%20')
         response = requests.get(url, timeout=10)
 
+        return self._get_response_as_unicode(response)
+
+    def _get_response_as_unicode(self, response):
+        '''
+        Returns the content of a requests response as unicode, as described
+        in _get_content_as_unicode.
+        '''
         content = response.text
 
         # Remove original XML declaration
@@ -700,6 +933,107 @@ class SpatialHarvester(HarvesterBase):
 
         return content
 
+    def _get_response_if_modified(self, url, previous_object=None):
+        '''
+        Requests a remote document, sending the ETag and Last-Modified values
+        of the response stored on the previous harvest object for the
+        document (if any) as If-None-Match and If-Modified-Since headers
+        (unless forcing the import).
+
+        Returns a tuple with the requests response, or None if the server
+        answered 304 Not Modified, and a dict with the `etag` and
+        `last_modified` values to store on the new harvest object (see
+        _save_http_validators).
+        '''
+        headers = {}
+        validators = {}
+        if previous_object and not self.force_import:
+            for key, header in (('etag', 'If-None-Match'),
+                                ('last_modified', 'If-Modified-Since')):
+                value = self._get_object_extra(previous_object, key)
+                if value:
+                    headers[header] = value
+                    validators[key] = value
+
+        url = url.replace(' ', '%20')
+        response = requests.get(url, headers=headers, timeout=10)
+        if response.status_code == 304 and headers:
+            return None, validators
+
+        validators = {}
+        for key, header in (('etag', 'ETag'), ('last_modified', 'Last-Modified')):
+            if response.headers.get(header):
+                validators[key] = response.headers[header]
+        return response, validators
+
+    def _save_http_validators(self, harvest_object, validators):
+        '''
+        Stores the ETag and Last-Modified values returned by
+        _get_response_if_modified as extras of the harvest object
+        '''
+        for key, value in validators.iteritems():
+            extra = HOExtra(object=harvest_object, key=key, value=value)
+            extra.save()
+
+    def _get_previous_object(self, harvest_object):
+        '''
+        Returns the current harvest object with the same GUID, if any
+        '''
+        return model.Session.query(HarvestObject) \
+                .filter(HarvestObject.guid==harvest_object.guid) \
+                .filter(HarvestObject.current==True) \
+                .filter(HarvestObject.id!=harvest_object.id) \
+                .first()
+
+    def _replace_previous_object(self, harvest_object, previous_object):
+        '''
+        Makes the harvest object of a document that has not changed since the
+        previous harvest the current one, taking over the package and content
+        digest of the previous object, which is deleted.
+        '''
+        harvest_object.package_id = previous_object.package_id
+        harvest_object.metadata_modified_date = previous_object.metadata_modified_date
+        # Assign the previous job id to the new object to
+        # avoid losing history
+        harvest_object.harvest_job_id = previous_object.job.id
+        harvest_object.current = True
+        harvest_object.add()
+
+        digest = self._get_object_extra(previous_object, 'content_digest')
+        if digest and not self._get_object_extra(harvest_object, 'content_digest'):
+            HOExtra(object=harvest_object, key='content_digest', value=digest).add()
+
+        # Delete the previous object to avoid cluttering the object table
+        previous_object.delete()
+        model.Session.commit()
+
+    def _log_skipped(self, harvest_object, reason):
+        '''
+        Logs that the document of a harvest object was not imported as it has
+        not changed, along with the number of documents skipped so far for
+        its job (by this process) for each reason.
+        '''
+        if not hasattr(self, '_skipped_counts'):
+            self._skipped_counts = {}
+        counts = self._skipped_counts.setdefault(harvest_object.harvest_job_id, {})
+        counts[reason] = counts.get(reason, 0) + 1
+
+        log.info('Document with GUID %s unchanged (%s), skipping...', harvest_object.guid, reason)
+        log.info('Skipped documents for job %s: %s', harvest_object.harvest_job_id,
+                 ', '.join('%i %s' % (count, reason) for reason, count in sorted(counts.iteritems())))
+
+    def _set_object_unchanged(self, harvest_object, previous_object):
+        '''
+        Flags a harvest object whose remote document has not been modified
+        since the previous harvest, so the import stage just takes over the
+        previous object instead of importing it again.
+        '''
+        for extra in harvest_object.extras:
+            if extra.key == 'status':
+                extra.value = 'unchanged'
+        harvest_object.content = previous_object.content
+        harvest_object.save()
+
     def _validate_document(self, document_string, harvest_object, validator=None):
         '''
         Validates an XML document with the default, or if present, the
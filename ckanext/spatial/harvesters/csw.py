@@ -1,6 +1,7 @@
 import re
 import urllib
 import urlparse
+import json
 
 import logging
 
@@ -12,9 +13,13 @@ from ckanext.harvest.interfaces import IHarvester
 from ckanext.harvest.model import HarvestObject
 from ckanext.harvest.model import HarvestObjectExtra as HOExtra
 
-from ckanext.spatial.lib.csw_client import CswService
+from ckanext.spatial.lib.csw_client import CswService, capabilities_cache
 from ckanext.spatial.harvesters.base import SpatialHarvester, text_traceback
 
+# Number of records requested per page, when gathering the identifiers only
+# or the full records (see the `bulk_records` source configuration key)
+DEFAULT_PAGE_SIZE = 10
+DEFAULT_BULK_PAGE_SIZE = 100
 
 class CSWHarvester(SpatialHarvester, SingletonPlugin):
     '''
@@ -32,6 +37,29 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
             }
 
 
+    def validate_config(self, source_config):
+        source_config = super(CSWHarvester, self).validate_config(source_config)
+        if not source_config:
+            return source_config
+
+        source_config_obj = json.loads(source_config)
+        for key in ('page_size', 'fetch_workers', 'fetch_batch_size'):
+            if key in source_config_obj:
+                value = source_config_obj[key]
+                # bool is a subclass of int
+                if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+                    raise ValueError('%s must be a positive integer' % key)
+        if 'fetch_retries' in source_config_obj:
+            value = source_config_obj['fetch_retries']
+            if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                raise ValueError('fetch_retries must be a non-negative integer')
+        if 'fetch_rate_limit' in source_config_obj:
+            value = source_config_obj['fetch_rate_limit']
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError('fetch_rate_limit must be a positive number')
+
+        return source_config
+
     def get_original_url(self, harvest_object_id):
         obj = model.Session.query(HarvestObject).\
                                     filter(HarvestObject.id==harvest_object_id).\
@@ -86,16 +114,46 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
 
         guids_in_db = set(guid_to_package_id.keys())
 
+        # In bulk mode the full records are requested here, and stored in the
+        # harvest objects as each page is read, so the fetch stage has nothing
+        # to do
+        bulk = self.source_config.get('bulk_records', False)
+        if bulk:
+            page_size = self.source_config.get('page_size', DEFAULT_BULK_PAGE_SIZE)
+        else:
+            page_size = self.source_config.get('page_size', DEFAULT_PAGE_SIZE)
+
         log.debug('Starting gathering for %s' % url)
         guids_in_harvest = set()
+        bulk_objects = []
+        ids = []
         try:
-            for identifier in self.csw.getidentifiers(page=10, outputschema=self.output_schema()):
+            if bulk:
+                records = self.csw.getfullrecords(page=page_size,
+                                                  outputschema=self.output_schema())
+            else:
+                records = ((identifier, None) for identifier in
+                           self.csw.getidentifiers(page=page_size,
+                                                   outputschema=self.output_schema()))
+            for identifier, content in records:
                 try:
                     log.info('Got identifier %s from the CSW', identifier)
                     if identifier is None:
                         log.error('CSW returned identifier %r, skipping...' % identifier)
                         continue
 
+                    if bulk and not identifier in guids_in_harvest:
+                        status = 'change' if identifier in guids_in_db else 'new'
+                        obj = HarvestObject(guid=identifier, job=harvest_job,
+                                            package_id=guid_to_package_id.get(identifier),
+                                            content=content.strip(),
+                                            extras=[HOExtra(key='status', value=status)])
+                        obj.add()
+                        bulk_objects.append(obj)
+                        if len(bulk_objects) >= page_size:
+                            ids.extend(self._save_objects(bulk_objects))
+                            bulk_objects = []
+
                     guids_in_harvest.add(identifier)
                 except Exception, e:
                     self._save_gather_error('Error for the identifier %s [%r]' % (identifier,e), harvest_job)
@@ -104,6 +162,9 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
 
         except Exception, e:
             log.error('Exception: %s' % text_traceback())
+            if ids or bulk_objects:
+                # Do not leave behind the objects of the pages already read
+                self._delete_job_objects(harvest_job)
             self._save_gather_error('Error gathering the identifiers from the CSW server [%s]' % str(e), harvest_job)
             return None
 
@@ -111,18 +172,20 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
         delete = guids_in_db - guids_in_harvest
         change = guids_in_db & guids_in_harvest
 
-        ids = []
-        for guid in new:
-            obj = HarvestObject(guid=guid, job=harvest_job,
-                                extras=[HOExtra(key='status', value='new')])
-            obj.save()
-            ids.append(obj.id)
-        for guid in change:
-            obj = HarvestObject(guid=guid, job=harvest_job,
-                                package_id=guid_to_package_id[guid],
-                                extras=[HOExtra(key='status', value='change')])
-            obj.save()
-            ids.append(obj.id)
+        if bulk:
+            ids.extend(self._save_objects(bulk_objects))
+        else:
+            for guid in new:
+                obj = HarvestObject(guid=guid, job=harvest_job,
+                                    extras=[HOExtra(key='status', value='new')])
+                obj.save()
+                ids.append(obj.id)
+            for guid in change:
+                obj = HarvestObject(guid=guid, job=harvest_job,
+                                    package_id=guid_to_package_id[guid],
+                                    extras=[HOExtra(key='status', value='change')])
+                obj.save()
+                ids.append(obj.id)
         for guid in delete:
             obj = HarvestObject(guid=guid, job=harvest_job,
                                 package_id=guid_to_package_id[guid],
@@ -133,30 +196,68 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
                   update({'current': False}, False)
             obj.save()
 
+        log.info('Gathered %i objects, %s', len(ids), capabilities_cache.get_stats())
+
         if len(ids) == 0:
             self._save_gather_error('No records received from the CSW server', harvest_job)
             return None
 
         return ids
 
+    def _save_objects(self, objects):
+        '''Commits the given (added) harvest objects, returning their ids'''
+        model.Session.flush()
+        object_ids = [obj.id for obj in objects]
+        model.Session.commit()
+        return object_ids
+
+    def _delete_job_objects(self, harvest_job):
+        '''Deletes the harvest objects (and their extras) created so far for
+        the given job'''
+        model.Session.rollback()
+        object_ids = model.Session.query(HarvestObject.id).\
+                filter(HarvestObject.harvest_job_id==harvest_job.id).subquery()
+        model.Session.query(HOExtra).\
+                filter(HOExtra.harvest_object_id.in_(object_ids)).\
+                delete(synchronize_session=False)
+        model.Session.query(HarvestObject).\
+                filter(HarvestObject.harvest_job_id==harvest_job.id).\
+                delete(synchronize_session=False)
+        model.Session.commit()
+
     def fetch_stage(self,harvest_object):
         log = logging.getLogger(__name__ + '.CSW.fetch')
         log.debug('CswHarvester fetch_stage for object: %s', harvest_object.id)
 
-        url = harvest_object.source.url
-        try:
-            self._setup_csw_client(url)
-        except Exception, e:
-            self._save_object_error('Error contacting the CSW server: %s' % e,
-                                    harvest_object)
-            return False
+        if harvest_object.content:
+            # Record already retrieved in the gather stage (bulk mode)
+            log.debug('Content already gathered for object %s', harvest_object.id)
+            return True
 
+        self._set_source_config(harvest_object.source.config)
         identifier = harvest_object.guid
-        try:
-            record = self.csw.getrecordbyid([identifier], outputschema=self.output_schema())
-        except Exception, e:
-            self._save_object_error('Error getting the CSW record with GUID %s' % identifier, harvest_object)
-            return False
+
+        if self.source_config.get('fetch_workers', 1) > 1:
+            try:
+                record = self._fetch_csw_records(harvest_object, self.output_schema())
+            except Exception, e:
+                self._save_object_error('Error getting the CSW record with GUID %s [%r]' % \
+                                        (identifier, e), harvest_object)
+                return False
+        else:
+            url = harvest_object.source.url
+            try:
+                self._setup_csw_client(url)
+            except Exception, e:
+                self._save_object_error('Error contacting the CSW server: %s' % e,
+                                        harvest_object)
+                return False
+
+            try:
+                record = self.csw.getrecordbyid([identifier], outputschema=self.output_schema())
+            except Exception, e:
+                self._save_object_error('Error getting the CSW record with GUID %s' % identifier, harvest_object)
+                return False
 
         if record is None:
             self._save_object_error('Empty record for GUID %s' % identifier,
@@ -165,20 +266,23 @@ class CSWHarvester(SpatialHarvester, SingletonPlugin):
 
         try:
             # Save the fetch contents in the HarvestObject
-            # Contents come from csw_client already declared and encoded as utf-8
-            # Remove original XML declaration
-            content = re.sub('<\?xml(.*)\?>', '', record['xml'])
-
-            harvest_object.content = content.strip()
+            harvest_object.content = self._get_record_content(record)
             harvest_object.save()
         except Exception,e:
             self._save_object_error('Error saving the harvest object for GUID %s [%r]' % \
                                     (identifier, e), harvest_object)
             return False
 
-        log.debug('XML content saved (len %s)', len(record['xml']))
+        log.debug('XML content saved (len %s), %s', len(record['xml']),
+                  capabilities_cache.get_stats())
         return True
 
+    def _get_record_content(self, record):
+        # Contents come from csw_client already declared and encoded as utf-8
+        # Remove original XML declaration
+        content = re.sub('<\?xml(.*)\?>', '', record['xml'])
+        return content.strip()
+
     def _setup_csw_client(self, url):
         self.csw = CswService(url)
 
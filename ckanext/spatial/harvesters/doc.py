@@ -49,22 +49,39 @@ class DocHarvester(SpatialHarvester, SingletonPlugin):
 
         self._set_source_config(harvest_job.source.config)
 
-        # Get contents
+        existing_object = model.Session.query(HarvestObject).\
+                                    filter(HarvestObject.current==True).\
+                                    filter(HarvestObject.harvest_source_id==harvest_job.source.id).\
+                                    first()
+
+        # Get contents, unless not modified since the previous harvest
         try:
-            content = self._get_content_as_unicode(url)
+            response, validators = self._get_response_if_modified(url, existing_object)
         except Exception,e:
             self._save_gather_error('Unable to get content for URL: %s: %r' % \
                                         (url, e),harvest_job)
             return None
 
-        existing_object = model.Session.query(HarvestObject.guid, HarvestObject.package_id).\
-                                    filter(HarvestObject.current==True).\
-                                    filter(HarvestObject.harvest_source_id==harvest_job.source.id).\
-                                    first()
-
         def create_extras(url, status):
-            return [HOExtra(key='doc_location', value=url),
-                    HOExtra(key='status', value=status)]
+            extras = [HOExtra(key='doc_location', value=url),
+                      HOExtra(key='status', value=status)]
+            for key, value in validators.iteritems():
+                extras.append(HOExtra(key=key, value=value))
+            return extras
+
+        if response is None:
+            log.debug('Document %s not modified', url)
+            harvest_object = HarvestObject(job=harvest_job,
+                                extras=create_extras(url,
+                                                     'unchanged'),
+                                guid=existing_object.guid,
+                                package_id=existing_object.package_id,
+                                content=existing_object.content
+                               )
+            harvest_object.save()
+            return [harvest_object.id]
+
+        content = self._get_response_as_unicode(response)
 
         if not existing_object:
             guid=hashlib.md5(url.encode('utf8', 'ignore')).hexdigest()
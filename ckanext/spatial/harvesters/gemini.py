@@ -31,9 +31,10 @@ from ckan.lib.navl.validators import not_empty
 
 from ckanext.harvest.interfaces import IHarvester
 from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObjectExtra as HOExtra
 
 from ckanext.spatial.model import GeminiDocument
-from ckanext.spatial.lib.csw_client import CswService
+from ckanext.spatial.lib.csw_client import CswService, capabilities_cache
 from ckanext.spatial.lib.coupled_resource import update_coupled_resources
 
 from ckanext.spatial.harvesters.base import SpatialHarvester, text_traceback
@@ -65,6 +66,8 @@ class GeminiHarvester(SpatialHarvester):
         # Save a reference
         self.obj = harvest_object
 
+        self._set_source_config(harvest_object.source.config)
+
         if harvest_object.content is None:
             self._save_object_error('Empty content for object %s' % harvest_object.id,harvest_object,'Import')
             return False
@@ -119,7 +122,9 @@ class GeminiHarvester(SpatialHarvester):
         log = logging.getLogger(__name__ + '.import')
         package = None
         gemini_document = GeminiDocument(content)
-        gemini_values = gemini_document.read_values()
+        gemini_values = gemini_document.read_values(
+            single_pass=self._use_single_pass_reader(),
+            lazy=self.lazy_iso_values)
         gemini_guid = gemini_values['guid']
 
         # Save the metadata reference date in the Harvest Object
@@ -597,6 +602,8 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
             self._save_gather_error('Error gathering the identifiers from the CSW server [%s]' % str(e), harvest_job)
             return None
 
+        log.info('Gathered %i objects, %s', len(ids), capabilities_cache.get_stats())
+
         if len(ids) == 0:
             self._save_gather_error('No records received from the CSW server', harvest_job)
             return None
@@ -607,20 +614,34 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
         log = logging.getLogger(__name__ + '.CSW.fetch')
         log.debug('GeminiCswHarvester fetch_stage for object: %r', harvest_object)
 
-        url = harvest_object.source.url
-        try:
-            self._setup_csw_client(url)
-        except Exception, e:
-            self._save_object_error('Error contacting the CSW server: %s' % e,
-                                    harvest_object)
-            return False
+        if harvest_object.content:
+            # Already fetched with the record of another object
+            return True
 
+        self._set_source_config(harvest_object.source.config)
         identifier = harvest_object.guid
-        try:
-            record = self.csw.getrecordbyid([identifier])
-        except Exception, e:
-            self._save_object_error('Error getting the CSW record with GUID %s' % identifier, harvest_object)
-            return False
+
+        if self.source_config.get('fetch_workers', 1) > 1:
+            try:
+                record = self._fetch_csw_records(harvest_object)
+            except Exception, e:
+                self._save_object_error('Error getting the CSW record with GUID %s [%r]' % \
+                                        (identifier, e), harvest_object)
+                return False
+        else:
+            url = harvest_object.source.url
+            try:
+                self._setup_csw_client(url)
+            except Exception, e:
+                self._save_object_error('Error contacting the CSW server: %s' % e,
+                                        harvest_object)
+                return False
+
+            try:
+                record = self.csw.getrecordbyid([identifier])
+            except Exception, e:
+                self._save_object_error('Error getting the CSW record with GUID %s' % identifier, harvest_object)
+                return False
 
         if record is None:
             self._save_object_error('Empty record for GUID %s' % identifier,
@@ -636,7 +657,8 @@ class GeminiCswHarvester(GeminiHarvester, SingletonPlugin):
                                     (identifier, e), harvest_object)
             return False
 
-        log.debug('XML content saved (len %s)', len(record['xml']))
+        log.debug('XML content saved (len %s), %s', len(record['xml']),
+                  capabilities_cache.get_stats())
         return True
 
     def _setup_csw_client(self, url):
@@ -666,13 +688,24 @@ class GeminiDocHarvester(GeminiHarvester, SingletonPlugin):
         # Get source URL
         url = harvest_job.source.url
 
-        # Get contents
+        previous_object = Session.query(HarvestObject) \
+                .filter(HarvestObject.current==True) \
+                .filter(HarvestObject.harvest_source_id==harvest_job.source.id) \
+                .first()
+
+        # Get contents, unless not modified since the previous harvest
         try:
-            content = self._get_content(url)
+            response, validators = self._get_response_if_modified(url, previous_object)
         except Exception,e:
             self._save_gather_error('Unable to get content for URL: %s: %r' % \
                                         (url, e),harvest_job)
             return None
+
+        if response is None:
+            log.info('Document %s not modified since the last harvest, skipping...' % url)
+            return []
+
+        content = response.content
         try:
             # We need to extract the guid to pass it to the next stage
             gemini_string, gemini_guid = self.get_gemini_string_and_guid(content,url)
@@ -684,7 +717,9 @@ class GeminiDocHarvester(GeminiHarvester, SingletonPlugin):
                 obj = HarvestObject(guid=gemini_guid,
                                     job=harvest_job,
                                     content=gemini_string,
-                                    harvest_source_reference=gemini_string)
+                                    harvest_source_reference=gemini_string,
+                                    extras=[HOExtra(key=key, value=value)
+                                            for key, value in validators.iteritems()])
                 obj.save()
 
                 log.info('Got GUID %s' % gemini_guid)
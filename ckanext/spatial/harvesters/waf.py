@@ -1,13 +1,18 @@
+import re
 import logging
 import hashlib
+import urllib
 from urlparse import urljoin
+from multiprocessing.pool import ThreadPool
 import dateutil.parser
 import pyparsing as parse
 import requests
+from lxml import etree
 from sqlalchemy.orm import aliased
 from sqlalchemy.exc import DataError
 
 from ckan import model
+from ckan.lib.helpers import json
 
 from ckan.plugins.core import SingletonPlugin, implements
 
@@ -20,6 +25,11 @@ from ckanext.spatial.harvesters.base import SpatialHarvester, guess_standard
 
 log = logging.getLogger(__name__)
 
+# Sub-folders of WAF pages deeper than this are not followed
+MAX_WAF_DEPTH = 10
+
+# Number of WAF sub-folders requested concurrently
+DEFAULT_CRAWL_WORKERS = 4
 
 class WAFHarvester(SpatialHarvester, SingletonPlugin):
     '''
@@ -58,8 +68,9 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
         self._set_source_config(harvest_job.source.config)
 
         # Get contents
+        session = requests.Session()
         try:
-            response = requests.get(source_url, timeout=60)
+            response = session.get(source_url, timeout=60)
             response.raise_for_status()
         except requests.exceptions.RequestException, e:
             self._save_gather_error('Unable to get content for URL: %s: %r' % \
@@ -94,7 +105,9 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
 
         url_to_modified_harvest = {} ## mapping of url to last_modified in harvest
         try:
-            for url, modified_date in _extract_waf(content,source_url,scraper):
+            workers = self.source_config.get('crawl_workers', DEFAULT_CRAWL_WORKERS)
+            for url, modified_date in _crawl_waf(content, source_url, scraper,
+                                                 session=session, workers=workers):
                 url_to_modified_harvest[url] = modified_date
         except Exception,e:
             msg = 'Error extracting URLs from %s, error was %s' % (source_url, e)
@@ -192,14 +205,25 @@ class WAFHarvester(SpatialHarvester, SingletonPlugin):
                     harvest_object)
             return False
 
-        # Get contents
+        # Get contents, unless not modified since the previous harvest
+        previous_object = None
+        if status == 'change':
+            previous_object = self._get_previous_object(harvest_object)
         try:
-            content = self._get_content_as_unicode(url)
+            response, validators = self._get_response_if_modified(url, previous_object)
         except Exception, e:
             msg = 'Could not harvest WAF link {0}: {1}'.format(url, e)
             self._save_object_error(msg, harvest_object)
             return False
 
+        self._save_http_validators(harvest_object, validators)
+        if response is None:
+            log.debug('WAF document %s not modified', url)
+            self._set_object_unchanged(harvest_object, previous_object)
+            return True
+
+        content = self._get_response_as_unicode(response)
+
         # Check if it is an ISO document
         document_format = guess_standard(content)
         if document_format == 'iso':
@@ -251,6 +275,115 @@ scrapers = {'apache': parse.OneOrMore(parse.Group(apache)),
             'other': parse.OneOrMore(parse.Group(other)),
             'iis': parse.OneOrMore(parse.Group(iis))}
 
+# The pyparsing grammars above are slow on large index pages, so the pages
+# are scraped with the following regular expressions instead, which match
+# exactly the same links and dates. Words are matched possessively (with the
+# `(?=(...))\1` idiom) as pyparsing does not backtrack.
+
+_white = r'[ \n\t\r]*'
+_quoted_string = _white + r'''((?:"(?:[^"\n\r\\]|(?:"")|(?:\\x[0-9a-fA-F]+)|(?:\\.))*")|(?:'(?:[^'\n\r\\]|(?:'')|(?:\\x[0-9a-fA-F]+)|(?:\\.))*'))'''
+
+_link_start = re.compile('<a href=', re.IGNORECASE)
+_quoted_url = re.compile(_quoted_string)
+_apache_date = re.compile(
+    r'(?:%(w)s</td><td align="right">)?%(w)s(?=([A-Za-z0-9-]+))\1%(w)s([A-Za-z0-9:]+)'
+    % {'w': _white})
+_iis_breaks = re.compile(r'<br>(?:%s<br>)*' % _white)
+_iis_date = re.compile(
+    r'%(w)s(?=([A-Za-z0-9/]+))\1%(w)s(?=([A-Za-z0-9:]+))\2%(w)s([A-Za-z]+)'
+    % {'w': _white})
+_iis_link = re.compile(r'%(w)s[0-9]+%(w)s<A HREF=%(q)s'
+                       % {'w': _white, 'q': _quoted_string})
+
+def _scrape_apache(content):
+    records = []
+    pos = 0
+    while True:
+        match = _link_start.search(content, pos)
+        if not match:
+            break
+        match = _quoted_url.match(content, match.end())
+        if not match:
+            break
+        url = match.group(1)[1:-1]
+        pos = content.find('</a>', match.end())
+        if pos == -1:
+            break
+        pos += 4
+        date = ''
+        match = _apache_date.match(content, pos)
+        if match:
+            date = match.group(1) + ' ' + match.group(2)
+            pos = match.end()
+        records.append((url, date))
+    return records
+
+def _scrape_iis(content):
+    records = []
+    pos = 0
+    while True:
+        pos = content.find('<br>', pos)
+        if pos == -1:
+            break
+        pos = _iis_breaks.match(content, pos).end()
+        date = ''
+        match = _iis_date.match(content, pos)
+        if match:
+            date = ' '.join(match.groups())
+            pos = match.end()
+        match = _iis_link.match(content, pos)
+        if not match:
+            break
+        pos = match.end()
+        records.append((match.group(1)[1:-1], date))
+    return records
+
+def _scrape_other(content):
+    records = []
+    pos = 0
+    while True:
+        match = _link_start.search(content, pos)
+        if not match:
+            break
+        match = _quoted_url.match(content, match.end())
+        if not match:
+            break
+        pos = match.end()
+        records.append((match.group(1)[1:-1], ''))
+    return records
+
+fast_scrapers = {'apache': _scrape_apache,
+                 'other': _scrape_other,
+                 'iis': _scrape_iis}
+
+_xml_listing = re.compile(r'\s*(?:<\?xml[^>]*>\s*)?<list[\s>]')
+
+def _scrape_listing(content):
+    '''
+    Scrapes JSON or XML directory listings, like the ones returned by nginx
+    `autoindex_format` option. Returns None if the content is not one.
+    '''
+    if content.lstrip().startswith('['):
+        entries = [(entry.get('name'), entry.get('type'), entry.get('mtime'))
+                   for entry in json.loads(content)]
+    elif _xml_listing.match(content):
+        entries = [(element.text, element.tag, element.get('mtime'))
+                   for element in etree.fromstring(content)]
+    else:
+        return None
+
+    records = []
+    for name, entry_type, date in entries:
+        if not name:
+            continue
+        if isinstance(name, unicode):
+            name = name.encode('utf8')
+        url = urllib.quote(name)
+        if entry_type == 'directory':
+            url += '/'
+        records.append((url, date or ''))
+    return records
+
 def _get_scraper(server):
     if not server or 'apache' in server.lower():
         return 'apache'
@@ -263,19 +396,90 @@ def _extract_waf(content, base_url, scraper, results = None, depth=0):
     if results is None:
         results = []
 
+    results.extend(_crawl_waf(content, base_url, scraper,
+                              max_depth=MAX_WAF_DEPTH - depth))
+    return results
+
+def _crawl_waf(content, base_url, scraper, session=None,
+               workers=DEFAULT_CRAWL_WORKERS, max_depth=MAX_WAF_DEPTH):
+    '''
+    Walks a WAF breadth-first, starting from the content of its index page,
+    and yields a (url, modified_date) tuple for each XML document found.
+
+    The sub-folders of each level are requested concurrently by `workers`
+    threads sharing a keep-alive requests session, and parsed as they
+    arrive. Sub-folders of pages deeper than `max_depth` are not followed.
+    '''
+    if session is None:
+        session = requests.Session()
+
+    pool = None
+    visited = set()
+    pages = [(base_url, content)]
+    depth = 0
+    try:
+        while True:
+            folders = []
+            for page_url, page_content in pages:
+                if page_content is None:
+                    continue
+                documents, page_folders = _parse_waf(page_content, page_url, scraper)
+                for document in documents:
+                    yield document
+                if depth > max_depth:
+                    if page_folders:
+                        log.info('Max WAF depth reached')
+                    continue
+                for folder in page_folders:
+                    if not folder in visited:
+                        visited.add(folder)
+                        folders.append(folder)
+
+            if not folders:
+                break
+            if pool is None:
+                pool = ThreadPool(workers)
+            pages = pool.imap(lambda url: _get_waf_page(session, url), folders)
+            depth += 1
+    finally:
+        if pool:
+            pool.terminate()
+
+def _get_waf_page(session, url):
+    log.debug('WAF new_url: %s', url)
+    try:
+        response = session.get(url, timeout=60)
+        response.raise_for_status()
+    except Exception, e:
+        log.warning('Could not get WAF folder %s: %s', url, e)
+        return url, None
+    return url, response.content
+
+def _parse_waf(content, base_url, scraper):
+    '''
+    Parses a WAF page, returning the list of (url, modified_date) tuples of
+    the XML documents linked and the list of URLs of its sub-folders.
+    '''
+    documents = []
+    folders = []
+
     base_url = base_url.rstrip('/').split('/')
     if 'index' in base_url[-1]:
         base_url.pop()
     base_url = '/'.join(base_url)
     base_url += '/'
 
-    try:
-        parsed = scrapers[scraper].parseString(content)
-    except parse.ParseException:
-        parsed = scrapers['other'].parseString(content)
-
-    for record in parsed:
-        url = record.url
+    records = _scrape_listing(content)
+    if records is None:
+        # Expand tabs as pyparsing does
+        content = content.expandtabs()
+        records = fast_scrapers[scraper](content)
+        if not records:
+            records = _scrape_other(content)
+        if not records:
+            raise parse.ParseException(content, 0, 'No links found')
+
+    for url, date in records:
         if not url:
             continue
         if url.startswith('_'):
@@ -287,32 +491,19 @@ def _extract_waf(content, base_url, scraper, results = None, depth=0):
         if 'mailto:' in url:
             continue
         if '..' not in url and url[0] != '/' and url[-1] == '/':
-            new_depth = depth + 1
-            if depth > 10:
-                log.info('Max WAF depth reached')
-                continue
             new_url = urljoin(base_url, url)
             if not new_url.startswith(base_url):
                 continue
-            log.debug('WAF new_url: %s', new_url)
-            try:
-                response = requests.get(new_url)
-                content = response.content
-            except Exception, e:
-                print str(e)
-                continue
-            _extract_waf(content, new_url, scraper, results, new_depth)
+            folders.append(new_url)
             continue
         if not url.endswith('.xml'):
             continue
-        date = record.date
         if date:
             try:
                 date = str(dateutil.parser.parse(date))
             except Exception, e:
                 raise
                 date = None
-        results.append((urljoin(base_url, record.url), date))
-
-    return results
+        documents.append((urljoin(base_url, url), date))
 
+    return documents, folders
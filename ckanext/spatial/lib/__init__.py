@@ -1,16 +1,30 @@
+import time
 import logging
+import binascii
 from string import Template
+from cStringIO import StringIO
 
-from ckan.model import Session, Package
+from ckan.model import Session, Package, PackageExtra, meta
 from ckan.lib.base import config
-
-from ckanext.spatial.model import PackageExtent
+from ckan.lib.helpers import json
+
+from ckanext.spatial.model import PackageExtent, increment_extents_version
+from ckanext.spatial.lib.tiles import invalidate_tiles
+from ckanext.spatial.lib.spatial_index import extents_index
+from ckanext.spatial.lib.transaction import on_commit
+from ckanext.spatial.lib.grid import (get_precomputed_grids, get_extent_centroid,
+                                      update_grid_counts, rebuild_grid_counts)
 from shapely.geometry import asShape
+from shapely import wkb
+from sqlalchemy import text
 
-from geoalchemy import WKTSpatialElement
+from geoalchemy import WKTSpatialElement, functions
 
 log = logging.getLogger(__name__)
 
+# Number of spatial extras read and loaded at once when rebuilding the extents
+DEFAULT_EXTENTS_CHUNK_SIZE = 1000
+
 def get_srid(crs):
     """Returns the SRID for the provided CRS definition
         The CRS can be defined in the following formats
@@ -38,43 +52,208 @@ def save_package_extent(package_id, geometry = None, srid = None):
 
        Will throw ValueError if the geometry object does not provide a geo interface.
 
-       The responsibility for calling model.Session.commit() is left to the
+       The existing extent is compared with the new one in Python, so saving
+       an extent takes one query plus one INSERT or UPDATE if it changed.
+       Extents whose coordinates do not differ more than the
+       `ckanext.spatial.extent_tolerance` option (0 by default) are
+       considered unchanged. Any change increments the version of the
+       extents (see get_extents_version) once committed, and updates the
+       counts of the precomputed grids (see ckanext.spatial.lib.grid).
+
+       The responsibility for calling model.Session.commit(), and for
+       updating the extents index of the process (see
+       ckanext.spatial.lib.spatial_index) once committed, is left to the
        caller.
     '''
     db_srid = int(config.get('ckan.spatial.srid', '4326'))
 
+    params = {'package_id': package_id}
 
-    existing_package_extent = Session.query(PackageExtent).filter(PackageExtent.package_id==package_id).first()
+    # Grids whose counts are updated with the centroids of the extents
+    precomputed_grids = get_precomputed_grids()
 
-    if geometry:
-        shape = asShape(geometry)
+    if not geometry:
+        # If extent exists but we received no geometry, we'll delete the existing one
+        old_centroid = get_extent_centroid(package_id) if precomputed_grids else None
+        deleted = Session.execute('''DELETE FROM package_extent WHERE package_id = :package_id
+                                     RETURNING ST_AsBinary(the_geom)''', params).fetchall()
+        if deleted:
+            on_commit(_increment_extents_version)
+            invalidate_tiles([wkb.loads(str(row[0])) for row in deleted if row[0]], db_srid)
+            if precomputed_grids:
+                update_grid_counts(old_centroid, None)
+            log.debug('Deleted extent for package %s' % package_id)
+        return
 
-        if not srid:
-            srid = db_srid
+    shape = asShape(geometry)
 
-        package_extent = PackageExtent(package_id=package_id,the_geom=WKTSpatialElement(shape.wkt, srid))
+    if not srid:
+        srid = db_srid
 
-    # Check if extent exists
-    if existing_package_extent:
+    existing_geom = Session.execute('''SELECT ST_AsBinary(the_geom) FROM package_extent
+                                       WHERE package_id = :package_id''',
+                                    params).fetchone()
 
-        # If extent exists but we received no geometry, we'll delete the existing one
-        if not geometry:
-            existing_package_extent.delete()
-            log.debug('Deleted extent for package %s' % package_id)
-        else:
-            # Check if extent changed
-            if Session.scalar(package_extent.the_geom.wkt) <> Session.scalar(existing_package_extent.the_geom.wkt):
-                # Update extent
-                existing_package_extent.the_geom = package_extent.the_geom
-                existing_package_extent.save()
-                log.debug('Updated extent for package %s' % package_id)
-            else:
-                log.debug('Extent for package %s unchanged' % package_id)
-    elif geometry:
+    # Geometries of the extent before and after the change
+    changed = []
+    old_centroid = None
+
+    params.update({'the_geom': binascii.hexlify(shape.wkb),
+                   'srid': srid,
+                   'db_srid': db_srid})
+    new_geom = "ST_GeomFromWKB(decode(:the_geom, 'hex'), :srid)"
+    if srid != db_srid:
+        new_geom = 'ST_Transform(%s, :db_srid)' % new_geom
+
+    # Check if extent exists
+    if existing_geom:
+        # Check if extent changed (only possible on the same projection)
+        if srid == db_srid and existing_geom[0] and \
+                _same_extent(shape, existing_geom[0]):
+            log.debug('Extent for package %s unchanged' % package_id)
+            return
+
+        # Update extent
+        if existing_geom[0]:
+            changed = [wkb.loads(str(existing_geom[0]))]
+        if precomputed_grids:
+            old_centroid = get_extent_centroid(package_id)
+        Session.execute('''UPDATE package_extent SET the_geom = %s
+                           WHERE package_id = :package_id''' % new_geom, params)
+        log.debug('Updated extent for package %s' % package_id)
+    else:
         # Insert extent
-        Session.add(package_extent)
+        Session.execute('''INSERT INTO package_extent (package_id, the_geom)
+                           VALUES (:package_id, %s)''' % new_geom, params)
         log.debug('Created new extent for package %s' % package_id)
 
+    on_commit(_increment_extents_version)
+    invalidate_tiles(changed + [shape] if srid == db_srid else None, db_srid)
+    if precomputed_grids:
+        update_grid_counts(old_centroid, get_extent_centroid(package_id))
+
+def _increment_extents_version():
+    # The callers update the extents index of this process with the change
+    extents_index.add_version(increment_extents_version())
+
+def _same_extent(shape, existing_wkb):
+    '''
+    Checks if a shapely geometry is the same as the one of an existing
+    extent (as WKB), within the tolerance set on the configuration.
+    '''
+    tolerance = float(config.get('ckanext.spatial.extent_tolerance', 0))
+    if not tolerance and str(existing_wkb) == shape.wkb:
+        return True
+    return shape.equals_exact(wkb.loads(str(existing_wkb)), tolerance)
+
+def rebuild_package_extents(chunk_size=DEFAULT_EXTENTS_CHUNK_SIZE, progress=None):
+    '''Rebuilds the extents of all datasets from their 'spatial' extras in bulk.
+
+       The extras are streamed from the database in chunks of `chunk_size`,
+       their GeoJSON geometries parsed with shapely and loaded into a
+       temporary staging table (with COPY if the database driver supports
+       it, otherwise with a multi-row INSERT). The staging table is then
+       merged into the package_extent table with a single UPDATE and INSERT,
+       and the extents of datasets without a 'spatial' extra (or that are
+       not active) are deleted.
+
+       progress: if provided, it is called after loading each chunk with the
+                 number of extras read so far.
+
+       Returns a tuple with the number of extents loaded, the number of
+       extras read and a list with the errors found parsing the geometries.
+
+       The changes are committed.
+    '''
+    db_srid = int(config.get('ckan.spatial.srid', '4326'))
+
+    Session.execute('''CREATE TEMPORARY TABLE package_extent_staging
+                       (package_id text, the_geom text) ON COMMIT DROP''')
+
+    query = Session.query(PackageExtra.package_id, PackageExtra.value) \
+            .join(Package, Package.id == PackageExtra.package_id) \
+            .filter(PackageExtra.key == 'spatial') \
+            .filter(PackageExtra.state == 'active') \
+            .filter(Package.state == 'active') \
+            .execution_options(stream_results=True).yield_per(chunk_size)
+
+    count = 0
+    read = 0
+    errors = []
+    rows = []
+    for package_id, value in query:
+        read += 1
+        try:
+            shape = asShape(json.loads(value))
+            rows.append((package_id, binascii.hexlify(shape.wkb)))
+        except Exception, e:
+            errors.append(u'Package %s - Error parsing the geometry: %s' % (package_id, e))
+
+        if read % chunk_size == 0:
+            _load_staging_extents(rows)
+            count += len(rows)
+            rows = []
+            if progress:
+                progress(read)
+    if rows:
+        _load_staging_extents(rows)
+        count += len(rows)
+    if progress and read % chunk_size:
+        progress(read)
+
+    params = {'srid': db_srid}
+    result = Session.execute('''UPDATE package_extent
+        SET the_geom = ST_GeomFromWKB(decode(s.the_geom, 'hex'), :srid)
+        FROM package_extent_staging s
+        WHERE package_extent.package_id = s.package_id
+            AND ST_AsBinary(package_extent.the_geom, 'NDR') <> decode(s.the_geom, 'hex')''',
+        params)
+    log.debug('Updated %i extents', result.rowcount)
+
+    result = Session.execute('''INSERT INTO package_extent (package_id, the_geom)
+        SELECT s.package_id, ST_GeomFromWKB(decode(s.the_geom, 'hex'), :srid)
+        FROM package_extent_staging s
+        WHERE NOT EXISTS (SELECT 1 FROM package_extent e
+                          WHERE e.package_id = s.package_id)''',
+        params)
+    log.debug('Created %i extents', result.rowcount)
+
+    result = Session.execute('''DELETE FROM package_extent
+        WHERE NOT EXISTS (SELECT 1 FROM package_extra x, package p
+                          WHERE x.package_id = package_extent.package_id
+                              AND x.key = 'spatial' AND x.state = 'active'
+                              AND p.id = x.package_id AND p.state = 'active')''')
+    log.debug('Deleted %i extents', result.rowcount)
+
+    on_commit(increment_extents_version)
+    invalidate_tiles()
+    rebuild_grid_counts()
+    Session.commit()
+
+    return count, read, errors
+
+def _load_staging_extents(rows):
+    '''
+    Loads a list of (package id, hex encoded WKB geometry) tuples into the
+    extents staging table
+    '''
+    connection = Session.connection().connection
+    cursor = connection.cursor()
+    if hasattr(cursor, 'copy_from'):
+        data = StringIO(''.join('%s\t%s\n' % (package_id.encode('utf8'), geom)
+                                for package_id, geom in rows))
+        cursor.copy_from(data, 'package_extent_staging',
+                         columns=('package_id', 'the_geom'))
+    else:
+        params = {}
+        values = []
+        for i, (package_id, geom) in enumerate(rows):
+            params['package_id_%i' % i] = package_id
+            params['the_geom_%i' % i] = geom
+            values.append('(:package_id_%i, :the_geom_%i)' % (i, i))
+        Session.execute('INSERT INTO package_extent_staging VALUES %s'
+                        % ', '.join(values), params)
+
 def validate_bbox(bbox_values):
     '''
     Ensures a bbox is expressed in a standard dict.
@@ -132,11 +311,13 @@ def _bbox_2_wkt(bbox, srid):
         input_geometry = WKTSpatialElement(wkt,db_srid)
     return input_geometry
 
-def bbox_query(bbox,srid=None):
+def bbox_query(bbox,srid=None,limit=None,offset=None):
     '''
     Performs a spatial query of a bounding box.
 
     bbox - bounding box dict
+    limit, offset - page of the results to return, ordered by package id
+                    (all of them by default)
 
     Returns a query object of PackageExtents, which each reference a package
     by ID.
@@ -148,37 +329,114 @@ def bbox_query(bbox,srid=None):
               .filter(PackageExtent.package_id==Package.id) \
               .filter(PackageExtent.the_geom.intersects(input_geometry)) \
               .filter(Package.state==u'active')
+    if limit is not None or offset:
+        extents = extents.order_by(PackageExtent.package_id) \
+                         .limit(limit).offset(offset)
     return extents
 
-def bbox_query_ordered(bbox, srid=None):
+def iter_bbox_query(bbox, srid=None, limit=None, offset=0, after=None,
+                    geojson=False, simplify=None,
+                    chunk_size=DEFAULT_EXTENTS_CHUNK_SIZE):
+    '''
+    Performs a spatial query of a bounding box, like bbox_query, but
+    returning a generator of (package_id, geometry) tuples, ordered by
+    package id, without loading the PackageExtent objects.
+
+    The results are read in chunks of `chunk_size` rows, each with a
+    separate query on a dedicated connection (released when the generator
+    is exhausted or closed), so they can be consumed after the current
+    session has been removed (eg when streaming a response).
+
+    limit, offset - page of the results to return (all of them by default)
+    after - only return the packages with an id greater than this one
+    geojson - if True, the geometry is the extent as a GeoJSON string in
+              EPSG:4326, otherwise None
+    simplify - tolerance used to simplify the GeoJSON geometries, in units
+               of the database projection
+    '''
+    db_srid = int(config.get('ckan.spatial.srid', '4326'))
+    params = {'query_bbox': str(_bbox_2_wkt(bbox, db_srid)),
+              'query_srid': srid or db_srid,
+              'db_srid': db_srid,
+              'simplify': simplify}
+
+    query_geometry = 'ST_GeomFromText(:query_bbox, :query_srid)'
+    if srid and srid != db_srid:
+        query_geometry = 'ST_Transform(%s, :db_srid)' % query_geometry
+
+    if geojson:
+        geometry = 'package_extent.the_geom'
+        if simplify:
+            geometry = 'ST_SimplifyPreserveTopology(%s, :simplify)' % geometry
+        if db_srid != 4326:
+            geometry = 'ST_Transform(%s, 4326)' % geometry
+        geometry = 'ST_AsGeoJSON(%s)' % geometry
+    else:
+        geometry = 'NULL'
+
+    sql = '''SELECT package_extent.package_id, %s
+             FROM package_extent, package
+             WHERE package_extent.package_id = package.id
+                AND ST_Intersects(package_extent.the_geom, %s)
+                AND package.state = 'active'
+                %%s
+             ORDER BY package_extent.package_id
+             LIMIT :limit OFFSET :offset''' % (geometry, query_geometry)
+
+    returned = 0
+    connection = meta.engine.connect()
+    try:
+        while limit is None or returned < limit:
+            params['limit'] = chunk_size if limit is None else min(chunk_size, limit - returned)
+            params['offset'] = offset
+            params['after'] = after
+            rows = connection.execute(text(sql % ('AND package_extent.package_id > :after'
+                                                  if after is not None else '')),
+                                      params).fetchall()
+            for row in rows:
+                yield row[0], row[1]
+            returned += len(rows)
+            if len(rows) < params['limit']:
+                break
+            # Next chunks start after the last package returned
+            after = rows[-1][0]
+            offset = 0
+    finally:
+        connection.close()
+
+def bbox_query_ordered(bbox, srid=None, limit=None, offset=0):
     '''
     Performs a spatial query of a bounding box. Returns packages in order
     of how similar the data\'s bounding box is to the search box (best first).
 
     bbox - bounding box dict
+    limit, offset - page of the results to return (all of them by default)
 
-    Returns a query object of PackageExtents, which each reference a package
-    by ID.
+    Returns a list of rows with the package_id, the spatial_ranking and the
+    total_count of packages within the bounding box (the same on all rows).
     '''
 
     input_geometry = _bbox_2_wkt(bbox, srid)
 
     params = {'query_bbox': str(input_geometry),
-              'query_srid': input_geometry.srid}
-
-    # First get the area of the query box
-    sql = "SELECT ST_Area(GeomFromText(:query_bbox, :query_srid));"
-    params['search_area'] = Session.execute(sql, params).fetchone()[0]
-
-    # Uses spatial ranking method from "USGS - 2006-1279" (Lanfear)
-    sql = """SELECT ST_AsBinary(package_extent.the_geom) AS package_extent_the_geom,
-                    POWER(ST_Area(ST_Intersection(package_extent.the_geom, GeomFromText(:query_bbox, :query_srid))),2)/ST_Area(package_extent.the_geom)/:search_area as spatial_ranking,
-                    package_extent.package_id AS package_id
+              'query_srid': input_geometry.srid,
+              'limit': limit,
+              'offset': offset or 0}
+
+    # Uses spatial ranking method from "USGS - 2006-1279" (Lanfear). The
+    # ranking, paging and count are all done on the database, so only the
+    # rows of the requested page are returned.
+    sql = """SELECT package_extent.package_id AS package_id,
+                    POWER(ST_Area(ST_Intersection(package_extent.the_geom, GeomFromText(:query_bbox, :query_srid))),2)
+                        / ST_Area(package_extent.the_geom)
+                        / ST_Area(GeomFromText(:query_bbox, :query_srid)) AS spatial_ranking,
+                    COUNT(*) OVER () AS total_count
              FROM package_extent, package
              WHERE package_extent.package_id = package.id
                 AND ST_Intersects(package_extent.the_geom, GeomFromText(:query_bbox, :query_srid))
                 AND package.state = 'active'
-             ORDER BY spatial_ranking desc"""
+             ORDER BY spatial_ranking DESC, package_extent.package_id
+             LIMIT :limit OFFSET :offset"""
     extents = Session.execute(sql, params).fetchall()
     log.debug('Spatial results: %r',
               [('%.2f' % extent.spatial_ranking, extent.package_id) for extent in extents[:20]])
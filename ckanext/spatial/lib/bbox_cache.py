@@ -0,0 +1,183 @@
+'''
+Cache of the ids of the datasets within the bounding boxes used on the
+spatial searches.
+'''
+import os
+import math
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+from ckan.lib.helpers import json
+
+log = logging.getLogger(__name__)
+
+
+class BboxCache(object):
+    '''
+    Cache of the ids of the datasets within a bounding box, for each search
+    backend and projection.
+
+    The ids are kept in memory (up to `max_size` entries, discarding the
+    least recently used first, and 0 to disable the cache) for `ttl`
+    seconds, along with the version of the extents they were computed from
+    (see get_extents_version), so they are discarded as soon as a change
+    to any extent is committed. If `cache_dir` is set, they are also stored
+    there, so they are shared by all the processes.
+
+    If `grid` is set, the bounding boxes are snapped outwards to a grid of
+    that size (in the units of the projection) with `snap`, so searches for
+    slightly different areas (eg after panning the map a little) share the
+    same entry.
+
+    The number of hits (in memory or on disk) and misses is kept in `hits`,
+    `disk_hits` and `misses`, and the hit ratio is logged every
+    `report_interval` searches.
+    '''
+
+    def __init__(self, max_size=0, ttl=3600, grid=0, cache_dir=None,
+                 report_interval=1000):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.grid = grid
+        self.cache_dir = cache_dir
+        self.report_interval = report_interval
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._saves = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.max_size and self.ttl)
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return float(self.hits + self.disk_hits) / lookups if lookups else 0.0
+
+    def snap(self, bbox):
+        '''
+        Returns the smallest bounding box on the grid that contains the
+        provided one.
+        '''
+        if not self.grid:
+            return bbox
+        grid = float(self.grid)
+        return {'minx': round(math.floor(bbox['minx'] / grid) * grid, 10),
+                'miny': round(math.floor(bbox['miny'] / grid) * grid, 10),
+                'maxx': round(math.ceil(bbox['maxx'] / grid) * grid, 10),
+                'maxy': round(math.ceil(bbox['maxy'] / grid) * grid, 10)}
+
+    def get(self, key, version, query):
+        '''
+        Returns the list of dataset ids cached for a key, or the result of
+        calling `query` if there are none for the current version of the
+        extents.
+        '''
+        if not self.enabled:
+            return query()
+
+        now = time.time()
+        with self._lock:
+            cached = self._entries.pop(key, None)
+            if cached and cached[0] == version and cached[1] + self.ttl > now:
+                # Move it to the end, as the most recently used
+                self._entries[key] = cached
+                self.hits += 1
+                self._report()
+                return cached[2]
+
+        ids = self._load(key, version, now)
+        if ids is None:
+            ids = query()
+            self._save(key, version, ids)
+            with self._lock:
+                self.misses += 1
+                self._report()
+        else:
+            with self._lock:
+                self.disk_hits += 1
+                self._report()
+
+        with self._lock:
+            self._entries[key] = (version, now, ids)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return ids
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        return 'bbox cache: %i hits, %i disk hits, %i misses (hit ratio %.2f)' % \
+            (self.hits, self.disk_hits, self.misses, self.hit_ratio)
+
+    def _report(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        if self.report_interval and lookups % self.report_interval == 0:
+            log.info(self.get_stats())
+
+    def _get_filepath(self, key):
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(repr(key)).hexdigest() + '.json')
+
+    def _load(self, key, version, now):
+        if not self.cache_dir:
+            return None
+        filepath = self._get_filepath(key)
+        try:
+            if os.path.getmtime(filepath) + self.ttl <= now:
+                return None
+            with open(filepath, 'rb') as f:
+                cached = json.loads(f.read())
+        except (IOError, OSError, ValueError):
+            return None
+        if cached.get('version') != version:
+            return None
+        return cached.get('ids')
+
+    def _save(self, key, version, ids):
+        if not self.cache_dir:
+            return
+        filepath = self._get_filepath(key)
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            fd, tmp_filepath = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps({'version': version, 'ids': ids}))
+            os.rename(tmp_filepath, filepath)
+        except (IOError, OSError), e:
+            log.warning('Could not store the bbox cache entry in %s: %s',
+                        self.cache_dir, e)
+            return
+
+        with self._lock:
+            self._saves += 1
+            prune = self._saves % max(self.max_size, 1) == 0
+        if prune:
+            self._prune()
+
+    def _prune(self):
+        '''
+        Removes the expired entries from the cache directory.
+        '''
+        expired = time.time() - self.ttl
+        for filename in os.listdir(self.cache_dir):
+            filepath = os.path.join(self.cache_dir, filename)
+            try:
+                if filename.endswith('.json') and os.path.getmtime(filepath) <= expired:
+                    os.remove(filepath)
+            except OSError:
+                # Removed by another process
+                pass
+
+
+bbox_cache = BboxCache()
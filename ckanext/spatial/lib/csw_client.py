@@ -3,16 +3,147 @@ Some very thin wrapper classes around those in OWSLib
 for convenience.
 """
 
+import os
+import time
+import hashlib
 import logging
+import tempfile
+import threading
+import urlparse
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
+import requests
+from requests.adapters import HTTPAdapter
+import owslib
 from owslib.etree import etree
 from owslib.fes import PropertyIsEqualTo
 
 log = logging.getLogger(__name__)
 
+CSW_NAMESPACE = 'http://www.opengis.net/cat/csw/2.0.2'
+OGC_NAMESPACE = 'http://www.opengis.net/ogc'
+OWS_NAMESPACE = 'http://www.opengis.net/ows'
+
+# Version of OWSLib (pinned in pip-requirements.txt) whose reading of the CSW
+# capabilities is reproduced by CswService._create_ows
+OWSLIB_VERSION = '0.8.2'
+
 class CswError(Exception):
     pass
 
+class CapabilitiesCache(object):
+    """
+    Cache of the capabilities documents of the services used by OwsService,
+    so they are not requested again each time it connects to one.
+
+    Only the documents are cached, each OwsService parses them into its own
+    OWSLib object, as these also hold the state of the requests made with
+    them.
+
+    The documents are kept in memory, keyed by service type and endpoint URL,
+    for `ttl` seconds (up to `max_size` of them, discarding the least
+    recently used first). If `cache_dir` is set, they are also stored there,
+    so other processes do not need to request them again.
+
+    The number of hits (in memory or on disk) and misses is kept in `hits`,
+    `disk_hits` and `misses`.
+    """
+
+    def __init__(self, ttl=300, max_size=100, cache_dir=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, service, endpoint, request):
+        """
+        Returns the capabilities document of a service endpoint, calling
+        `request(endpoint)` to get it if there is no valid one in the cache.
+        """
+        if not self.ttl:
+            with self._lock:
+                self.misses += 1
+            return request(endpoint)
+
+        key = (service, endpoint)
+        now = time.time()
+        with self._lock:
+            cached = self._documents.pop(key, None)
+            if cached and cached[0] + self.ttl > now:
+                # Move it to the end, as the most recently used
+                self._documents[key] = cached
+                self.hits += 1
+                return cached[1]
+
+        capabilities = self._load(key, now)
+        if capabilities is None:
+            capabilities = request(endpoint)
+            self._save(key, capabilities)
+            with self._lock:
+                self.misses += 1
+        else:
+            with self._lock:
+                self.disk_hits += 1
+
+        with self._lock:
+            self._documents[key] = (now, capabilities)
+            while len(self._documents) > self.max_size:
+                self._documents.popitem(last=False)
+        return capabilities
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return 'capabilities cache: %i hits, %i disk hits, %i misses' % \
+                (self.hits, self.disk_hits, self.misses)
+
+    def _get_filepath(self, key):
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(('%s %s' % key).encode('utf-8')).hexdigest() + '.xml')
+
+    def _load(self, key, now):
+        if not self.cache_dir:
+            return None
+        filepath = self._get_filepath(key)
+        try:
+            if os.path.getmtime(filepath) + self.ttl <= now:
+                return None
+            with open(filepath, 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def _save(self, key, capabilities):
+        if not self.cache_dir or not isinstance(capabilities, str):
+            return
+        filepath = self._get_filepath(key)
+        tmp_filepath = None
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir, 0700)
+            fd, tmp_filepath = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(capabilities)
+            os.rename(tmp_filepath, filepath)
+        except (IOError, OSError), e:
+            log.warning('Could not store capabilities for %s in %s: %s',
+                        key[1], self.cache_dir, e)
+            if tmp_filepath and os.path.exists(tmp_filepath):
+                try:
+                    os.remove(tmp_filepath)
+                except OSError:
+                    pass
+
+capabilities_cache = CapabilitiesCache()
+
 class OwsService(object):
     def __init__(self, endpoint=None):
         if endpoint is not None:
@@ -49,8 +180,23 @@ class OwsService(object):
         if not hasattr(self, "__ows_obj__"):
             if endpoint is None:
                 raise ValueError("Must specify a service endpoint")
-            self.__ows_obj__ = self._Implementation(endpoint)
+            capabilities = capabilities_cache.get(
+                self._service, endpoint, self._request_capabilities)
+            self.__ows_obj__ = self._create_ows(endpoint, capabilities)
         return self.__ows_obj__
+
+    def _request_capabilities(self, endpoint):
+        """
+        Returns the capabilities document of the service at endpoint.
+        """
+        raise NotImplementedError("Needs an Implementation")
+
+    def _create_ows(self, endpoint, capabilities):
+        """
+        Returns a new OWSLib object for the service, with the given
+        capabilities document.
+        """
+        raise NotImplementedError("Needs an Implementation")
     
     def getcapabilities(self, debug=False, **kw):
         ows = self._ows(**kw)
@@ -66,6 +212,57 @@ class CswService(OwsService):
     Perform various operations on a CSW service
     """
     from owslib.csw import CatalogueServiceWeb as _Implementation
+    _service = 'CSW'
+
+    def _request_capabilities(self, endpoint, timeout=10):
+        params = {
+            'service': 'CSW',
+            'version': '2.0.2',
+            'request': 'GetCapabilities',
+        }
+        log.info('Making CSW request: GetCapabilities %s', endpoint)
+        response = requests.get(endpoint, params=params, timeout=timeout)
+        response.raise_for_status()
+        tree = etree.fromstring(response.content)
+        if tree.tag == '{%s}ExceptionReport' % OWS_NAMESPACE:
+            texts = [text.strip() for text in tree.itertext() if text.strip()]
+            raise CswError('Error getting capabilities: %r' % texts)
+        if tree.tag != '{%s}Capabilities' % CSW_NAMESPACE:
+            raise CswError('Not a CSW capabilities document: %s' % tree.tag)
+        return response.content
+
+    def _create_ows(self, endpoint, capabilities):
+        """
+        Returns a new OWSLib CatalogueServiceWeb, reading the capabilities
+        as it does after requesting them.
+
+        OWSLib can not be given the capabilities document, so this is only
+        done with the version it is pinned to. With any other version it
+        requests the capabilities itself.
+        """
+        if owslib.__version__ != OWSLIB_VERSION:
+            log.warning('OWSLib %s is not supported, the cached CSW capabilities '
+                        'are not used (install OWSLib %s)',
+                        owslib.__version__, OWSLIB_VERSION)
+            return self._Implementation(endpoint)
+
+        from owslib import ows, fes, util
+        from owslib.csw import namespaces
+        csw = self._Implementation(endpoint, skip_caps=True)
+        csw.response = capabilities
+        tree = etree.fromstring(capabilities)
+
+        val = tree.find(util.nspath_eval('ows:ServiceIdentification', namespaces))
+        csw.identification = ows.ServiceIdentification(val, csw.owscommon.namespace)
+        val = tree.find(util.nspath_eval('ows:ServiceProvider', namespaces))
+        csw.provider = ows.ServiceProvider(val, csw.owscommon.namespace)
+        csw.operations = [ows.OperationsMetadata(elem, csw.owscommon.namespace)
+                          for elem in tree.findall(util.nspath_eval(
+                              'ows:OperationsMetadata/ows:Operation', namespaces))]
+        val = tree.find(util.nspath_eval('ogc:Filter_Capabilities', namespaces))
+        csw.filters = fes.FilterCapabilities(val)
+        return csw
+
     def getrecords(self, qtype=None, keywords=[],
                    typenames="csw:Record", esn="brief",
                    skip=0, count=10, outputschema="gmd", **kw):
@@ -145,6 +342,55 @@ class CswService(OwsService):
 
             kwa["startposition"] = startposition
 
+    def getfullrecords(self, qtype=None, typenames="csw:Record", limit=None,
+                       page=100, outputschema="gmd", startposition=1,
+                       timeout=60, **kw):
+        """
+        Pages through the records of the server with GetRecords requests
+        for the full element set, yielding an (identifier, xml) tuple for
+        each record, where xml is the record serialized as unicode.
+
+        The responses are parsed as they are downloaded and the records
+        discarded once yielded, so large pages do not need to be held in
+        memory.
+        """
+        from owslib.csw import namespaces
+        csw = self._ows(**kw)
+
+        i = 0
+        while True:
+            request = _getrecords_request(qtype, typenames, "full",
+                                          startposition, page,
+                                          namespaces[outputschema])
+            log.info('Making CSW request: GetRecords startposition=%s maxrecords=%s',
+                     startposition, page)
+            response = requests.post(csw.url, data=request, stream=True,
+                                     timeout=timeout,
+                                     headers={'Content-Type': 'application/xml'})
+            search_results = {}
+            count = 0
+            try:
+                response.raise_for_status()
+                response.raw.decode_content = True
+
+                for identifier, record in _iterparse_records(response.raw,
+                                                             search_results):
+                    if limit is not None and i >= limit:
+                        break
+                    count += 1
+                    i += 1
+                    yield identifier, record
+            finally:
+                # Also run if the generator is closed before the page is read
+                response.close()
+
+            next_record = int(search_results.get('nextRecord') or 0)
+            matches = int(search_results.get('numberOfRecordsMatched') or 0)
+            if count == 0 or (limit is not None and i >= limit) or \
+                    next_record == 0 or next_record > matches:
+                break
+            startposition = next_record
+
     def getrecordbyid(self, ids=[], esn="full", outputschema="gmd", **kw):
         from owslib.csw import namespaces
         csw = self._ows(**kw)
@@ -181,3 +427,223 @@ class CswService(OwsService):
         record["xml"] = '<?xml version="1.0" encoding="UTF-8"?>\n' + record["xml"]
         record["tree"] = mdtree
         return record
+
+
+class CswRecordFetcher(object):
+    """
+    Fetches records from a CSW server with concurrent GetRecordById
+    requests.
+
+    The requests are made by `workers` threads sharing a pool of keep-alive
+    connections. If `rate_limit` is set, no more than that number of
+    requests per second are made to each host. Requests failing because of
+    connection errors, timeouts or server errors are retried up to
+    `retries` times.
+
+    The capabilities of the server are only requested once, when the fetcher
+    is created, to find the GetRecordById endpoint.
+    """
+
+    def __init__(self, url, workers=4, rate_limit=None, retries=2,
+                 timeout=60, outputschema="gmd"):
+        from owslib.csw import namespaces
+        self.csw = CswService(url)
+        self.url = _get_operation_url(self.csw._ows(), 'GetRecordById', url)
+        self.workers = workers
+        self.retries = retries
+        self.timeout = timeout
+        self.outputschema = namespaces[outputschema]
+        self.rate_limiter = _RateLimiter(rate_limit) if rate_limit else None
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._pool = None
+
+    def getrecordsbyid(self, ids):
+        """
+        Fetches the records with the given identifiers, yielding an
+        (identifier, record, error) tuple for each of them in the same order.
+
+        record is a dict with the record XML as for `CswService.getrecordbyid`
+        (or None if the server did not return it) and error the exception
+        raised when fetching it, if any.
+        """
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers)
+        return self._pool.imap(self._fetch, ids)
+
+    def close(self):
+        """
+        Stops the worker threads and closes the connections of the fetcher.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        self.session.close()
+
+    def _fetch(self, identifier):
+        try:
+            return identifier, self.getrecordbyid(identifier), None
+        except Exception, e:
+            return identifier, None, e
+
+    def getrecordbyid(self, identifier):
+        params = {
+            'service': 'CSW',
+            'version': '2.0.2',
+            'request': 'GetRecordById',
+            'id': identifier,
+            'elementSetName': 'full',
+            'outputSchema': self.outputschema,
+        }
+        host = urlparse.urlparse(self.url).netloc
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.wait(host)
+            try:
+                log.debug('Making CSW request: GetRecordById %s', identifier)
+                response = self.session.get(self.url, params=params,
+                                            timeout=self.timeout)
+                if response.status_code < 500:
+                    break
+                error = CswError('Server error %s getting record by id %s' %
+                                 (response.status_code, identifier))
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout), e:
+                error = e
+            if attempt >= self.retries:
+                raise error
+            attempt += 1
+            log.info('Retrying CSW request for %s (%s)', identifier, error)
+            time.sleep(2 ** attempt * 0.5)
+
+        response.raise_for_status()
+        return _parse_getrecordbyid_response(response.content)
+
+
+class _RateLimiter(object):
+    """
+    Spaces the requests to each host so no more than `rate` are made per
+    second, across all threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+def _get_operation_url(ows, operation_name, default):
+    """
+    Returns the GET URL of an operation from the capabilities of a service,
+    or the default one if not advertised.
+    """
+    for operation in getattr(ows, 'operations', []):
+        if operation.name != operation_name:
+            continue
+        methods = operation.methods
+        if isinstance(methods, dict):
+            # Older versions of OWSLib key the methods by type
+            methods = [dict(value, type=key) for key, value in methods.items()]
+        for method in methods:
+            if method.get('type', '').endswith('Get') and method.get('url'):
+                return method['url']
+    return default
+
+def _parse_getrecordbyid_response(content):
+    """
+    Returns a record dict with the XML of the record in a GetRecordById
+    response, as `CswService.getrecordbyid` does, or None if it is empty.
+    """
+    tree = etree.fromstring(content)
+    if tree.tag == '{%s}ExceptionReport' % OWS_NAMESPACE:
+        texts = [text.strip() for text in tree.itertext() if text.strip()]
+        raise CswError('Error getting record by id: %r' % texts)
+    records = [child for child in tree if isinstance(child.tag, basestring)]
+    if not records:
+        return None
+    xml = etree.tostring(records[0], pretty_print=True, encoding=unicode)
+    return {'xml': '<?xml version="1.0" encoding="UTF-8"?>\n' + xml}
+
+
+def _getrecords_request(qtype, typenames, esn, startposition, maxrecords,
+                        outputschema):
+    """
+    Returns the XML body of a CSW 2.0.2 GetRecords request.
+    """
+    nsmap = {'csw': CSW_NAMESPACE, 'ogc': OGC_NAMESPACE}
+    root = etree.Element('{%s}GetRecords' % CSW_NAMESPACE, nsmap=nsmap)
+    root.set('service', 'CSW')
+    root.set('version', '2.0.2')
+    root.set('resultType', 'results')
+    root.set('startPosition', str(startposition))
+    root.set('maxRecords', str(maxrecords))
+    root.set('outputSchema', outputschema)
+
+    query = etree.SubElement(root, '{%s}Query' % CSW_NAMESPACE)
+    query.set('typeNames', typenames)
+    etree.SubElement(query, '{%s}ElementSetName' % CSW_NAMESPACE).text = esn
+
+    if qtype is not None:
+        constraint = etree.SubElement(query, '{%s}Constraint' % CSW_NAMESPACE)
+        constraint.set('version', '1.1.0')
+        filter_ = etree.SubElement(constraint, '{%s}Filter' % OGC_NAMESPACE)
+        equal = etree.SubElement(filter_, '{%s}PropertyIsEqualTo' % OGC_NAMESPACE)
+        etree.SubElement(equal, '{%s}PropertyName' % OGC_NAMESPACE).text = 'dc:type'
+        etree.SubElement(equal, '{%s}Literal' % OGC_NAMESPACE).text = qtype
+
+    return etree.tostring(root, xml_declaration=True, encoding='UTF-8')
+
+def _iterparse_records(source, search_results):
+    """
+    Parses a GetRecords response from a file-like object, yielding an
+    (identifier, xml) tuple for each record as soon as it has been read.
+
+    The attributes of the csw:SearchResults element (eg nextRecord) are
+    stored in the search_results dict.
+    """
+    from owslib.csw import namespaces
+    results_tag = '{%s}SearchResults' % CSW_NAMESPACE
+    exception_tag = '{%s}ExceptionReport' % OWS_NAMESPACE
+    identifier_paths = [
+        '{%s}fileIdentifier/{%s}CharacterString' % (namespaces['gmd'], namespaces['gco']),
+        '{%s}identifier' % namespaces['dc'],
+    ]
+
+    for event, element in etree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if element.tag == results_tag:
+                search_results.update(element.attrib)
+            continue
+
+        if element.tag == exception_tag:
+            texts = [text.strip() for text in element.itertext() if text.strip()]
+            raise CswError('Error getting records: %r' % texts)
+
+        parent = element.getparent()
+        if parent is None or parent.tag != results_tag:
+            continue
+
+        identifier = None
+        for path in identifier_paths:
+            identifier = element.findtext(path)
+            if identifier is not None:
+                identifier = identifier.strip()
+                break
+        yield identifier, etree.tostring(element, pretty_print=True, encoding=unicode)
+
+        # Free the records already read
+        element.clear()
+        while element.getprevious() is not None:
+            del parent[0]
@@ -0,0 +1,254 @@
+'''
+Aggregation of the dataset extents in the cells of a grid, used to show the
+density of datasets on zoomed out maps instead of their extents.
+
+Two grids are supported, both regular on lon/lat (EPSG:4326):
+
+* ``lonlat``: square cells, 180 / 2 ** level degrees wide.
+* ``geohash``: the cells of the geohashes of `level` characters.
+
+Each dataset is counted in the cell that contains the centroid of its
+extent (only the extents of active datasets are stored, see
+save_package_extent). The counts are computed in PostGIS, or read from the
+package_extent_grid table for the grids listed on the
+`ckanext.spatial.grid.precomputed` option, which is updated as the extents
+change.
+'''
+import math
+import logging
+
+from ckan.model import Session
+from ckan.lib.base import config
+
+from ckanext.spatial.lib.tiles import MERCATOR_MAX_LATITUDE
+
+log = logging.getLogger(__name__)
+
+GRIDS = ('lonlat', 'geohash')
+
+# Approximate number of cells on each side of a map tile
+CELLS_PER_TILE = 8
+
+# Zoom levels above this one use the cells of this one
+DEFAULT_MAX_ZOOM = 10
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Column (x) and row (y) of the cell containing the lon/lat centroid of each
+# extent, with the cell size as :width and :height. As the incremental
+# updates, it does not look at the state of the datasets
+_CELLS_SQL = '''SELECT LEAST(FLOOR((ST_X(c) + 180) / :width), :columns - 1) AS x,
+                       LEAST(FLOOR((ST_Y(c) + 90) / :height), :rows - 1) AS y
+                FROM (SELECT ST_Transform(ST_Centroid(package_extent.the_geom), 4326) AS c
+                      FROM package_extent
+                      WHERE NOT ST_IsEmpty(package_extent.the_geom)
+                         %s) AS centroids'''
+
+
+def get_precomputed_grids():
+    '''
+    Returns the grids whose counts are kept on the package_extent_grid
+    table.
+    '''
+    grids = config.get('ckanext.spatial.grid.precomputed', '').split()
+    for grid in grids:
+        if grid not in GRIDS:
+            raise ValueError('Unknown grid on ckanext.spatial.grid.precomputed: %s' % grid)
+    return grids
+
+def get_max_zoom():
+    return int(config.get('ckanext.spatial.grid.max_zoom', DEFAULT_MAX_ZOOM))
+
+def get_cell_size(grid, level):
+    '''
+    Returns the (width, height) in degrees of the cells of a grid level.
+    '''
+    if grid == 'geohash':
+        # The bits of the geohash alternate between longitude and latitude,
+        # starting with longitude
+        bits = 5 * level
+        lon_bits = (bits + 1) / 2
+        return 360.0 / 2 ** lon_bits, 180.0 / 2 ** (bits - lon_bits)
+    return 180.0 / 2 ** level, 180.0 / 2 ** level
+
+def get_grid_level(grid, zoom):
+    '''
+    Returns the level of a grid used for a map zoom level, the first one
+    with about CELLS_PER_TILE cells (or more) on each side of a tile.
+    '''
+    zoom = min(max(zoom, 0), get_max_zoom())
+    target = 360.0 / 2 ** zoom / CELLS_PER_TILE
+    level = 1 if grid == 'geohash' else 0
+    while get_cell_size(grid, level)[0] > target:
+        level += 1
+    return level
+
+def get_grid_levels(grid):
+    '''
+    Returns the levels of a grid that can be used, up to the one of the
+    maximum zoom level.
+    '''
+    return range(1 if grid == 'geohash' else 0, get_grid_level(grid, get_max_zoom()) + 1)
+
+def _get_grid_shape(grid, level):
+    width, height = get_cell_size(grid, level)
+    return width, height, int(round(360 / width)), int(round(180 / height))
+
+def get_cell(grid, level, lon, lat):
+    '''
+    Returns the (x, y) column and row of the cell containing a point,
+    counted from the south west corner.
+    '''
+    width, height, columns, rows = _get_grid_shape(grid, level)
+    return (min(max(int(math.floor((lon + 180) / width)), 0), columns - 1),
+            min(max(int(math.floor((lat + 90) / height)), 0), rows - 1))
+
+def get_cell_bounds(grid, level, x, y):
+    '''
+    Returns the (minx, miny, maxx, maxy) bounds of a cell.
+    '''
+    width, height = get_cell_size(grid, level)
+    return (-180 + x * width, -90 + y * height,
+            -180 + (x + 1) * width, -90 + (y + 1) * height)
+
+def get_cell_id(grid, level, x, y):
+    '''
+    Returns the identifier of a cell, its geohash or a "level/x/y" string.
+    '''
+    if grid != 'geohash':
+        return '%i/%i/%i' % (level, x, y)
+
+    bits = 5 * level
+    lon_bits = (bits + 1) / 2
+    lat_bits = bits - lon_bits
+    value = 0
+    for i in xrange(bits):
+        if i % 2 == 0:
+            bit = (x >> (lon_bits - 1 - i / 2)) & 1
+        else:
+            bit = (y >> (lat_bits - 1 - i / 2)) & 1
+        value = (value << 1) | bit
+    return ''.join(GEOHASH_ALPHABET[(value >> (5 * (level - 1 - i))) & 31]
+                   for i in xrange(level))
+
+
+def aggregate_extents(bbox, zoom, grid='lonlat'):
+    '''
+    Returns the level of the grid used for a map zoom level and a list of
+    (x, y, count) tuples with the number of datasets on each of its cells
+    that intersect a lon/lat bounding box dict (see validate_bbox). Cells
+    without datasets are not returned.
+    '''
+    if grid not in GRIDS:
+        raise ValueError('Unknown grid: %s' % grid)
+
+    level = get_grid_level(grid, zoom)
+    minx, miny = get_cell(grid, level, bbox['minx'], bbox['miny'])
+    maxx, maxy = get_cell(grid, level, bbox['maxx'], bbox['maxy'])
+    params = {'grid': grid, 'level': level,
+              'minx': minx, 'miny': miny, 'maxx': maxx, 'maxy': maxy}
+
+    if grid in get_precomputed_grids():
+        sql = '''SELECT x, y, count FROM package_extent_grid
+                 WHERE grid = :grid AND level = :level
+                    AND x BETWEEN :minx AND :maxx AND y BETWEEN :miny AND :maxy
+                    AND count > 0
+                 ORDER BY y, x'''
+    else:
+        db_srid = int(config.get('ckan.spatial.srid', '4326'))
+        # Only the extents whose bounding box intersects the cells can have
+        # their centroid in them
+        cells_bounds = get_cell_bounds(grid, level, minx, miny)[:2] + \
+            get_cell_bounds(grid, level, maxx, maxy)[2:]
+        envelope = 'ST_GeomFromText(:envelope, 4326)'
+        if db_srid != 4326:
+            envelope = 'ST_Transform(%s, :db_srid)' % envelope
+            # The poles can not be projected to eg Web Mercator
+            cells_bounds = (cells_bounds[0], max(cells_bounds[1], -MERCATOR_MAX_LATITUDE),
+                            cells_bounds[2], min(cells_bounds[3], MERCATOR_MAX_LATITUDE))
+        width, height, columns, rows = _get_grid_shape(grid, level)
+        params.update({'envelope': 'POLYGON ((%r %r, %r %r, %r %r, %r %r, %r %r))' % (
+                           cells_bounds[0], cells_bounds[1], cells_bounds[0], cells_bounds[3],
+                           cells_bounds[2], cells_bounds[3], cells_bounds[2], cells_bounds[1],
+                           cells_bounds[0], cells_bounds[1]),
+                       'db_srid': db_srid, 'width': width, 'height': height,
+                       'columns': columns, 'rows': rows})
+        sql = '''SELECT x, y, COUNT(*) FROM (%s) AS cells
+                 WHERE x BETWEEN :minx AND :maxx AND y BETWEEN :miny AND :maxy
+                 GROUP BY x, y
+                 ORDER BY y, x''' % \
+            (_CELLS_SQL % ('AND package_extent.the_geom && %s' % envelope))
+
+    return level, [(int(x), int(y), int(count))
+                   for x, y, count in Session.execute(sql, params)]
+
+
+def get_extent_centroid(package_id):
+    '''
+    Returns the (lon, lat) centroid of the extent of a dataset, or None if
+    it has none.
+    '''
+    sql = '''SELECT ST_X(c), ST_Y(c)
+             FROM (SELECT ST_Transform(ST_Centroid(the_geom), 4326) AS c
+                   FROM package_extent
+                   WHERE package_id = :package_id
+                      AND NOT ST_IsEmpty(the_geom)) AS centroid'''
+    row = Session.execute(sql, {'package_id': package_id}).fetchone()
+    return tuple(row) if row and row[0] is not None else None
+
+def update_grid_counts(old=None, new=None):
+    '''
+    Moves a dataset between the cells of the precomputed grids, given the
+    (lon, lat) centroids of its old and new extents (None if it had or has
+    none).
+    '''
+    changes = []
+    for grid in get_precomputed_grids():
+        for level in get_grid_levels(grid):
+            old_cell = get_cell(grid, level, *old) if old else None
+            new_cell = get_cell(grid, level, *new) if new else None
+            if old_cell == new_cell:
+                continue
+            if old_cell:
+                changes.append((grid, level) + old_cell + (-1,))
+            if new_cell:
+                changes.append((grid, level) + new_cell + (1,))
+
+    # The rows are always locked in the same order, so concurrent updates
+    # do not deadlock
+    for grid, level, x, y, value in sorted(changes):
+        _increment_grid_count(grid, level, x, y, value)
+
+def _increment_grid_count(grid, level, x, y, value):
+    params = {'grid': grid, 'level': level, 'x': x, 'y': y, 'value': value,
+              'key': '%s/%i/%i/%i' % (grid, level, x, y)}
+    update_sql = '''UPDATE package_extent_grid SET count = count + :value
+                    WHERE grid = :grid AND level = :level AND x = :x AND y = :y'''
+    if Session.execute(update_sql, params).rowcount or value < 0:
+        return
+
+    # Another process may be adding the cell too, so it is locked until the
+    # end of the transaction and updated again before adding it (the update
+    # sees the cells committed meanwhile)
+    Session.execute('SELECT pg_advisory_xact_lock(hashtext(:key))', params)
+    if not Session.execute(update_sql, params).rowcount:
+        Session.execute('''INSERT INTO package_extent_grid (grid, level, x, y, count)
+                           VALUES (:grid, :level, :x, :y, :value)''', params)
+
+def rebuild_grid_counts():
+    '''
+    Computes again the counts of all the levels of the precomputed grids
+    (eg after changing the grids or the maximum zoom level). The caller is
+    responsible for committing the changes.
+    '''
+    Session.execute('DELETE FROM package_extent_grid')
+    for grid in get_precomputed_grids():
+        for level in get_grid_levels(grid):
+            width, height, columns, rows = _get_grid_shape(grid, level)
+            params = {'grid': grid, 'level': level, 'width': width, 'height': height,
+                      'columns': columns, 'rows': rows}
+            result = Session.execute('''INSERT INTO package_extent_grid (grid, level, x, y, count)
+                                        SELECT :grid, :level, x, y, COUNT(*) FROM (%s) AS cells
+                                        GROUP BY x, y''' % (_CELLS_SQL % ''), params)
+            log.debug('Computed %i cells of level %i of the %s grid',
+                      result.rowcount, level, grid)
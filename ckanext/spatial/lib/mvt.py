@@ -0,0 +1,203 @@
+'''
+Minimal encoder of Mapbox Vector Tiles (version 2 of the specification),
+used to render the dataset extents as tiles without extra dependencies.
+
+See https://github.com/mapbox/vector-tile-spec
+'''
+import struct
+
+# Feature geometry types
+POINT = 1
+LINESTRING = 2
+POLYGON = 3
+
+# Geometry commands
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+
+DEFAULT_EXTENT = 4096
+
+
+def _varint(value):
+    encoded = []
+    while True:
+        towrite = value & 0x7f
+        value >>= 7
+        if value:
+            encoded.append(struct.pack('B', towrite | 0x80))
+        else:
+            encoded.append(struct.pack('B', towrite))
+            return ''.join(encoded)
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 31)
+
+def _key(field, wire_type):
+    return _varint((field << 3) | wire_type)
+
+def _length_delimited(field, data):
+    return _key(field, 2) + _varint(len(data)) + data
+
+def _packed(field, values):
+    return _length_delimited(field, ''.join(_varint(value) for value in values))
+
+def _command(command, count):
+    return (command & 0x7) | (count << 3)
+
+
+class _GeometryEncoder(object):
+    '''
+    Encodes the geometry of a feature as a list of command integers. The
+    cursor position is kept between parts, as the coordinates are relative
+    to the previous point.
+    '''
+
+    def __init__(self):
+        self.x = 0
+        self.y = 0
+        self.commands = []
+
+    def _move(self, points, command):
+        self.commands.append(_command(command, len(points)))
+        for x, y in points:
+            self.commands.append(_zigzag(x - self.x))
+            self.commands.append(_zigzag(y - self.y))
+            self.x, self.y = x, y
+
+    def add_points(self, points):
+        if points:
+            self._move(points, MOVE_TO)
+
+    def add_line(self, points):
+        points = _remove_repeated(points)
+        if len(points) < 2:
+            return False
+        self._move(points[:1], MOVE_TO)
+        self._move(points[1:], LINE_TO)
+        return True
+
+    def add_ring(self, points, exterior):
+        points = _remove_repeated(points)
+        if len(points) > 1 and points[0] == points[-1]:
+            points = points[:-1]
+        area = _signed_area(points)
+        if len(points) < 3 or not area:
+            return False
+        # Exterior rings must have a positive area in tile coordinates
+        # (clockwise, with y pointing down), and interior rings a negative one
+        if (area > 0) != exterior:
+            points = points[::-1]
+        self._move(points[:1], MOVE_TO)
+        self._move(points[1:], LINE_TO)
+        self.commands.append(_command(CLOSE_PATH, 1))
+        return True
+
+
+def _remove_repeated(points):
+    result = []
+    for point in points:
+        if not result or result[-1] != point:
+            result.append(point)
+    return result
+
+def _signed_area(points):
+    area = 0
+    for i in xrange(len(points)):
+        x1, y1 = points[i]
+        x2, y2 = points[(i + 1) % len(points)]
+        area += x1 * y2 - x2 * y1
+    return area
+
+
+def encode_geometry(geometry, transform):
+    '''
+    Returns a (type, commands) tuple with the encoding of a shapely geometry,
+    or None if nothing is left of it in tile coordinates. `transform` is a
+    function returning the integer tile coordinates of an (x, y) tuple.
+
+    Geometry collections are encoded with their polygons, or with their lines
+    or points if they have none, as each feature can only have one type.
+    '''
+    parts = {POINT: [], LINESTRING: [], POLYGON: []}
+    _collect_parts(geometry, parts)
+
+    encoder = _GeometryEncoder()
+    if parts[POLYGON]:
+        geometry_type = POLYGON
+        for polygon in parts[POLYGON]:
+            if encoder.add_ring([transform(c) for c in polygon.exterior.coords], True):
+                for interior in polygon.interiors:
+                    encoder.add_ring([transform(c) for c in interior.coords], False)
+    elif parts[LINESTRING]:
+        geometry_type = LINESTRING
+        for line in parts[LINESTRING]:
+            encoder.add_line([transform(c) for c in line.coords])
+    else:
+        geometry_type = POINT
+        encoder.add_points(_remove_repeated([transform(point.coords[0])
+                                             for point in parts[POINT]]))
+
+    if not encoder.commands:
+        return None
+    return geometry_type, encoder.commands
+
+def _collect_parts(geometry, parts):
+    if geometry.is_empty:
+        return
+    geom_type = geometry.geom_type
+    if geom_type == 'Point':
+        parts[POINT].append(geometry)
+    elif geom_type in ('LineString', 'LinearRing'):
+        parts[LINESTRING].append(geometry)
+    elif geom_type == 'Polygon':
+        parts[POLYGON].append(geometry)
+    else:
+        # Multi geometries and collections
+        for part in geometry.geoms:
+            _collect_parts(part, parts)
+
+
+def encode_layer(name, features, extent=DEFAULT_EXTENT):
+    '''
+    Encodes a layer of a vector tile.
+
+    features - list of (geometry_type, commands, properties) tuples, as
+               returned by encode_geometry plus a dict of string properties
+    '''
+    keys, values = [], []
+    key_indexes, value_indexes = {}, {}
+    encoded_features = []
+    for feature_id, (geometry_type, commands, properties) in enumerate(features):
+        tags = []
+        for key, value in sorted(properties.iteritems()):
+            if value is None:
+                continue
+            if key not in key_indexes:
+                key_indexes[key] = len(keys)
+                keys.append(key)
+            if value not in value_indexes:
+                value_indexes[value] = len(values)
+                values.append(value)
+            tags.extend((key_indexes[key], value_indexes[value]))
+
+        encoded_features.append(_length_delimited(2,
+            _key(1, 0) + _varint(feature_id + 1) +
+            (_packed(2, tags) if tags else '') +
+            _key(3, 0) + _varint(geometry_type) +
+            _packed(4, commands)))
+
+    layer = [_key(15, 0) + _varint(2),
+             _length_delimited(1, name.encode('utf-8'))]
+    layer.extend(encoded_features)
+    layer.extend(_length_delimited(3, key.encode('utf-8')) for key in keys)
+    layer.extend(_length_delimited(4, _length_delimited(1, unicode(value).encode('utf-8')))
+                 for value in values)
+    layer.append(_key(5, 0) + _varint(extent))
+    return ''.join(layer)
+
+def encode_tile(layers):
+    '''
+    Encodes a vector tile from a list of encoded layers (see encode_layer).
+    '''
+    return ''.join(_length_delimited(3, layer) for layer in layers)
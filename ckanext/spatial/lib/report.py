@@ -3,19 +3,31 @@ Library for creating reports that can be displayed easily in an HTML table
 and then saved as a CSV.
 '''
 
+import cgi
 import datetime
 import csv
 try: from cStringIO import StringIO
 except ImportError: from StringIO import StringIO
 
 class ReportTable(object):
-    def __init__(self, column_names):
+    def __init__(self, column_names, row_dicts=None):
+        '''
+        If an iterable of row dicts is provided, the rows are only generated
+        when the report is output (so they can be read only once), instead
+        of being stored in memory.
+        '''
         assert isinstance(column_names, (list, tuple))
         self.column_names = column_names
-        self.rows = []
+        if row_dicts is None:
+            self.rows = []
+        else:
+            self.rows = (self._get_row(row_dict) for row_dict in row_dicts)
 
     def add_row_dict(self, row_dict):
         '''Adds a row to the report table'''
+        self.rows.append(self._get_row(row_dict))
+
+    def _get_row(self, row_dict):
         row = []
         for col_name in self.column_names:
             if col_name in row_dict:
@@ -25,45 +37,128 @@ class ReportTable(object):
             row.append(value)
         if row_dict:
             raise Exception('Have left-over keys not under a column: %s' % row_dict)
-        self.rows.append(row)
+        return row
 
     def get_rows_html_formatted(self, date_format='%d/%m/%y %H:%M',
                                 blank_cell_html=''):
         for row in self.rows:
-            row_formatted = row[:]
-            for i, cell in enumerate(row):
-                if isinstance(cell, datetime.datetime):
-                    row_formatted[i] = cell.strftime(date_format)
-                elif cell is None:
-                    row_formatted[i] = blank_cell_html
-            yield row_formatted
+            yield self._format_html_row(row, date_format, blank_cell_html)
+
+    def iter_html(self, date_format='%d/%m/%y %H:%M', blank_cell_html='',
+                  chunk_size=100):
+        '''Generates the report as the rows of an HTML table (with the
+        header row first), in UTF-8 encoded strings of `chunk_size` rows, eg
+        to use it as the body of a streamed response.'''
+        chunk = [u'<tr>%s</tr>' % u''.join([u'<th>%s</th>' % self._escape_html(col_name)
+                                             for col_name in self.column_names])]
+        count = 0
+        for row in self.rows:
+            cells = []
+            for cell in self._format_html_row(row, date_format, None):
+                if cell is None:
+                    cells.append(u'<td>%s</td>' % blank_cell_html)
+                else:
+                    cells.append(u'<td>%s</td>' % self._escape_html(cell))
+            chunk.append(u'<tr>%s</tr>' % u''.join(cells))
+            count += 1
+            if count % chunk_size == 0:
+                yield (u'\n'.join(chunk) + u'\n').encode('utf8')
+                chunk = []
+        if chunk:
+            yield (u'\n'.join(chunk) + u'\n').encode('utf8')
 
     def get_csv(self):
         csvout = StringIO()
-        csvwriter = csv.writer(
-            csvout,
+        self.write_csv(csvout)
+        return csvout.getvalue()
+
+    def write_csv(self, f):
+        '''Writes the report in CSV format to the given file object, one row
+        at a time.'''
+        csvwriter = self._get_csv_writer(f)
+        csvwriter.writerow(self.column_names)
+        for row in self.rows:
+            self._write_csv_row(csvwriter, row)
+
+    def iter_csv(self, chunk_size=100):
+        '''Generates the report in CSV format, in strings of `chunk_size`
+        rows, eg to use it as the body of a streamed response.'''
+        csvout = StringIO()
+        csvwriter = self._get_csv_writer(csvout)
+        csvwriter.writerow(self.column_names)
+        count = 0
+        for row in self.rows:
+            self._write_csv_row(csvwriter, row)
+            count += 1
+            if count % chunk_size == 0:
+                yield csvout.getvalue()
+                csvout = StringIO()
+                csvwriter = self._get_csv_writer(csvout)
+        if count % chunk_size or not count:
+            yield csvout.getvalue()
+
+    def _get_csv_writer(self, f):
+        return csv.writer(
+            f,
             dialect='excel',
             quoting=csv.QUOTE_NONNUMERIC
         )
-        csvwriter.writerow(self.column_names)
-        for row in self.rows:
-            row_formatted = []
-            for cell in row:
-                if isinstance(cell, datetime.datetime):
-                    cell = cell.strftime('%Y-%m-%d %H:%M')
-                elif isinstance(cell, (int, long)):
-                    cell = str(cell)
-                elif isinstance(cell, (list, tuple)):
-                    cell = str(cell)
-                elif cell is None:
-                    cell = ''
-                else:
-                    cell = cell.encode('utf8')
-                row_formatted.append(cell)
-            try:
-                csvwriter.writerow(row_formatted)
-            except Exception, e:
-                raise Exception("%s: %s, %s"%(e, row, row_formatted))
-        csvout.seek(0)
-        return csvout.read()
-        
+
+    def _write_csv_row(self, csvwriter, row):
+        row_formatted = []
+        for cell in row:
+            if isinstance(cell, datetime.datetime):
+                cell = cell.strftime('%Y-%m-%d %H:%M')
+            elif isinstance(cell, (int, long)):
+                cell = str(cell)
+            elif isinstance(cell, (list, tuple)):
+                cell = str(cell)
+            elif cell is None:
+                cell = ''
+            else:
+                cell = cell.encode('utf8')
+            row_formatted.append(cell)
+        try:
+            csvwriter.writerow(row_formatted)
+        except Exception, e:
+            raise Exception("%s: %s, %s"%(e, row, row_formatted))
+
+    def _format_html_row(self, row, date_format, blank_cell_html):
+        row_formatted = row[:]
+        for i, cell in enumerate(row):
+            if isinstance(cell, datetime.datetime):
+                row_formatted[i] = cell.strftime(date_format)
+            elif cell is None:
+                row_formatted[i] = blank_cell_html
+        return row_formatted
+
+    def _escape_html(self, cell):
+        if isinstance(cell, str):
+            cell = cell.decode('utf8')
+        elif not isinstance(cell, unicode):
+            cell = unicode(cell)
+        return cgi.escape(cell)
+
+
+class StreamingReportTable(ReportTable):
+    '''
+    A report table that does not keep the rows in memory: they are written
+    in CSV format to the given file object (eg an open file or a WSGI
+    response body) as soon as they are added, so memory usage does not
+    depend on the size of the report.
+    '''
+    def __init__(self, column_names, f):
+        super(StreamingReportTable, self).__init__(column_names)
+        self.rows = None
+        self.row_count = 0
+        self._csvwriter = self._get_csv_writer(f)
+        self._csvwriter.writerow(self.column_names)
+
+    def add_row_dict(self, row_dict):
+        '''Adds a row to the report table, writing it straight away'''
+        self._write_csv_row(self._csvwriter, self._get_row(row_dict))
+        self.row_count += 1
+
+    def add_row_dicts(self, row_dicts):
+        for row_dict in row_dicts:
+            self.add_row_dict(row_dict)
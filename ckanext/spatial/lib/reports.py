@@ -1,19 +1,31 @@
 import logging
+import multiprocessing
 
 from lxml import etree
 
 from ckanext.spatial.harvesters import SpatialHarvester
 from ckanext.spatial.lib.report import ReportTable
+from ckanext.spatial.validation import Validators
 from ckan import model
 from ckanext.harvest.model import HarvestObject
 
-def validation_report(package_id=None):
+DEFAULT_CHUNK_SIZE = 100
+
+# Validators used by each of the report worker processes
+_worker_validators = None
+
+def validation_report(package_id=None, processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
     '''
     Looks at every harvested metadata record and compares the
     validation errors that it had on last import and what it would be with
     the current validators. Useful when going to update the validators.
 
-    Returns a ReportTable.
+    The harvest objects are read from the database in chunks of `chunk_size`
+    and validated by a pool of `processes` worker processes (by default as
+    many as CPUs, with 1 the validation is done in this process).
+
+    Returns a ReportTable. Its rows are generated as the report is output,
+    so they can only be read once.
     '''
     log = logging.getLogger(__name__ + '.validation_report')
 
@@ -27,7 +39,10 @@ def validation_report(package_id=None):
     if package_id:
         query = query.filter(HarvestObject.package_id==package_id)
 
-    report = ReportTable([
+    row_dicts = _validation_report_rows(query, validators.profiles,
+                                        processes, chunk_size)
+
+    return ReportTable([
         'Harvest Object id',
         'GEMINI2 id',
         'Date fetched',
@@ -35,40 +50,123 @@ def validation_report(package_id=None):
         'Publisher',
         'Source URL',
         'Old validation errors',
-        'New validation errors'])
+        'New validation errors'], row_dicts)
+
+def _validation_report_rows(query, profiles, processes, chunk_size):
+    '''
+    Generates the validation report row dicts for the harvest objects of the
+    query, validating one chunk in the worker processes while the rows of the
+    previous one are being output.
+    '''
+    log = logging.getLogger(__name__ + '.validation_report')
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes > 1:
+        # The forked workers would share the open database connections, so
+        # they are closed first (this process opens new ones as needed)
+        model.Session.close()
+        model.meta.engine.dispose()
+        pool = multiprocessing.Pool(processes, _init_validation_worker, (profiles,))
+    else:
+        pool = None
+        _init_validation_worker(profiles)
+
+    # Use a server side cursor so the objects are not all loaded at once
+    query = query.execution_options(stream_results=True).yield_per(chunk_size)
+
+    stats = {'count': 0, 'old_failures': 0, 'new_failures': 0}
+    try:
+        pending = None
+        for chunk in _chunks(query, chunk_size):
+            row_dicts = []
+            contents = []
+            for harvest_object in chunk:
+                row_dict, content = _get_validation_report_row(harvest_object)
+                if row_dict['Old validation errors']:
+                    stats['old_failures'] += 1
+                row_dicts.append(row_dict)
+                contents.append(content)
+            if pool:
+                results = pool.map_async(_validate_content, contents)
+            else:
+                results = map(_validate_content, contents)
 
-    old_validation_failure_count = 0
-    new_validation_failure_count = 0
+            if pending:
+                for row_dict in _add_validation_results(*pending, stats=stats):
+                    yield row_dict
+            pending = (row_dicts, results)
 
-    for harvest_object in query:
-        validation_errors = []
-        for err in harvest_object.errors:
-            if 'not a valid Gemini' in err.message or \
-                   'Validating against' in err.message:
-                validation_errors.append(err.message)
-        if validation_errors:
-            old_validation_failure_count += 1
+        if pending:
+            for row_dict in _add_validation_results(*pending, stats=stats):
+                yield row_dict
+    finally:
+        if pool:
+            pool.terminate()
 
-        groups = harvest_object.package.get_groups()
-        publisher = groups[0].title if groups else '(none)'
+    log.debug('%i results', stats['count'])
+    log.debug('%i failed old validation', stats['old_failures'])
+    log.debug('%i failed new validation', stats['new_failures'])
 
-        xml = etree.fromstring(harvest_object.content.encode("utf-8"))
-        valid, errors = validators.is_valid(xml)
+def _chunks(iterable, chunk_size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _get_validation_report_row(harvest_object):
+    '''
+    Returns the report row dict for a harvest object (without the new
+    validation errors) and its content
+    '''
+    validation_errors = []
+    for err in harvest_object.errors:
+        if 'not a valid Gemini' in err.message or \
+               'Validating against' in err.message:
+            validation_errors.append(err.message)
+
+    groups = harvest_object.package.get_groups()
+    publisher = groups[0].title if groups else '(none)'
+
+    row_dict = {
+        'Harvest Object id': harvest_object.id,
+        'GEMINI2 id': harvest_object.guid,
+        'Date fetched': harvest_object.fetch_finished,
+        'Dataset name': harvest_object.package.name,
+        'Publisher': publisher,
+        'Source URL': harvest_object.source.url,
+        'Old validation errors': '; '.join(validation_errors),
+        }
+    return row_dict, harvest_object.content
+
+def _add_validation_results(row_dicts, results, stats):
+    if hasattr(results, 'get'):
+        results = results.get()
+    for row_dict, (valid, errors) in zip(row_dicts, results):
+        stats['count'] += 1
         if not valid:
-            new_validation_failure_count += 1
-                         
-        report.add_row_dict({
-                             'Harvest Object id': harvest_object.id,
-                             'GEMINI2 id': harvest_object.guid,
-                             'Date fetched': harvest_object.fetch_finished,
-                             'Dataset name': harvest_object.package.name,
-                             'Publisher': publisher,
-                             'Source URL': harvest_object.source.url,
-                             'Old validation errors': '; '.join(validation_errors),
-                             'New validation errors': '; '.join(errors),
-                             })
-
-    log.debug('%i results', query.count())
-    log.debug('%i failed old validation', old_validation_failure_count)
-    log.debug('%i failed new validation', new_validation_failure_count)
-    return report
+            stats['new_failures'] += 1
+        row_dict['New validation errors'] = '; '.join(errors)
+        yield row_dict
+
+def _init_validation_worker(profiles):
+    global _worker_validators
+    _worker_validators = Validators(profiles=profiles)
+    _worker_validators.prepare()
+
+def _validate_content(content):
+    '''
+    Validates a harvest object content with the validators of this worker.
+
+    Returns a tuple with a boolean and the list of error messages.
+    '''
+    try:
+        xml = etree.fromstring(content.encode("utf-8"))
+    except (etree.XMLSyntaxError, AttributeError), e:
+        return False, ['Could not parse XML: %s' % e]
+    valid, profile, errors = _worker_validators.is_valid(xml)
+    return valid, [error[0] for error in errors]
@@ -0,0 +1,290 @@
+'''
+In-memory spatial index of the dataset extents, used by the ``rtree`` search
+backend to filter the datasets within a bounding box without querying the
+database.
+
+The bounding boxes of the extents are bulk loaded in an R-tree packed with
+the Sort-Tile-Recursive (STR) algorithm, and the candidates returned by the
+tree are then checked against the actual geometries.
+'''
+import math
+import time
+import logging
+import threading
+
+from shapely import wkb
+from shapely.geometry import shape, box
+from shapely.prepared import prep
+
+from ckan.model import Session
+
+from ckanext.spatial.model import get_extents_version
+
+log = logging.getLogger(__name__)
+
+
+class STRTree(object):
+    '''
+    Static R-tree packed with the Sort-Tile-Recursive algorithm.
+
+    `items` is a list of (bounds, value) tuples, where bounds is a
+    (minx, miny, maxx, maxy) tuple. Each node of the tree holds up to
+    `node_capacity` children.
+    '''
+
+    def __init__(self, items, node_capacity=16):
+        self.node_capacity = node_capacity
+        self.size = len(items)
+
+        # Nodes are (minx, miny, maxx, maxy, children) tuples, and the
+        # children of the leaves the values themselves
+        nodes = [tuple(bounds) + (value,) for bounds, value in items]
+        self.depth = 0
+        while len(nodes) > node_capacity or self.depth == 0:
+            nodes = self._pack(nodes)
+            self.depth += 1
+        self._root = nodes
+
+    def _pack(self, nodes):
+        '''
+        Groups the nodes of a level in parent nodes, sorting them in
+        vertical slices by the x of their centre, and then each slice by
+        the y of their centre.
+        '''
+        capacity = self.node_capacity
+        leaves = int(math.ceil(len(nodes) / float(capacity)))
+        slices = int(math.ceil(math.sqrt(leaves)))
+        slice_size = max(slices * capacity, 1)
+
+        nodes = sorted(nodes, key=lambda n: n[0] + n[2])
+        parents = []
+        for i in xrange(0, len(nodes), slice_size):
+            nodes_slice = sorted(nodes[i:i + slice_size], key=lambda n: n[1] + n[3])
+            for j in xrange(0, len(nodes_slice), capacity):
+                children = nodes_slice[j:j + capacity]
+                parents.append((min(n[0] for n in children),
+                                min(n[1] for n in children),
+                                max(n[2] for n in children),
+                                max(n[3] for n in children),
+                                children))
+        return parents
+
+    def query(self, bounds):
+        '''
+        Returns the values of the items whose bounds intersect the provided
+        (minx, miny, maxx, maxy) ones.
+        '''
+        minx, miny, maxx, maxy = bounds
+        results = []
+        level = self._root
+        for depth in xrange(self.depth):
+            children = []
+            for node in level:
+                if node[0] <= maxx and node[2] >= minx and \
+                   node[1] <= maxy and node[3] >= miny:
+                    children.extend(node[4])
+            level = children
+        for item in level:
+            if item[0] <= maxx and item[2] >= minx and \
+               item[1] <= maxy and item[3] >= miny:
+                results.append(item[4])
+        return results
+
+
+class ExtentsIndex(object):
+    '''
+    Index of the extents of the active datasets.
+
+    The index is loaded from the package_extent table on the first query,
+    and kept up to date with `update` (once the changes are committed).
+    Changes made by other processes (eg harvesters) are picked up by
+    checking the version of the extents (see get_extents_version) every
+    `check_interval` seconds, and loading the index again if it changed
+    (unless all the new versions were produced by this process, see
+    `add_version`). It is also loaded again every `reload_interval` seconds
+    if set.
+
+    Updated extents are kept outside the packed tree until there are
+    `max_pending` of them, when the tree is packed again.
+    '''
+
+    def __init__(self, node_capacity=16, max_pending=1000, reload_interval=0,
+                 check_interval=30):
+        self.node_capacity = node_capacity
+        self.max_pending = max_pending
+        self.reload_interval = reload_interval
+        self.check_interval = check_interval
+        self.loaded_at = None
+        self.checked_at = None
+        self.version = None
+        self._own_versions = set()
+        self._geometries = {}
+        self._pending = {}
+        self._tree = None
+        self._lock = threading.RLock()
+
+    @property
+    def loaded(self):
+        return self.loaded_at is not None
+
+    def __len__(self):
+        return len(self._geometries)
+
+    def load(self, extents=None):
+        '''
+        Bulk loads the index from an iterable of (package_id, geometry)
+        tuples, or from the database if not provided.
+        '''
+        t0 = time.time()
+        version = None
+        if extents is None:
+            # Read before the extents, so changes made meanwhile are loaded
+            # on the next check
+            version = get_extents_version()
+            extents = self._get_extents()
+        geometries = {}
+        for package_id, geometry in extents:
+            if not geometry.is_empty:
+                geometries[package_id] = _entry(geometry)
+        with self._lock:
+            self._geometries = geometries
+            self._pack()
+            self.loaded_at = self.checked_at = time.time()
+            self.version = version
+            if version is not None:
+                self._own_versions = set(v for v in self._own_versions if v > version)
+        log.debug('Loaded %i extents in the spatial index in %.2f s',
+                  len(geometries), time.time() - t0)
+
+    def _get_extents(self):
+        sql = '''SELECT package_extent.package_id, ST_AsBinary(package_extent.the_geom)
+                 FROM package_extent, package
+                 WHERE package_extent.package_id = package.id
+                    AND package.state = 'active'
+                    AND package_extent.the_geom IS NOT NULL'''
+        for package_id, geometry in Session.execute(sql):
+            yield package_id, wkb.loads(str(geometry))
+
+    def _pack(self):
+        self._tree = STRTree([(entry[0], (package_id, entry))
+                              for package_id, entry in self._geometries.iteritems()],
+                             self.node_capacity)
+        self._pending = {}
+
+    def _needs_loading(self):
+        if not self.loaded:
+            return True
+        now = time.time()
+        if self.reload_interval and now - self.loaded_at > self.reload_interval:
+            return True
+        if self.version is not None and self.check_interval and \
+           now - self.checked_at > self.check_interval:
+            self.checked_at = now
+            version = get_extents_version()
+            if version == self.version:
+                return False
+            with self._lock:
+                if all(v in self._own_versions
+                       for v in xrange(self.version + 1, version + 1)):
+                    # The changes are already in the index
+                    self.version = version
+                    self._own_versions = set(v for v in self._own_versions
+                                             if v > version)
+                    return False
+            return True
+        return False
+
+    def add_version(self, version):
+        '''
+        Records a version of the extents produced by a change made in this
+        process, which is also applied to the index with `update`, so the
+        index is not loaded again because of it.
+        '''
+        with self._lock:
+            if self.version is None or version > self.version:
+                self._own_versions.add(version)
+
+    def update(self, package_id, geometry=None):
+        '''
+        Adds, updates or (if geometry is None) removes the extent of a
+        dataset. `geometry` can be a shapely geometry or a Python object
+        implementing the Geo Interface (eg a loaded GeoJSON object).
+        '''
+        if not self.loaded:
+            # It will be read from the database when loaded
+            return
+        with self._lock:
+            if geometry is not None and not hasattr(geometry, 'wkb'):
+                geometry = shape(geometry)
+            if geometry is None or geometry.is_empty:
+                self._geometries.pop(package_id, None)
+                self._pending.pop(package_id, None)
+                return
+
+            existing = self._geometries.get(package_id)
+            if existing is not None and existing[2].wkb == geometry.wkb:
+                return
+            # The old entry on the tree will no longer match the one on
+            # _geometries, so it will be ignored
+            entry = _entry(geometry)
+            self._geometries[package_id] = entry
+            self._pending[package_id] = entry
+            if len(self._pending) >= self.max_pending:
+                self._pack()
+
+    def query(self, bbox):
+        '''
+        Returns the ids of the datasets whose extents intersect a bounding
+        box dict (see validate_bbox), in the database projection.
+        '''
+        loaded_at = self.loaded_at
+        if self._needs_loading():
+            with self._lock:
+                # Another thread may have loaded it meanwhile
+                if self.loaded_at == loaded_at:
+                    self.load()
+
+        bounds = (bbox['minx'], bbox['miny'], bbox['maxx'], bbox['maxy'])
+        with self._lock:
+            geometries = self._geometries
+            candidates = [(package_id, entry) for package_id, entry
+                          in self._tree.query(bounds)
+                          if geometries.get(package_id) is entry]
+            candidates.extend(item for item in self._pending.iteritems()
+                              if _intersects(item[1][0], bounds))
+
+        # The bounding boxes intersect, so only the geometries which are
+        # not boxes themselves and are not within the search box need to
+        # be checked
+        search_box = None
+        ids = []
+        for package_id, (geometry_bounds, is_box, geometry) in candidates:
+            if is_box or _contains(bounds, geometry_bounds):
+                ids.append(package_id)
+                continue
+            if search_box is None:
+                search_box = prep(box(*bounds))
+            if search_box.intersects(geometry):
+                ids.append(package_id)
+        return ids
+
+
+def _entry(geometry):
+    '''
+    Returns the (bounds, is_box, geometry) tuple stored for each extent.
+    '''
+    bounds = geometry.bounds
+    minx, miny, maxx, maxy = bounds
+    is_box = geometry.geom_type == 'Point' or \
+        (geometry.geom_type == 'Polygon' and
+         geometry.area == (maxx - minx) * (maxy - miny))
+    return (bounds, is_box, geometry)
+
+def _intersects(a, b):
+    return a[0] <= b[2] and a[2] >= b[0] and a[1] <= b[3] and a[3] >= b[1]
+
+def _contains(a, b):
+    return a[0] <= b[0] and a[1] <= b[1] and a[2] >= b[2] and a[3] >= b[3]
+
+
+extents_index = ExtentsIndex()
@@ -0,0 +1,225 @@
+'''
+Rendering of the dataset extents as Mapbox Vector Tiles, in the usual
+Web Mercator (EPSG:3857) tiling scheme, and a disk cache for them.
+'''
+import os
+import math
+import errno
+import shutil
+import logging
+import tempfile
+
+from shapely import wkb
+
+from ckan.model import Session
+from ckan.lib.base import config
+
+from ckanext.spatial.lib import mvt
+from ckanext.spatial.lib.transaction import on_commit
+
+log = logging.getLogger(__name__)
+
+# Half of the side of the Web Mercator world, in metres
+MERCATOR_HALF_SIDE = 20037508.342789244
+
+# Maximum latitude covered by the Web Mercator tiles
+MERCATOR_MAX_LATITUDE = 85.0511287798066
+
+# Tile pixels added on each side of the tiles when clipping the geometries,
+# so their edges are not drawn on the tile borders
+TILE_BUFFER = 64
+
+TILE_LAYER_NAME = 'extents'
+
+
+def get_tile_bounds(z, x, y):
+    '''
+    Returns the (minx, miny, maxx, maxy) bounds of a tile in EPSG:3857
+    '''
+    side = 2 * MERCATOR_HALF_SIDE / 2 ** z
+    minx = -MERCATOR_HALF_SIDE + x * side
+    maxy = MERCATOR_HALF_SIDE - y * side
+    return (minx, maxy - side, minx + side, maxy)
+
+def get_tile_range(z, bounds):
+    '''
+    Returns the (minx, miny, maxx, maxy) range of the tiles of zoom level `z`
+    covering some lon/lat bounds.
+    '''
+    n = 2 ** z
+
+    def tile_x(lon):
+        return min(max(int((lon + 180.0) / 360.0 * n), 0), n - 1)
+
+    def tile_y(lat):
+        lat = math.radians(min(max(lat, -MERCATOR_MAX_LATITUDE), MERCATOR_MAX_LATITUDE))
+        y = (1.0 - math.log(math.tan(lat) + 1.0 / math.cos(lat)) / math.pi) / 2.0 * n
+        return min(max(int(y), 0), n - 1)
+
+    minlon, minlat, maxlon, maxlat = bounds
+    return (tile_x(minlon), tile_y(maxlat), tile_x(maxlon), tile_y(minlat))
+
+def render_tile(z, x, y, extent=mvt.DEFAULT_EXTENT):
+    '''
+    Returns a vector tile with the extents of the active, public datasets
+    that intersect the tile, as a layer named "extents" with the `id` and `name`
+    of the datasets as properties.
+
+    The geometries are clipped to the tile (plus a buffer) and simplified to
+    one pixel in PostGIS.
+    '''
+    db_srid = int(config.get('ckan.spatial.srid', '4326'))
+
+    minx, miny, maxx, maxy = get_tile_bounds(z, x, y)
+    pixel = (maxx - minx) / extent
+    margin = pixel * TILE_BUFFER
+    tile_wkt = 'POLYGON ((%r %r, %r %r, %r %r, %r %r, %r %r))' % (
+        minx - margin, miny - margin, minx - margin, maxy + margin,
+        maxx + margin, maxy + margin, maxx + margin, miny - margin,
+        minx - margin, miny - margin)
+
+    # The geometries are clipped on the database projection, so the ones
+    # reaching the poles can be projected to Web Mercator
+    sql = '''SELECT package.id, package.name,
+                    ST_AsBinary(ST_SimplifyPreserveTopology(
+                        ST_Transform(ST_Intersection(package_extent.the_geom, tile.geom), 3857),
+                        :tolerance))
+             FROM package_extent, package,
+                  (SELECT ST_Transform(ST_GeomFromText(:tile, 3857), :db_srid) AS geom) AS tile
+             WHERE package_extent.package_id = package.id
+                AND package_extent.the_geom && tile.geom
+                AND ST_Intersects(package_extent.the_geom, tile.geom)
+                AND package.state = 'active'
+                AND package.private IS NOT TRUE
+             ORDER BY package.id'''
+    params = {'tile': tile_wkt, 'db_srid': db_srid, 'tolerance': pixel}
+
+    def transform(coords):
+        return (int(round((coords[0] - minx) / pixel)),
+                int(round((maxy - coords[1]) / pixel)))
+
+    features = []
+    for package_id, name, geometry in Session.execute(sql, params):
+        if not geometry:
+            continue
+        encoded = mvt.encode_geometry(wkb.loads(str(geometry)), transform)
+        if encoded:
+            features.append(encoded + ({'id': package_id, 'name': name},))
+
+    return mvt.encode_tile([mvt.encode_layer(TILE_LAYER_NAME, features, extent)])
+
+
+class TileCache(object):
+    '''
+    Disk cache of the extents vector tiles, stored as `{z}/{x}/{y}.mvt`
+    files in `cache_dir` (disabled if not set).
+
+    The tiles covering an extent are removed with `invalidate` when it
+    changes.
+    '''
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+
+    def _get_filepath(self, z, x, y):
+        return os.path.join(self.cache_dir, str(z), str(x), '%i.mvt' % y)
+
+    def get(self, z, x, y):
+        '''
+        Returns the tile from the cache, rendering and storing it if
+        necessary.
+        '''
+        if not self.cache_dir:
+            return render_tile(z, x, y)
+
+        filepath = self._get_filepath(z, x, y)
+        try:
+            with open(filepath, 'rb') as f:
+                return f.read()
+        except IOError:
+            pass
+
+        tile = render_tile(z, x, y)
+        try:
+            if not os.path.exists(os.path.dirname(filepath)):
+                os.makedirs(os.path.dirname(filepath))
+            fd, tmp_filepath = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(tile)
+            os.rename(tmp_filepath, filepath)
+        except (IOError, OSError), e:
+            log.warning('Could not store the tile %i/%i/%i in %s: %s',
+                        z, x, y, self.cache_dir, e)
+        return tile
+
+    def invalidate(self, bounds=None):
+        '''
+        Removes the cached tiles covering some lon/lat (minx, miny, maxx,
+        maxy) bounds, on all zoom levels, or all of them if no bounds are
+        provided. Only the tiles on the cache are looked at, so it is cheap
+        even for large extents.
+        '''
+        if not self.cache_dir or not os.path.exists(self.cache_dir):
+            return
+        if bounds is None:
+            for name in os.listdir(self.cache_dir):
+                if name.isdigit():
+                    shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+            return
+
+        removed = 0
+        for z in _int_names(self.cache_dir):
+            minx, miny, maxx, maxy = get_tile_range(z, bounds)
+            zoom_dir = os.path.join(self.cache_dir, str(z))
+            for x in _int_names(zoom_dir):
+                # Neighbouring tiles include the geometries within their buffer
+                if not minx - 1 <= x <= maxx + 1:
+                    continue
+                x_dir = os.path.join(zoom_dir, str(x))
+                for y in _int_names(x_dir, '.mvt'):
+                    if not miny - 1 <= y <= maxy + 1:
+                        continue
+                    try:
+                        os.remove(os.path.join(x_dir, '%i.mvt' % y))
+                        removed += 1
+                    except OSError, e:
+                        # It may have been removed by another process
+                        if e.errno != errno.ENOENT:
+                            raise
+        log.debug('Removed %i cached tiles', removed)
+
+
+def _int_names(path, extension=''):
+    '''
+    Returns the numbers used as names of the files or directories in a
+    directory (without the extension).
+    '''
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return []
+    numbers = []
+    for name in names:
+        if name.endswith(extension) and name[:len(name) - len(extension)].isdigit():
+            numbers.append(int(name[:len(name) - len(extension)]))
+    return numbers
+
+
+tile_cache = TileCache()
+
+def invalidate_tiles(geometries=None, srid=None):
+    '''
+    Removes the cached tiles covering some shapely geometries (eg the old
+    and new extents of a dataset) in the given projection once the current
+    transaction is committed, so they are not rendered again from the old
+    extents meanwhile. If no geometries are provided, or the projection is
+    not lon/lat, all the tiles are removed.
+    '''
+    if not tile_cache.cache_dir:
+        return
+    if geometries is None or srid != 4326:
+        on_commit(tile_cache.invalidate)
+        return
+    for geometry in geometries:
+        if not geometry.is_empty:
+            on_commit(tile_cache.invalidate, geometry.bounds)
@@ -0,0 +1,80 @@
+'''
+Actions run once the current database transaction is committed, so the
+effects of a change outside the database (eg removing cached tiles or
+updating the in-memory spatial index) are not seen by other processes
+before the change itself, and are discarded if it is rolled back.
+'''
+import logging
+import threading
+
+from sqlalchemy import event
+
+from ckan.model import Session
+
+log = logging.getLogger(__name__)
+
+# The Session is scoped to the thread, and so are the pending actions
+_state = threading.local()
+_listening = False
+_listening_lock = threading.Lock()
+
+
+def on_commit(callback, *args):
+    '''
+    Calls `callback(*args)` after the current transaction of the Session is
+    committed, or discards it if the transaction is rolled back or the
+    Session is removed without ending it.
+
+    It must be called once the transaction has begun (ie after its first
+    statement), as the pending actions are discarded when a new one begins.
+    '''
+    _listen()
+    _get_actions().append((callback, args))
+
+def _get_actions():
+    actions = getattr(_state, 'actions', None)
+    if actions is None:
+        actions = _state.actions = []
+    return actions
+
+def _listen():
+    global _listening
+    if _listening:
+        return
+    with _listening_lock:
+        if not _listening:
+            event.listen(Session, 'after_begin', _after_begin)
+            event.listen(Session, 'after_commit', _after_commit)
+            event.listen(Session, 'after_rollback', _after_rollback)
+            _listening = True
+
+def _is_savepoint(session):
+    # The events are also sent when a savepoint is released or rolled back
+    transaction = getattr(session, 'transaction', None)
+    return bool(transaction is not None and transaction.nested)
+
+def _after_begin(session, transaction, connection):
+    # Any actions left belong to a transaction that was neither committed
+    # nor rolled back (eg a Session removed at the end of a request)
+    if transaction.nested:
+        return
+    if _get_actions():
+        log.debug('Discarding the actions of a transaction not committed')
+    _state.actions = []
+
+def _after_commit(session):
+    if _is_savepoint(session):
+        return
+    actions = _get_actions()
+    _state.actions = []
+    for callback, args in actions:
+        try:
+            callback(*args)
+        except Exception, e:
+            # The changes are already committed
+            log.error('Error running %r after commit: %s', callback, e)
+
+def _after_rollback(session):
+    if _is_savepoint(session):
+        return
+    _state.actions = []
@@ -1,8 +1,19 @@
+import re
+from collections import MutableMapping
+
 from lxml import etree
 
 import logging
 log = logging.getLogger(__name__)
 
+# SinglePassXmlReader of each document class
+_single_pass_readers = {}
+
+
+class MappedXmlParseError(Exception):
+    '''Error reading a value of a LazyMappedXmlValues mapping'''
+    pass
+
 
 class MappedXmlObject(object):
     elements = []
@@ -14,16 +25,42 @@ class MappedXmlDocument(MappedXmlObject):
         self.xml_str = xml_str
         self.xml_tree = xml_tree
 
-    def read_values(self):
+    def read_values(self, single_pass=False, lazy=False):
         '''For all of the elements listed, finds the values of them in the
-        XML and returns them.'''
-        values = {}
+        XML and returns them.
+
+        If single_pass is True, the values are read walking the XML tree only
+        once (see SinglePassXmlReader), which is faster for large documents.
+
+        If lazy is True, a LazyMappedXmlValues mapping is returned instead,
+        which only reads the values that are actually accessed. As each value
+        is read on its own, it can not be combined with single_pass.
+        '''
+        if lazy and single_pass:
+            raise ValueError('The lazy values can not be read in a single pass')
+        if lazy:
+            return LazyMappedXmlValues(self)
         tree = self.get_xml_tree()
-        for element in self.elements:
-            values[element.name] = element.read_value(tree)
+        if single_pass:
+            values = self.get_single_pass_reader().read_values(tree)
+        else:
+            values = {}
+            for element in self.elements:
+                values[element.name] = element.read_value(tree)
         self.infer_values(values)
         return values
 
+    @classmethod
+    def get_single_pass_reader(cls):
+        '''Returns the SinglePassXmlReader for the elements of this class,
+        creating it only the first time it is requested (or if the elements
+        have changed since).'''
+        reader = _single_pass_readers.get(cls)
+        if reader is None or reader.elements != cls.elements:
+            reader = SinglePassXmlReader(cls.elements)
+            _single_pass_readers[cls] = reader
+        return reader
+
     def read_value(self, name):
         '''For the given element name, find the value in the XML and return
         it.
@@ -48,6 +85,122 @@ class MappedXmlDocument(MappedXmlObject):
         pass
 
 
+class LazyMappedXmlValues(MutableMapping):
+    '''
+    Mapping with the values of a MappedXmlDocument, as returned by
+    `read_values`, that only reads each element from the XML the first time
+    it is accessed and then caches it.
+
+    The values added by the document `infer_values` method are computed the
+    first time one of them (or any other key that is not an element name) is
+    accessed, or when iterating over the mapping. They are computed from the
+    values in the document, not from the ones changed afterwards in the
+    mapping, as is the case with `read_values`.
+
+    Any error reading or inferring the values is raised as a
+    MappedXmlParseError.
+    '''
+
+    def __init__(self, document):
+        self.document = document
+        # Parse the document now, so errors are raised as with read_values
+        self.tree = document.get_xml_tree()
+        self._elements = dict((element.name, element)
+                              for element in document.elements)
+        self._read = {}
+        self._inferred = None
+        self._changed = {}
+        self._deleted = set()
+
+    def __getitem__(self, key):
+        if key in self._deleted:
+            raise KeyError(key)
+        if key in self._changed:
+            return self._changed[key]
+        if self._inferred is not None and key in self._inferred:
+            return self._inferred[key]
+        if key in self._elements:
+            return self._read_element(key)
+        return self._infer_values()[key]
+
+    def __setitem__(self, key, value):
+        self._deleted.discard(key)
+        self._changed[key] = value
+
+    def __delitem__(self, key):
+        if not key in self:
+            raise KeyError(key)
+        self._changed.pop(key, None)
+        self._deleted.add(key)
+
+    def __iter__(self):
+        keys = set(self._elements) | set(self._infer_values()) | \
+            set(self._changed)
+        return iter(keys - self._deleted)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, dict(self))
+
+    def has_key(self, key):
+        return key in self
+
+    def _read_element(self, key):
+        if not key in self._read:
+            try:
+                self._read[key] = self._elements[key].read_value(self.tree)
+            except Exception, e:
+                raise MappedXmlParseError('Error reading %s: %s' % (key, e))
+        return self._read[key]
+
+    def _infer_values(self):
+        if self._inferred is None:
+            self._inferred = {}
+            try:
+                self.document.infer_values(_InferredXmlValues(self))
+            except MappedXmlParseError:
+                self._inferred = None
+                raise
+            except Exception, e:
+                self._inferred = None
+                raise MappedXmlParseError('Error inferring the values: %s' % e)
+        return self._inferred
+
+
+class _InferredXmlValues(MutableMapping):
+    '''
+    Mapping passed to `infer_values` by LazyMappedXmlValues. It reads the
+    element values from the document and stores the inferred ones.
+    '''
+
+    def __init__(self, values):
+        self.values = values
+
+    def __getitem__(self, key):
+        if key in self.values._inferred:
+            return self.values._inferred[key]
+        if key in self.values._elements:
+            return self.values._read_element(key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self.values._inferred[key] = value
+
+    def __delitem__(self, key):
+        del self.values._inferred[key]
+
+    def __iter__(self):
+        return iter(set(self.values._elements) | set(self.values._inferred))
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def has_key(self, key):
+        return key in self
+
+
 class MappedXmlElement(MappedXmlObject):
     namespaces = {}
 
@@ -57,6 +210,12 @@ class MappedXmlElement(MappedXmlObject):
         self.multiplicity = multiplicity
         self.elements = elements or self.elements
 
+        # Compile the search paths now (ie when the document classes are
+        # defined) rather than for every document read
+        self._xpaths = {}
+        for xpath in self.get_search_paths():
+            self.get_xpath(xpath)
+
     def read_value(self, tree):
         values = []
         for xpath in self.get_search_paths():
@@ -74,7 +233,16 @@ class MappedXmlElement(MappedXmlObject):
         return search_paths
 
     def get_elements(self, tree, xpath):
-        return tree.xpath(xpath, namespaces=self.namespaces)
+        return self.get_xpath(xpath)(tree)
+
+    def get_xpath(self, xpath):
+        '''Returns the compiled version of an XPath expression, compiling it
+        only the first time it is requested.'''
+        compiled = self._xpaths.get(xpath)
+        if compiled is None:
+            compiled = etree.XPath(xpath, namespaces=self.namespaces)
+            self._xpaths[xpath] = compiled
+        return compiled
 
     def get_values(self, elements):
         values = []
@@ -142,6 +310,185 @@ class MappedXmlElement(MappedXmlObject):
             return values
 
 
+class SinglePassXmlReader(object):
+    '''
+    Reads the values of a list of mapped elements walking the XML tree only
+    once, instead of evaluating every search path of every element against
+    the whole tree.
+
+    The search paths are merged in a tree of location steps, so each node of
+    the document is visited at most once and only if some search path goes
+    through it. The values returned are the same as the ones returned by
+    the `read_value` method of the elements.
+
+    Only simple location paths are supported: child steps, descendant steps
+    ("//") and a final text() or attribute step. Elements with other kind
+    of search paths, or that override how their values are read, are read
+    with their XPath expressions.
+    '''
+
+    _step_re = re.compile(r'^(?:([A-Za-z_][\w.-]*):)?([A-Za-z_][\w.-]*)$')
+
+    def __init__(self, elements):
+        self.elements = list(elements)
+        self.root = _PathNode()
+        # Number of search paths read so far, each one gets an index in the
+        # list of matches
+        self.path_count = 0
+        # Indexes of the search paths of each element read in the single pass
+        self.path_indexes = {}
+        # Readers for the values of the elements with nested elements
+        self.nested = {}
+
+        for index, element in enumerate(self.elements):
+            if not self._is_supported(element):
+                continue
+            paths = [self._parse_path(search_path, element.namespaces)
+                     for search_path in element.get_search_paths()]
+            if None in paths:
+                continue
+            self.path_indexes[index] = []
+            for steps, target in paths:
+                node = self.root
+                for descendant, tag in steps:
+                    node = node.get_child(tag, descendant)
+                node.targets.append((self.path_count,) + target)
+                self.path_indexes[index].append(self.path_count)
+                self.path_count += 1
+            if element.elements:
+                self.nested[index] = SinglePassXmlReader(element.elements)
+
+    def read_values(self, tree):
+        '''Returns a dict with the values of all elements, keyed by name.'''
+        matches = [[] for i in xrange(self.path_count)]
+        self._walk(tree, self.root, matches)
+
+        values = {}
+        for index, element in enumerate(self.elements):
+            if not index in self.path_indexes:
+                values[element.name] = element.read_value(tree)
+                continue
+            element_values = []
+            for path_index in self.path_indexes[index]:
+                if matches[path_index]:
+                    element_values = self._get_values(index, element,
+                                                      matches[path_index])
+                    break
+            values[element.name] = element.fix_multiplicity(element_values)
+        return values
+
+    def _walk(self, element, node, matches):
+        for path_index, kind, name in node.targets:
+            if kind == 'element':
+                matches[path_index].append(element)
+            elif kind == 'attribute':
+                value = element.get(name)
+                if value is not None:
+                    matches[path_index].append(value)
+            else:
+                # Same text nodes as text(): the element text and the tails
+                # of its children
+                if element.text is not None:
+                    matches[path_index].append(element.text)
+                for child in element:
+                    if child.tail is not None:
+                        matches[path_index].append(child.tail)
+
+        if node.children:
+            children = node.children
+            for child in element:
+                child_node = children.get(child.tag)
+                if child_node is not None:
+                    self._walk(child, child_node, matches)
+        if node.descendants:
+            for tag, descendant_node in node.descendants.iteritems():
+                for descendant in element.iterdescendants(tag):
+                    self._walk(descendant, descendant_node, matches)
+
+    def _get_values(self, index, element, found):
+        if index in self.nested:
+            return [self.nested[index].read_values(item) for item in found]
+        values = []
+        for item in found:
+            if isinstance(item, basestring):
+                values.append(item)
+            else:
+                values.append(element.element_tostring(item))
+        return values
+
+    def _is_supported(self, element):
+        for method in ('read_value', 'get_elements', 'get_values', 'get_value'):
+            if getattr(type(element), method).im_func is not \
+                    getattr(MappedXmlElement, method).im_func:
+                return False
+        return True
+
+    def _parse_path(self, search_path, namespaces):
+        '''
+        Returns a tuple with the list of (descendant, tag) steps of a search
+        path and the (kind, name) of what is selected at the end of it, or
+        None if the path is not supported.
+        '''
+        if search_path.startswith('/'):
+            return None
+        steps = []
+        descendant = False
+        parts = search_path.split('/')
+        target = ('element', None)
+        for position, part in enumerate(parts):
+            last = position == len(parts) - 1
+            if part == '':
+                if descendant or last:
+                    return None
+                descendant = True
+                continue
+            if last and part == 'text()':
+                target = ('text', None)
+                break
+            if last and part.startswith('@'):
+                name = self._get_name(part[1:], namespaces)
+                if name is None:
+                    return None
+                target = ('attribute', name)
+                break
+            tag = self._get_name(part, namespaces)
+            if tag is None:
+                return None
+            steps.append((descendant, tag))
+            descendant = False
+        if descendant:
+            return None
+        return steps, target
+
+    def _get_name(self, step, namespaces):
+        match = self._step_re.match(step)
+        if not match:
+            return None
+        prefix, local_name = match.groups()
+        if prefix is None:
+            return local_name
+        if not prefix in namespaces:
+            return None
+        return '{%s}%s' % (namespaces[prefix], local_name)
+
+
+class _PathNode(object):
+    '''A location step shared by one or more search paths.'''
+
+    def __init__(self):
+        self.children = {}
+        self.descendants = {}
+        # (search path index, kind, name) of the search paths ending in this
+        # step
+        self.targets = []
+
+    def get_child(self, tag, descendant=False):
+        steps = self.descendants if descendant else self.children
+        if not tag in steps:
+            steps[tag] = _PathNode()
+        return steps[tag]
+
+
 class ISOElement(MappedXmlElement):
 
     namespaces = {
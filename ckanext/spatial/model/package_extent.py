@@ -1,6 +1,6 @@
 from logging import getLogger
 
-from sqlalchemy import types, Column, Table
+from sqlalchemy import types, Column, Table, Sequence
 
 from geoalchemy import Geometry, GeometryColumn, GeometryDDL, GeometryExtensionColumn
 from geoalchemy.postgis import PGComparator
@@ -15,9 +15,15 @@ from ckan.model.domain_object import DomainObject
 log = getLogger(__name__)
 
 package_extent_table = None
+package_extent_version_seq = None
+package_extent_grid_table = None
 
 DEFAULT_SRID = 4326 #(WGS 84)
 
+# Name of the GiST index on the extents geometry column (the same that
+# GeoAlchemy uses when creating the table)
+SPATIAL_INDEX_NAME = 'idx_package_extent_the_geom'
+
 def setup(srid=None):
 
     if package_extent_table is None:
@@ -44,10 +50,19 @@ def setup(srid=None):
 
                 raise e
 
+            package_extent_version_seq.create(checkfirst=True)
+            package_extent_grid_table.create(checkfirst=True)
+
             log.debug('Spatial tables created')
         else:
             log.debug('Spatial tables already exist')
             # Future migrations go here
+            package_extent_version_seq.create(checkfirst=True)
+            package_extent_grid_table.create(checkfirst=True)
+            if not get_spatial_indexes():
+                log.warning('The package_extent table has no spatial index, ' + \
+                        'spatial queries will be slow. Please run the ' + \
+                        '"spatial migrate" paster command to create it.')
 
     else:
         log.debug('Spatial tables creation deferred')
@@ -61,6 +76,8 @@ class PackageExtent(DomainObject):
 def define_spatial_tables(db_srid=None):
 
     global package_extent_table
+    global package_extent_version_seq
+    global package_extent_grid_table
 
     if not db_srid:
         db_srid = int(config.get('ckan.spatial.srid', DEFAULT_SRID))
@@ -79,6 +96,111 @@ def define_spatial_tables(db_srid=None):
     # enable the DDL extension
     GeometryDDL(package_extent_table)
 
-
-
-
+    # Incremented every time an extent changes (see get_extents_version)
+    package_extent_version_seq = Sequence('package_extent_version',
+                                          metadata=meta.metadata)
+
+    # Number of datasets on each cell of the precomputed grids (see
+    # ckanext.spatial.lib.grid)
+    package_extent_grid_table = Table('package_extent_grid', meta.metadata,
+                    Column('grid', types.UnicodeText, primary_key=True),
+                    Column('level', types.Integer, primary_key=True),
+                    Column('x', types.Integer, primary_key=True),
+                    Column('y', types.Integer, primary_key=True),
+                    Column('count', types.Integer, nullable=False, default=0))
+
+def get_spatial_indexes():
+    '''
+    Returns a list with the names of the GiST indexes on the package_extent
+    table geometry column.
+    '''
+    sql = '''SELECT indexname FROM pg_indexes
+             WHERE tablename = 'package_extent'
+                AND indexdef ILIKE '%USING gist%'
+                AND indexdef LIKE '%the_geom%' '''
+    return [row[0] for row in Session.execute(sql)]
+
+def create_spatial_index():
+    '''
+    Creates a GiST index on the package_extent table geometry column, if it
+    does not have one yet, and updates the table statistics so the query
+    planner uses it.
+
+    Returns True if the index was created.
+    '''
+    created = False
+    if not get_spatial_indexes():
+        Session.execute('CREATE INDEX %s ON package_extent USING GIST (the_geom)'
+                        % SPATIAL_INDEX_NAME)
+        created = True
+        log.debug('Spatial index created')
+    Session.execute('ANALYZE package_extent')
+    Session.commit()
+    return created
+
+def get_spatial_index_usage():
+    '''
+    Returns a list of dicts with the usage statistics of the indexes of the
+    package_extent table: `name`, `scans` (times the index was used),
+    `tuples_read`, `tuples_fetched` and `size` (pretty printed).
+    '''
+    sql = '''SELECT indexrelname, idx_scan, idx_tup_read, idx_tup_fetch,
+                    pg_size_pretty(pg_relation_size(indexrelid))
+             FROM pg_stat_user_indexes
+             WHERE relname = 'package_extent'
+             ORDER BY indexrelname'''
+    return [dict(zip(('name', 'scans', 'tuples_read', 'tuples_fetched', 'size'), row))
+            for row in Session.execute(sql)]
+
+def explain_spatial_query(srid=None):
+    '''
+    Checks that bounding box queries on the package_extent table can use its
+    spatial index, looking at the plan of a query like the ones run by
+    `bbox_query` (the planner is asked to avoid sequential scans, as on
+    small tables they are cheaper than the index).
+
+    Returns a tuple with a boolean, True if the spatial index is used, and
+    the lines of the query plan. The current transaction is rolled back.
+    '''
+    if not srid:
+        srid = int(config.get('ckan.spatial.srid', DEFAULT_SRID))
+
+    sql = '''EXPLAIN SELECT package_extent.package_id
+             FROM package_extent, package
+             WHERE package_extent.package_id = package.id
+                AND ST_Intersects(package_extent.the_geom,
+                                  ST_GeomFromText(:query_bbox, :query_srid))
+                AND package.state = 'active' '''
+    params = {'query_bbox': 'POLYGON ((0 0, 0 1, 1 1, 1 0, 0 0))',
+              'query_srid': srid}
+    try:
+        Session.execute('SET LOCAL enable_seqscan TO off')
+        plan = [row[0] for row in Session.execute(sql, params)]
+    finally:
+        Session.rollback()
+
+    indexes = get_spatial_indexes()
+    uses_index = any(index in line for line in plan for index in indexes)
+    return uses_index, plan
+
+def get_extents_version():
+    '''
+    Returns the current version of the extents, which is incremented every
+    time an extent is created, updated or deleted, by any process.
+    '''
+    # The sequence returns its start value on the first nextval
+    sql = '''SELECT last_value + CAST(is_called AS INTEGER)
+             FROM package_extent_version'''
+    return Session.execute(sql).scalar()
+
+def increment_extents_version():
+    '''
+    Increments the version of the extents. It must be called once the
+    changes are committed (see ckanext.spatial.lib.transaction), otherwise
+    other processes could cache the old extents with the new version.
+
+    Returns the new version.
+    '''
+    # nextval is not transactional, so it is run on its own connection
+    value = meta.engine.execute("SELECT nextval('package_extent_version')").scalar()
+    return value + 1
@@ -12,10 +12,20 @@ from ckan.lib.search import SearchError, PackageSearchQuery
 from ckan.lib.helpers import json
 
 from ckanext.spatial.lib import save_package_extent,validate_bbox, bbox_query, bbox_query_ordered
-from ckanext.spatial.model.package_extent import setup as setup_model
+from ckanext.spatial.lib.bbox_cache import bbox_cache
+from ckanext.spatial.lib.spatial_index import extents_index
+from ckanext.spatial.lib.tiles import tile_cache
+from ckanext.spatial.lib.transaction import on_commit
+from ckanext.spatial.model.package_extent import setup as setup_model, PackageExtent, \
+     get_extents_version
 
 log = getLogger(__name__)
 
+# Number of dataset ids of each clause of the boolean queries used to filter
+# the Solr results by the ids returned by PostGIS (Solr's maxBooleanClauses
+# is 1024 by default)
+POSTGIS_IDS_CHUNK_SIZE = 1000
+
 def package_error_summary(error_dict):
     ''' Do some i18n stuff on the error_dict keys '''
 
@@ -48,6 +58,33 @@ class SpatialMetadata(p.SingletonPlugin):
         if not p.toolkit.asbool(config.get('ckan.spatial.testing', 'False')):
             setup_model()
 
+        if 'ckanext.spatial.validator.schematron_cache_dir' in config:
+            from ckanext.spatial.validation import SchematronValidator
+            SchematronValidator.cache_dir = \
+                config.get('ckanext.spatial.validator.schematron_cache_dir') or None
+
+        if p.toolkit.asbool(config.get('ckanext.spatial.validator.preload', 'False')):
+            self._prepare_validators(config)
+
+        from ckanext.spatial.lib.csw_client import capabilities_cache
+        capabilities_cache.ttl = int(config.get('ckanext.spatial.csw.capabilities_cache_ttl', 300))
+        capabilities_cache.cache_dir = config.get('ckanext.spatial.csw.capabilities_cache_dir') or None
+
+    def _prepare_validators(self, config):
+        '''
+        Compiles the XSD schemas and schematrons of the configured validation
+        profiles, so harvest workers don't pay for it on the first document.
+        '''
+        from ckanext.spatial.validation import Validators, DEFAULT_VALIDATOR_PROFILES
+
+        if config.get('ckan.spatial.validator.profiles'):
+            profiles = [x.strip() for x in
+                        config.get('ckan.spatial.validator.profiles').split(',')]
+        else:
+            profiles = DEFAULT_VALIDATOR_PROFILES
+        log.debug('Preloading validators for profile(s) %s', ','.join(profiles))
+        Validators(profiles=profiles).prepare()
+
     def update_config(self, config):
         ''' Set up the resource library, public directory and
         template directory for all the spatial extensions
@@ -71,6 +108,13 @@ class SpatialMetadata(p.SingletonPlugin):
             log.warning('Couldn\'t store spatial extent because no id was provided for the package')
             return
 
+        if package.state and package.state != 'active':
+            # Only the extents of active datasets are stored (eg they are
+            # counted on the precomputed grids)
+            save_package_extent(package.id, None)
+            on_commit(extents_index.update, package.id, None)
+            return
+
         # TODO: deleted extra
         for extra in package.extras_list:
             if extra.key == 'spatial':
@@ -87,6 +131,7 @@ class SpatialMetadata(p.SingletonPlugin):
 
                     try:
                         save_package_extent(package.id,geometry)
+                        on_commit(extents_index.update, package.id, geometry)
 
                     except ValueError,e:
                         error_dict = {'spatial':[u'Error creating geometry: %s' % str(e)]}
@@ -100,12 +145,14 @@ class SpatialMetadata(p.SingletonPlugin):
                 elif (extra.state == 'active' and not extra.value) or extra.state == 'deleted':
                     # Delete extent from table
                     save_package_extent(package.id,None)
+                    on_commit(extents_index.update, package.id, None)
 
                 break
 
 
     def delete(self, package):
         save_package_extent(package.id,None)
+        on_commit(extents_index.update, package.id, None)
 
     ## ITemplateHelpers
 
@@ -125,24 +172,71 @@ class SpatialQuery(p.SingletonPlugin):
 
     search_backend = None
 
+    # Filter used to pass the dataset ids returned by the postgis backend to
+    # Solr, 'boolean' (id:(a OR b ...), works with any Solr version) or
+    # 'terms' ({!terms f=id}a,b..., requires Solr 4.10 or higher)
+    postgis_id_filter = 'boolean'
+
+    # Maximum number of dataset ids passed to Solr by the postgis backend.
+    # If more datasets match, the bounding box is filtered on Solr instead
+    # (0 means no limit)
+    postgis_max_ids = 0
+
     def configure(self, config):
 
         self.search_backend = config.get('ckanext.spatial.search_backend', 'postgis')
-        if self.search_backend != 'postgis' and not p.toolkit.check_ckan_version('2.0.1'):
+        if self.search_backend not in ('postgis', 'rtree') and not p.toolkit.check_ckan_version('2.0.1'):
             msg = 'The Solr backends for the spatial search require CKAN 2.0.1 or higher. ' + \
                   'Please upgrade CKAN or select the \'postgis\' backend.'
             raise p.toolkit.CkanVersionException(msg)
 
+        self.postgis_id_filter = config.get('ckanext.spatial.postgis.id_filter', 'boolean')
+        if self.postgis_id_filter not in ('boolean', 'terms'):
+            raise ValueError('Unknown ckanext.spatial.postgis.id_filter: %s' % self.postgis_id_filter)
+        self.postgis_max_ids = int(config.get('ckanext.spatial.postgis.max_ids', 0))
+
+        if self.search_backend == 'rtree':
+            extents_index.reload_interval = int(config.get('ckanext.spatial.rtree.reload_interval', 0))
+            extents_index.check_interval = int(config.get('ckanext.spatial.rtree.check_interval', 30))
+
+        bbox_cache.max_size = int(config.get('ckanext.spatial.bbox_cache.size', 0))
+        bbox_cache.ttl = int(config.get('ckanext.spatial.bbox_cache.ttl', 3600))
+        bbox_cache.grid = float(config.get('ckanext.spatial.bbox_cache.grid', 0))
+        bbox_cache.cache_dir = config.get('ckanext.spatial.bbox_cache.cache_dir') or None
+
+        tile_cache.cache_dir = config.get('ckanext.spatial.tiles.cache_dir') or None
+
     def before_map(self, map):
 
         map.connect('api_spatial_query', '/api/2/search/{register:dataset|package}/geo',
             controller='ckanext.spatial.controllers.api:ApiController',
             action='spatial_query')
+        map.connect('api_spatial_tile', '/api/2/spatial/tiles/{z}/{x}/{y}.mvt',
+            controller='ckanext.spatial.controllers.api:ApiController',
+            action='spatial_tile')
+        map.connect('api_spatial_grid', '/api/2/spatial/grid',
+            controller='ckanext.spatial.controllers.api:ApiController',
+            action='spatial_grid')
         return map
 
     def before_index(self, pkg_dict):
 
-        if pkg_dict.get('extras_spatial', None) and self.search_backend in ('solr', 'solr-spatial-field'):
+        if pkg_dict.get('extras_spatial', None) and self.search_backend in ('postgis', 'rtree') \
+           and self.postgis_max_ids:
+            # Index the bounding box of the geometry, to filter on Solr the
+            # searches that match too many datasets
+            try:
+                shape = shapely.geometry.asShape(json.loads(pkg_dict['extras_spatial']))
+                minx, miny, maxx, maxy = shape.bounds
+            except Exception, e:
+                log.error('Geometry not valid GeoJSON, not indexing its bounding box')
+                return pkg_dict
+
+            pkg_dict['minx'], pkg_dict['miny'] = minx, miny
+            pkg_dict['maxx'], pkg_dict['maxy'] = maxx, maxy
+            pkg_dict['bbox_area'] = (maxx - minx) * (maxy - miny)
+
+        elif pkg_dict.get('extras_spatial', None) and self.search_backend in ('solr', 'solr-spatial-field'):
             try:
                 geometry = json.loads(pkg_dict['extras_spatial'])
             except ValueError, e:
@@ -213,6 +307,8 @@ class SpatialQuery(p.SingletonPlugin):
                 search_params = self._params_for_solr_spatial_field_search(bbox, search_params)
             elif self.search_backend == 'postgis':
                 search_params = self._params_for_postgis_search(bbox, search_params)
+            elif self.search_backend == 'rtree':
+                search_params = self._params_for_rtree_search(bbox, search_params)
 
         return search_params
 
@@ -236,6 +332,21 @@ class SpatialQuery(p.SingletonPlugin):
 
         '''
 
+        bf = self._get_solr_bbox_function(bbox)
+
+        search_params['fq_list'] = ['{!frange incl=false l=0 u=1}%s' % bf]
+
+        search_params['bf'] = bf
+        search_params['defType'] = 'edismax'
+
+        return search_params
+
+    def _get_solr_bbox_function(self, bbox):
+        '''
+        Returns the Solr function used by the solr backend to compute the
+        overlap between the search bounding box and the indexed ones (see
+        _params_for_solr_search)
+        '''
         variables =dict(
             x11=bbox['minx'],
             x12=bbox['maxx'],
@@ -248,7 +359,7 @@ class SpatialQuery(p.SingletonPlugin):
             area_search = abs(bbox['maxx'] - bbox['minx']) * abs(bbox['maxy'] - bbox['miny'])
         )
 
-        bf = '''div(
+        return '''div(
                    mul(
                    mul(max(0, sub(min({x12},{x22}) , max({x11},{x21}))),
                        max(0, sub(min({y12},{y22}) , max({y11},{y21})))
@@ -257,13 +368,6 @@ class SpatialQuery(p.SingletonPlugin):
                    add({area_search}, mul(sub({y22}, {y21}), sub({x22}, {x21})))
                 )'''.format(**variables).replace('\n','').replace(' ','')
 
-        search_params['fq_list'] = ['{!frange incl=false l=0 u=1}%s' % bf]
-
-        search_params['bf'] = bf
-        search_params['defType'] = 'edismax'
-
-        return search_params
-
     def _params_for_solr_spatial_field_search(self, bbox, search_params):
         '''
         This will add an fq filter with the form:
@@ -288,37 +392,126 @@ class SpatialQuery(p.SingletonPlugin):
                 # ...because it is too inefficient to use SOLR to filter
                 # results and return the entire set to this class and
                 # after_search do the sorting and paging.
-            extents = bbox_query_ordered(bbox)
-            are_no_results = not extents
-            search_params['extras']['ext_rows'] = search_params['rows']
-            search_params['extras']['ext_start'] = search_params['start']
-            # this SOLR query needs to return no actual results since
-            # they are in the wrong order anyway. We just need this SOLR
-            # query to get the count and facet counts.
-            rows = 0
-            search_params['sort'] = None # SOLR should not sort.
+            # Only the rows of the requested page are returned, along with
+            # the total number of results
+            rows = search_params.get('rows')
+            start = search_params.get('start') or 0
+            extents = bbox_query_ordered(bbox, limit=rows, offset=start)
+            if extents:
+                count = extents[0].total_count
+            else:
+                count = bbox_query(bbox).count() if start else 0
+
             # Store the rankings of the results for this page, so for
             # after_search to construct the correctly sorted results
-            rows = search_params['extras']['ext_rows'] = search_params['rows']
-            start = search_params['extras']['ext_start'] = search_params['start']
             search_params['extras']['ext_spatial'] = [
                 (extent.package_id, extent.spatial_ranking) \
-                for extent in extents[start:start+rows]]
-        else:
-            extents = bbox_query(bbox)
-            are_no_results = extents.count() == 0
+                for extent in extents]
+            search_params['extras']['ext_spatial_count'] = count
+            # this SOLR query needs to return no actual results since
+            # they are in the wrong order anyway. We just need this SOLR
+            # query to get the facet counts.
+            search_params['rows'] = 0
+            search_params['sort'] = None # SOLR should not sort.
+
+            if not count:
+                # after_search sets the (empty) results
+                search_params['abort_search'] = True
+                return search_params
 
-        if are_no_results:
+            # The facets are those of all the datasets within the bbox, so
+            # the query is still filtered by all their ids (only the datasets
+            # of the page are retrieved by after_search)
+
+        def get_ids(bbox):
+            # Only get the ids (one more than the limit, to know if there
+            # are too many)
+            query = bbox_query(bbox).with_entities(PackageExtent.package_id)
+            if self.postgis_max_ids:
+                query = query.limit(self.postgis_max_ids + 1)
+            return [row[0] for row in query]
+
+        bbox_query_ids = self._get_bbox_ids(bbox, get_ids)
+
+        if not bbox_query_ids:
             # We don't need to perform the search
             search_params['abort_search'] = True
+            return search_params
+
+        return self._params_for_bbox_ids(bbox, bbox_query_ids, search_params)
+
+    def _params_for_rtree_search(self, bbox, search_params):
+        '''
+        Gets the ids of the datasets within the bounding box from the
+        in-memory spatial index, and filters the Solr search by them as
+        the postgis backend does. Spatial sorting is not supported.
+        '''
+        bbox_query_ids = self._get_bbox_ids(bbox, extents_index.query)
+        if not bbox_query_ids:
+            # We don't need to perform the search
+            search_params['abort_search'] = True
+            return search_params
+
+        return self._params_for_bbox_ids(bbox, bbox_query_ids, search_params)
+
+    def _get_bbox_ids(self, bbox, query):
+        '''
+        Returns the ids of the datasets within the bounding box from the
+        cache (see BboxCache), or calling `query` with it if they are not
+        cached. The bounding box is snapped to the grid of the cache first.
+        '''
+        if not bbox_cache.enabled or self.search_backend == 'rtree':
+            # The in-memory index is faster than reading the extents
+            # version from the database
+            return query(bbox)
+
+        bbox = bbox_cache.snap(bbox)
+        key = (self.search_backend, int(config.get('ckan.spatial.srid', '4326')),
+               bbox['minx'], bbox['miny'], bbox['maxx'], bbox['maxy'])
+        return bbox_cache.get(key, get_extents_version(), lambda: query(bbox))
+
+    def _params_for_bbox_ids(self, bbox, bbox_query_ids, search_params):
+
+        if self.postgis_max_ids and len(bbox_query_ids) > self.postgis_max_ids:
+            # Too many datasets to pass their ids to Solr, filter them by
+            # their bounding boxes there instead
+            log.debug('More than %i datasets within the bbox, filtering on Solr',
+                      self.postgis_max_ids)
+            search_params['fq_list'] = search_params.get('fq_list', [])
+            search_params['fq_list'].append('{!frange incl=false l=0 u=1}%s'
+                                            % self._get_solr_bbox_function(bbox))
         else:
             # We'll perform the existing search but also filtering by the ids
             # of datasets within the bbox
-            bbox_query_ids = [extent.package_id for extent in extents]
+            search_params = self._filter_by_ids(bbox_query_ids, search_params)
 
+        return search_params
+
+    def _filter_by_ids(self, ids, search_params):
+        '''
+        Adds a filter query to the search to only return the datasets with
+        the provided ids.
+
+        With the 'terms' filter the ids are passed to the Solr terms query
+        parser. Otherwise they are split in nested boolean queries of up to
+        POSTGIS_IDS_CHUNK_SIZE clauses, so they do not exceed Solr's
+        maxBooleanClauses.
+        '''
+        if self.postgis_id_filter == 'terms':
+            fq = '{!terms f=id}%s' % ','.join(ids)
+        else:
+            chunks = [ids[i:i + POSTGIS_IDS_CHUNK_SIZE]
+                      for i in xrange(0, len(ids), POSTGIS_IDS_CHUNK_SIZE)]
+            fq = ' OR '.join('id:(%s)' % ' OR '.join(chunk) for chunk in chunks)
+
+        if p.toolkit.check_ckan_version('2.0.1'):
+            search_params['fq_list'] = search_params.get('fq_list', [])
+            search_params['fq_list'].append(fq)
+        else:
+            # Older versions do not support fq_list
             q = search_params.get('q','').strip() or '""'
             new_q = '%s AND ' % q if q else ''
-            new_q += '(%s)' % ' OR '.join(['id:%s' % id for id in bbox_query_ids])
+            new_q += '(%s)' % fq
 
             search_params['q'] = new_q
 
@@ -329,16 +522,25 @@ class SpatialQuery(p.SingletonPlugin):
         # Note: This will be deprecated at some point in favour of the
         # Solr 4 spatial sorting capabilities
 
-        if search_params.get('extras', {}).get('ext_spatial') and \
+        if search_params.get('extras', {}).get('ext_spatial') is not None and \
            p.toolkit.asbool(config.get('ckanext.spatial.use_postgis_sorting', 'False')):
-            # Apply the spatial sort
-            querier = PackageSearchQuery()
-            pkgs = []
-            for package_id, spatial_ranking in search_params['extras']['ext_spatial']:
-                # get package from SOLR
-                pkg = querier.get_index(package_id)['data_dict']
-                pkgs.append(json.loads(pkg))
-            search_results['results'] = pkgs
+            # Apply the spatial sort, getting all the packages of the page
+            # from SOLR in a single request
+            ranked_ids = [package_id for package_id, spatial_ranking
+                          in search_params['extras']['ext_spatial']]
+            pkgs = {}
+            if ranked_ids:
+                querier = PackageSearchQuery()
+                querier.run({'q': '',
+                             'fq': '+id:(%s)' % ' OR '.join(ranked_ids),
+                             'fl': 'id data_dict',
+                             'rows': len(ranked_ids),
+                             'facet': 'false'})
+                for result in querier.results:
+                    pkgs[result['id']] = json.loads(result['data_dict'])
+            search_results['results'] = [pkgs[package_id] for package_id in ranked_ids
+                                         if package_id in pkgs]
+            search_results['count'] = search_params['extras']['ext_spatial_count']
         return search_results
 
 
@@ -0,0 +1,20 @@
+'''
+Benchmarks comparing the speed of some of the optimized code paths with
+the ones they replaced. They are not collected by the test runner (the
+tests check that both give the same results on small inputs), run each
+module on its own instead, eg:
+
+    python -m ckanext.spatial.tests.benchmarks.waf
+
+The inputs shared with those tests are in the fixtures module.
+'''
+import time
+
+
+def timed(function, *args):
+    '''
+    Returns the seconds taken to call the function and its result.
+    '''
+    t0 = time.time()
+    result = function(*args)
+    return time.time() - t0, result
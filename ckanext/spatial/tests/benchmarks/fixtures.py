@@ -0,0 +1,89 @@
+'''
+Inputs shared by the benchmarks and the tests checking that the optimized
+code paths give the same results as the ones they replaced.
+'''
+import os
+import copy
+import glob
+
+from lxml import etree
+
+from ckanext.spatial.harvesters.waf import scrapers
+from ckanext.spatial.model import ISODocument
+from ckanext.spatial.model.harvested_metadata import MappedXmlElement
+
+TESTS_DIR = os.path.dirname(os.path.dirname(__file__))
+
+INDEX_TEMPLATE = '''<html><body><table>
+%s
+</table></body></html>'''
+
+LINK_TEMPLATE = '''<tr><td><a href="%s">%s</a></td><td align="right">17-Sep-2013 10:11  </td></tr>'''
+
+IIS_INDEX_TEMPLATE = '''<html><body><H1>waf.example.com - /waf/</H1><hr>
+<pre><A HREF="/">[To Parent Directory]</A><br><br>%s</pre><hr></body></html>'''
+
+IIS_LINK_TEMPLATE = ''' 9/17/2013 10:11 AM        %s <A HREF="/waf/%s">%s</A><br>'''
+
+
+def waf_index(links):
+    '''Returns an Apache WAF index page with the given links'''
+    return INDEX_TEMPLATE % '\n'.join(LINK_TEMPLATE % (link, link)
+                                      for link in links)
+
+def iis_waf_index(links):
+    '''Returns an IIS WAF index page with the given links'''
+    return IIS_INDEX_TEMPLATE % ''.join(
+        IIS_LINK_TEMPLATE % ('&lt;dir&gt;' if link.endswith('/') else '1234',
+                             link, link)
+        for link in links)
+
+def pyparsing_records(content, scraper):
+    '''Scrapes a WAF index page with the pyparsing grammars'''
+    return [(record.url, record.date)
+            for record in scrapers[scraper].parseString(content)]
+
+def read_values_with_uncompiled_xpaths(xml_string):
+    '''Reads the values of an ISO document evaluating the XPath strings'''
+    def get_elements(self, tree, xpath):
+        return tree.xpath(xpath, namespaces=self.namespaces)
+
+    original_get_elements = MappedXmlElement.get_elements
+    MappedXmlElement.get_elements = get_elements
+    try:
+        return ISODocument(xml_string).read_values()
+    finally:
+        MappedXmlElement.get_elements = original_get_elements
+
+def get_iso_fixtures():
+    '''Returns the ISO 19139 documents of the test fixtures'''
+    xml_strings = []
+    xml_dirs = [os.path.join(TESTS_DIR, 'model', 'xml'),
+                os.path.join(TESTS_DIR, 'xml', 'gemini2.1'),
+                os.path.join(TESTS_DIR, 'xml', 'iso19139')]
+    for xml_dir in xml_dirs:
+        for xml_filepath in sorted(glob.glob(os.path.join(xml_dir, '*.xml'))):
+            with open(xml_filepath, 'rb') as f:
+                xml_string = f.read()
+            try:
+                tree = etree.fromstring(xml_string)
+            except etree.XMLSyntaxError:
+                continue
+            if tree.tag == '{http://www.isotc211.org/2005/gmd}MD_Metadata':
+                xml_strings.append(xml_string)
+    return xml_strings
+
+def get_large_iso_record(copies=300):
+    '''
+    Returns a version of the gemini_dataset.xml fixture with `copies` times
+    its keywords and online resources.
+    '''
+    with open(os.path.join(TESTS_DIR, 'model', 'xml', 'gemini_dataset.xml'), 'rb') as f:
+        tree = etree.fromstring(f.read())
+    namespaces = {'gmd': 'http://www.isotc211.org/2005/gmd'}
+    for xpath in ('//gmd:MD_Keywords/gmd:keyword',
+                  '//gmd:MD_DigitalTransferOptions/gmd:onLine'):
+        for element in tree.xpath(xpath, namespaces=namespaces):
+            for i in xrange(copies - 1):
+                element.addnext(copy.deepcopy(element))
+    return etree.tostring(tree)
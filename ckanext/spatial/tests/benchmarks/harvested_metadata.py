@@ -0,0 +1,46 @@
+'''
+Prints the time taken to read the values of the ISO test fixtures with and
+without precompiled XPath expressions, and of a large record with and
+without the single pass reader.
+'''
+from ckanext.spatial.model import ISODocument
+from ckanext.spatial.tests.benchmarks import timed
+from ckanext.spatial.tests.benchmarks.fixtures import (
+    read_values_with_uncompiled_xpaths, get_iso_fixtures, get_large_iso_record)
+
+ITERATIONS = 20
+
+
+def read_all(read_values, xml_strings, iterations):
+    for i in xrange(iterations):
+        for xml_string in xml_strings:
+            read_values(xml_string)
+
+def time_per_document(read_values, xml_strings, iterations=ITERATIONS):
+    seconds, result = timed(read_all, read_values, xml_strings, iterations)
+    return seconds / (iterations * len(xml_strings))
+
+
+def main():
+    xml_strings = get_iso_fixtures()
+    uncompiled = time_per_document(read_values_with_uncompiled_xpaths, xml_strings)
+    compiled = time_per_document(
+        lambda xml_string: ISODocument(xml_string).read_values(), xml_strings)
+
+    print 'ISODocument.read_values() per document'
+    print '  evaluating XPath strings: %.2f ms' % (uncompiled * 1000)
+    print '  using compiled XPaths: %.2f ms' % (compiled * 1000)
+
+    large_record = [get_large_iso_record()]
+    timings = [time_per_document(
+                   lambda xml_string: ISODocument(xml_string).read_values(
+                       single_pass=single_pass), large_record)
+               for single_pass in (False, True)]
+
+    print 'ISODocument.read_values() for a record with hundreds of ' \
+          'keywords and online resources'
+    print '  one XPath per search path: %.2f ms' % (timings[0] * 1000)
+    print '  single pass: %.2f ms' % (timings[1] * 1000)
+
+if __name__ == '__main__':
+    main()
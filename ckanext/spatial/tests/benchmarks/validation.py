@@ -0,0 +1,52 @@
+'''
+Compares the number of documents per second validated against the ISO19139
+XSD when compiling the schema for every document and when reusing the
+cached one.
+'''
+import os
+
+from lxml import etree
+
+from ckanext.spatial import validation
+from ckanext.spatial.tests.benchmarks import timed
+
+XML_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'xml')
+
+
+def get_corpus():
+    corpus = []
+    for dir_path, dir_names, file_names in os.walk(XML_DIR):
+        for file_name in sorted(file_names):
+            if not file_name.endswith('.xml'):
+                continue
+            try:
+                xml = etree.parse(os.path.join(dir_path, file_name))
+            except etree.XMLSyntaxError:
+                continue
+            if xml.getroot().tag == '{http://www.isotc211.org/2005/gmd}MD_Metadata':
+                corpus.append(xml)
+    return corpus
+
+def validate(corpus, clear_schemas):
+    for xml in corpus:
+        if clear_schemas:
+            validation.XsdValidator.clear_schemas()
+        validation.ISO19139Schema.is_valid(xml)
+
+def docs_per_second(corpus, clear_schemas):
+    seconds, result = timed(validate, corpus, clear_schemas)
+    return len(corpus) / seconds
+
+
+def main():
+    corpus = get_corpus()
+    uncached = docs_per_second(corpus, clear_schemas=True)
+    validation.ISO19139Schema.prepare()
+    cached = docs_per_second(corpus, clear_schemas=False)
+
+    print 'ISO19139 XSD validation of %i documents' % len(corpus)
+    print '  compiling the schema every time: %.2f docs/s' % uncached
+    print '  using the cached schema: %.2f docs/s' % cached
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+'''
+Prints the time taken to scrape a WAF index page with 50,000 links with the
+pyparsing grammars and with the regular expressions used instead.
+'''
+from ckanext.spatial.harvesters.waf import fast_scrapers
+from ckanext.spatial.tests.benchmarks import timed
+from ckanext.spatial.tests.benchmarks.fixtures import (waf_index, iis_waf_index,
+                                                       pyparsing_records)
+
+LINKS = 50000
+
+
+def main(links=LINKS):
+    names = ['doc%i.xml' % i for i in xrange(links)]
+    pages = {'apache': waf_index(names), 'iis': iis_waf_index(names)}
+    print 'Scraping a WAF index page with %i links' % links
+    for scraper, content in sorted(pages.items()):
+        pyparsing_time, expected = timed(pyparsing_records, content, scraper)
+        fast_time, records = timed(fast_scrapers[scraper], content)
+        assert records == expected
+        print '  %s, pyparsing: %.2f s' % (scraper, pyparsing_time)
+        print '  %s, regular expressions: %.2f s' % (scraper, fast_time)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.spatial.lib.bbox_cache import BboxCache
+
+
+class _Query(object):
+    '''Returns a list of ids, counting the times it is called'''
+    calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return ['id-1', 'id-2']
+
+class TestBboxCache:
+
+    def test_disabled(self):
+        query = _Query()
+        cache = BboxCache(max_size=0)
+        cache.get('a', 1, query)
+        cache.get('a', 1, query)
+        assert_equal(query.calls, 2)
+
+    def test_memory(self):
+        query = _Query()
+        cache = BboxCache(max_size=2)
+        assert_equal(cache.get('a', 1, query), ['id-1', 'id-2'])
+        assert_equal(cache.get('a', 1, query), ['id-1', 'id-2'])
+        assert_equal(query.calls, 1)
+        assert_equal((cache.hits, cache.misses), (1, 1))
+        assert_equal(cache.hit_ratio, 0.5)
+
+        # A new version of the extents
+        cache.get('a', 2, query)
+        assert_equal(query.calls, 2)
+
+    def test_max_size(self):
+        query = _Query()
+        cache = BboxCache(max_size=2)
+        for key in ('a', 'b', 'a', 'c', 'a'):
+            cache.get(key, 1, query)
+        # b was the least recently used when c was added
+        cache.get('b', 1, query)
+        assert_equal(query.calls, 4)
+
+    def test_disk(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            query = _Query()
+            BboxCache(max_size=10, cache_dir=cache_dir).get('a', 1, query)
+
+            # Another process
+            cache = BboxCache(max_size=10, cache_dir=cache_dir)
+            assert_equal(cache.get('a', 1, query), ['id-1', 'id-2'])
+            assert_equal(query.calls, 1)
+            assert_equal(cache.disk_hits, 1)
+
+            cache = BboxCache(max_size=10, cache_dir=cache_dir)
+            cache.get('a', 2, query)
+            assert_equal(query.calls, 2)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_snap(self):
+        cache = BboxCache(grid=0.5)
+        assert_equal(cache.snap({'minx': -1.3, 'miny': 0.1, 'maxx': 2.2, 'maxy': 2.5}),
+                     {'minx': -1.5, 'miny': 0.0, 'maxx': 2.5, 'maxy': 2.5})
+
+        bbox = {'minx': -1.3, 'miny': 0.1, 'maxx': 2.2, 'maxy': 2.5}
+        assert_equal(BboxCache().snap(bbox), bbox)
@@ -0,0 +1,255 @@
+try: from cStringIO import StringIO
+except ImportError: from StringIO import StringIO
+
+import time
+import shutil
+import tempfile
+
+from lxml import etree
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.spatial.lib.csw_client import (CswError, CswService,
+                                            CapabilitiesCache, capabilities_cache,
+                                            _getrecords_request,
+                                            _iterparse_records,
+                                            _parse_getrecordbyid_response,
+                                            _get_operation_url, _RateLimiter)
+
+GETRECORDS_RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<csw:GetRecordsResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2"
+        xmlns:gmd="http://www.isotc211.org/2005/gmd"
+        xmlns:gco="http://www.isotc211.org/2005/gco">
+  <csw:SearchStatus timestamp="2013-01-01T00:00:00"/>
+  <csw:SearchResults numberOfRecordsMatched="3" numberOfRecordsReturned="2"
+          nextRecord="3" elementSet="full">
+    <gmd:MD_Metadata>
+      <gmd:fileIdentifier>
+        <gco:CharacterString>record-1</gco:CharacterString>
+      </gmd:fileIdentifier>
+    </gmd:MD_Metadata>
+    <gmd:MD_Metadata>
+      <gmd:fileIdentifier>
+        <gco:CharacterString> record-2 </gco:CharacterString>
+      </gmd:fileIdentifier>
+      <gmd:language>
+        <gco:CharacterString>eng</gco:CharacterString>
+      </gmd:language>
+    </gmd:MD_Metadata>
+  </csw:SearchResults>
+</csw:GetRecordsResponse>'''
+
+EXCEPTION_RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<ows:ExceptionReport xmlns:ows="http://www.opengis.net/ows" version="1.0.0">
+  <ows:Exception exceptionCode="InvalidParameterValue">
+    <ows:ExceptionText>Unknown output schema</ows:ExceptionText>
+  </ows:Exception>
+</ows:ExceptionReport>'''
+
+GETRECORDBYID_RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<csw:GetRecordByIdResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2"
+        xmlns:gmd="http://www.isotc211.org/2005/gmd"
+        xmlns:gco="http://www.isotc211.org/2005/gco">
+  <gmd:MD_Metadata>
+    <gmd:fileIdentifier>
+      <gco:CharacterString>record-1</gco:CharacterString>
+    </gmd:fileIdentifier>
+  </gmd:MD_Metadata>
+</csw:GetRecordByIdResponse>'''
+
+def test_iterparse_records():
+    search_results = {}
+    records = list(_iterparse_records(StringIO(GETRECORDS_RESPONSE),
+                                      search_results))
+
+    assert_equal([identifier for identifier, xml in records],
+                 ['record-1', 'record-2'])
+    assert_equal(search_results['nextRecord'], '3')
+    assert_equal(search_results['numberOfRecordsMatched'], '3')
+
+    # Records are complete documents, with their namespaces declared
+    tree = etree.fromstring(records[1][1].encode('utf-8'))
+    assert_equal(tree.tag, '{http://www.isotc211.org/2005/gmd}MD_Metadata')
+    assert_equal(tree.findtext('{http://www.isotc211.org/2005/gmd}language/'
+                               '{http://www.isotc211.org/2005/gco}CharacterString'),
+                 'eng')
+
+def test_iterparse_records_exception():
+    records = _iterparse_records(StringIO(EXCEPTION_RESPONSE), {})
+    assert_raises(CswError, list, records)
+
+def test_getrecords_request():
+    request = etree.fromstring(_getrecords_request(
+        'dataset', 'csw:Record', 'full', 101, 100,
+        'http://www.isotc211.org/2005/gmd'))
+
+    assert_equal(request.get('startPosition'), '101')
+    assert_equal(request.get('maxRecords'), '100')
+    assert_equal(request.get('outputSchema'), 'http://www.isotc211.org/2005/gmd')
+    namespaces = {'csw': 'http://www.opengis.net/cat/csw/2.0.2',
+                  'ogc': 'http://www.opengis.net/ogc'}
+    assert_equal(request.xpath('csw:Query/csw:ElementSetName/text()',
+                               namespaces=namespaces), ['full'])
+    assert_equal(request.xpath('//ogc:Literal/text()', namespaces=namespaces),
+                 ['dataset'])
+
+def test_parse_getrecordbyid_response():
+    record = _parse_getrecordbyid_response(GETRECORDBYID_RESPONSE)
+    assert record['xml'].startswith('<?xml version="1.0" encoding="UTF-8"?>\n<gmd:MD_Metadata')
+    tree = etree.fromstring(record['xml'].encode('utf-8'))
+    assert_equal(tree.findtext('{http://www.isotc211.org/2005/gmd}fileIdentifier/'
+                               '{http://www.isotc211.org/2005/gco}CharacterString'),
+                 'record-1')
+
+    empty = '<csw:GetRecordByIdResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2"/>'
+    assert_equal(_parse_getrecordbyid_response(empty), None)
+
+    assert_raises(CswError, _parse_getrecordbyid_response, EXCEPTION_RESPONSE)
+
+class _Operation(object):
+    def __init__(self, name, methods):
+        self.name = name
+        self.methods = methods
+
+class _Service(object):
+    def __init__(self, operations):
+        self.operations = operations
+
+def test_get_operation_url():
+    service = _Service([
+        _Operation('GetCapabilities', [{'type': 'Get', 'url': 'http://a/caps'}]),
+        _Operation('GetRecordById', [{'type': 'Post', 'url': 'http://a/post'},
+                                     {'type': 'Get', 'url': 'http://a/get'}]),
+    ])
+    assert_equal(_get_operation_url(service, 'GetRecordById', 'http://a/'),
+                 'http://a/get')
+    assert_equal(_get_operation_url(service, 'GetRecords', 'http://a/'),
+                 'http://a/')
+
+    # Methods keyed by type
+    service = _Service([_Operation('GetRecordById', {
+        '{http://www.opengis.net/ows}Get': {'url': 'http://a/get'}})])
+    assert_equal(_get_operation_url(service, 'GetRecordById', 'http://a/'),
+                 'http://a/get')
+
+def test_rate_limiter():
+    limiter = _RateLimiter(50)
+    t0 = time.time()
+    for i in xrange(6):
+        limiter.wait('host-a')
+    # Other hosts are not limited
+    limiter.wait('host-b')
+    assert time.time() - t0 >= 0.1
+
+CAPABILITIES_RESPONSE = '''<?xml version="1.0" encoding="UTF-8"?>
+<csw:Capabilities xmlns:csw="http://www.opengis.net/cat/csw/2.0.2"
+        xmlns:ows="http://www.opengis.net/ows"
+        xmlns:xlink="http://www.w3.org/1999/xlink" version="2.0.2">
+  <ows:ServiceIdentification>
+    <ows:Title>Test CSW</ows:Title>
+    <ows:ServiceType>CSW</ows:ServiceType>
+    <ows:ServiceTypeVersion>2.0.2</ows:ServiceTypeVersion>
+  </ows:ServiceIdentification>
+  <ows:ServiceProvider>
+    <ows:ProviderName>Test provider</ows:ProviderName>
+  </ows:ServiceProvider>
+  <ows:OperationsMetadata>
+    <ows:Operation name="GetRecordById">
+      <ows:DCP>
+        <ows:HTTP>
+          <ows:Get xlink:href="http://a/get"/>
+        </ows:HTTP>
+      </ows:DCP>
+    </ows:Operation>
+  </ows:OperationsMetadata>
+  <ogc:Filter_Capabilities xmlns:ogc="http://www.opengis.net/ogc">
+    <ogc:Spatial_Capabilities/>
+    <ogc:Scalar_Capabilities/>
+  </ogc:Filter_Capabilities>
+</csw:Capabilities>'''
+
+class _Requests(object):
+    '''Returns a capabilities document for each endpoint, counting the requests'''
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, endpoint):
+        self.count += 1
+        return '<Capabilities title="%s"/>' % endpoint
+
+class TestCapabilitiesCache:
+
+    def setup(self):
+        self.request = _Requests()
+
+    def test_memory(self):
+        cache = CapabilitiesCache(ttl=300)
+        capabilities = cache.get('CSW', 'http://a', self.request)
+        assert_equal(cache.get('CSW', 'http://a', self.request), capabilities)
+        cache.get('CSW', 'http://b', self.request)
+
+        assert_equal(self.request.count, 2)
+        assert_equal((cache.hits, cache.misses), (1, 2))
+
+    def test_ttl(self):
+        cache = CapabilitiesCache(ttl=0.05)
+        cache.get('CSW', 'http://a', self.request)
+        time.sleep(0.1)
+        cache.get('CSW', 'http://a', self.request)
+        assert_equal(self.request.count, 2)
+
+        cache = CapabilitiesCache(ttl=0)
+        cache.get('CSW', 'http://a', self.request)
+        cache.get('CSW', 'http://a', self.request)
+        assert_equal(self.request.count, 4)
+
+    def test_max_size(self):
+        cache = CapabilitiesCache(ttl=300, max_size=2)
+        for url in ('http://a', 'http://b', 'http://a', 'http://c', 'http://a'):
+            cache.get('CSW', url, self.request)
+        # b was the least recently used when c was added
+        cache.get('CSW', 'http://b', self.request)
+        assert_equal(self.request.count, 4)
+
+    def test_disk(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            CapabilitiesCache(ttl=300, cache_dir=cache_dir).get(
+                'CSW', 'http://a', self.request)
+
+            # Another process
+            cache = CapabilitiesCache(ttl=300, cache_dir=cache_dir)
+            capabilities = cache.get('CSW', 'http://a', self.request)
+
+            assert_equal(self.request.count, 1)
+            assert_equal(cache.disk_hits, 1)
+            assert_equal(capabilities, '<Capabilities title="http://a"/>')
+        finally:
+            shutil.rmtree(cache_dir)
+
+class TestCswServiceCapabilities:
+
+    def setup(self):
+        self.requests = 0
+        self.original_request = CswService._request_capabilities
+        CswService._request_capabilities = self._request_capabilities
+        capabilities_cache.clear()
+
+    def teardown(self):
+        CswService._request_capabilities = self.original_request
+        capabilities_cache.clear()
+
+    def _request_capabilities(self, endpoint):
+        self.requests += 1
+        return CAPABILITIES_RESPONSE
+
+    def test_services_not_shared(self):
+        csw = CswService('http://a/csw')
+        other_csw = CswService('http://a/csw')
+
+        assert_equal(self.requests, 1)
+        # Each service has its own OWSLib object, with the capabilities parsed
+        assert csw._ows() is not other_csw._ows()
+        assert_equal(csw._ows().identification.title, 'Test CSW')
+        assert_equal(_get_operation_url(csw._ows(), 'GetRecordById', 'http://a/csw'),
+                     'http://a/get')
@@ -0,0 +1,40 @@
+from nose.tools import assert_equal
+
+from ckanext.spatial.lib.grid import (get_cell_size, get_grid_level, get_cell,
+                                      get_cell_bounds, get_cell_id)
+
+
+def test_cell_size():
+    assert_equal(get_cell_size('lonlat', 0), (180.0, 180.0))
+    assert_equal(get_cell_size('lonlat', 3), (22.5, 22.5))
+    assert_equal(get_cell_size('geohash', 1), (45.0, 45.0))
+    assert_equal(get_cell_size('geohash', 2), (11.25, 5.625))
+
+def test_grid_level():
+    assert_equal(get_grid_level('lonlat', 0), 2)
+    assert_equal(get_grid_level('lonlat', 5), 7)
+    assert_equal(get_grid_level('geohash', 0), 1)
+    assert_equal(get_grid_level('geohash', 3), 3)
+
+    # Limited by the maximum zoom level
+    assert_equal(get_grid_level('lonlat', 20), get_grid_level('lonlat', 10))
+
+def test_cell():
+    assert_equal(get_cell('lonlat', 2, 100, 0), (6, 2))
+    assert_equal(get_cell('lonlat', 2, -180, -90), (0, 0))
+    # The cells on the east and north edges include them
+    assert_equal(get_cell('lonlat', 2, 180, 90), (7, 3))
+
+    assert_equal(get_cell_bounds('lonlat', 2, 6, 2), (90.0, 0.0, 135.0, 45.0))
+
+def test_geohash():
+    # Example from the geohash article on Wikipedia
+    lon, lat = -5.6, 42.6
+    assert_equal(get_cell_id('geohash', 5, *get_cell('geohash', 5, lon, lat)), 'ezs42')
+    assert_equal(get_cell_id('geohash', 1, *get_cell('geohash', 1, lon, lat)), 'e')
+
+    minx, miny, maxx, maxy = get_cell_bounds('geohash', 5, *get_cell('geohash', 5, lon, lat))
+    assert minx <= lon <= maxx and miny <= lat <= maxy
+
+def test_cell_id():
+    assert_equal(get_cell_id('lonlat', 2, 6, 2), '2/6/2')
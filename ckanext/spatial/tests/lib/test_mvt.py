@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_almost_equal
+from shapely.geometry import Point, Polygon, LineString, GeometryCollection, box
+
+from ckanext.spatial.lib import mvt
+from ckanext.spatial.lib.tiles import TileCache, get_tile_bounds, get_tile_range
+
+
+def _identity(coords):
+    return (int(coords[0]), int(coords[1]))
+
+class TestEncodeGeometry:
+
+    # The examples are from the vector tile specification
+
+    def test_point(self):
+        assert_equal(mvt.encode_geometry(Point(25, 17), _identity),
+                     (mvt.POINT, [9, 50, 34]))
+
+    def test_line(self):
+        assert_equal(mvt.encode_geometry(LineString([(2, 2), (2, 10), (10, 10)]), _identity),
+                     (mvt.LINESTRING, [9, 4, 4, 18, 0, 16, 16, 0]))
+
+    def test_polygon(self):
+        commands = [9, 6, 12, 18, 10, 12, 24, 44, 15]
+        polygon = Polygon([(3, 6), (8, 12), (20, 34)])
+        assert_equal(mvt.encode_geometry(polygon, _identity), (mvt.POLYGON, commands))
+
+        # Exterior rings are always encoded clockwise, so this one is reversed
+        reversed_polygon = Polygon([(3, 6), (20, 34), (8, 12)])
+        assert_equal(mvt.encode_geometry(reversed_polygon, _identity),
+                     (mvt.POLYGON, [9, 16, 24, 18, 24, 44, 33, 55, 15]))
+
+    def test_collapsed(self):
+        # Smaller than a pixel
+        assert_equal(mvt.encode_geometry(box(0.1, 0.1, 0.2, 0.2), _identity), None)
+
+    def test_collection(self):
+        collection = GeometryCollection([Point(1, 1), Polygon([(3, 6), (8, 12), (20, 34)])])
+        assert_equal(mvt.encode_geometry(collection, _identity)[0], mvt.POLYGON)
+
+
+def test_encode_tile():
+    features = [(mvt.POINT, [9, 50, 34], {'id': 'a', 'name': 'dataset'})]
+    layer = mvt.encode_layer('extents', features)
+    tile = mvt.encode_tile([layer])
+
+    assert_equal(tile[:2], '\x1a' + chr(len(layer)))
+    # version, name, feature, keys, values and extent
+    assert_equal(layer, '\x78\x02' + '\x0a\x07extents' +
+                 '\x12\x0f\x08\x01\x12\x04\x00\x00\x01\x01\x18\x01\x22\x03\x09\x32\x22' +
+                 '\x1a\x02id' + '\x1a\x04name' +
+                 '\x22\x03\x0a\x01a' + '\x22\x09\x0a\x07dataset' +
+                 '\x28\x80\x20')
+
+
+def test_tile_bounds():
+    minx, miny, maxx, maxy = get_tile_bounds(1, 1, 0)
+    assert_almost_equal(minx, 0)
+    assert_almost_equal(miny, 0)
+    assert_almost_equal(maxx, 20037508.342789244)
+    assert_almost_equal(maxy, 20037508.342789244)
+
+def test_tile_range():
+    assert_equal(get_tile_range(0, (-180, -90, 180, 90)), (0, 0, 0, 0))
+    assert_equal(get_tile_range(2, (-180, -90, 180, 90)), (0, 0, 3, 3))
+    assert_equal(get_tile_range(2, (10, 10, 20, 20)), (2, 1, 2, 1))
+
+
+class TestTileCache:
+
+    def setup(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = TileCache(self.cache_dir)
+        for z, x, y in ((0, 0, 0), (2, 2, 1), (2, 0, 3), (3, 4, 3), (3, 7, 7)):
+            x_dir = os.path.join(self.cache_dir, str(z), str(x))
+            if not os.path.exists(x_dir):
+                os.makedirs(x_dir)
+            open(os.path.join(x_dir, '%i.mvt' % y), 'wb').close()
+
+    def teardown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _tiles(self):
+        tiles = []
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                z, x = dirpath[len(self.cache_dir) + 1:].split(os.sep)
+                tiles.append((int(z), int(x), int(filename[:-4])))
+        return sorted(tiles)
+
+    def test_invalidate(self):
+        self.cache.invalidate((10, 10, 20, 20))
+        # The neighbours of the tiles are removed too
+        assert_equal(self._tiles(), [(2, 0, 3), (3, 7, 7)])
+
+    def test_invalidate_all(self):
+        self.cache.invalidate()
+        assert_equal(self._tiles(), [])
@@ -0,0 +1,60 @@
+import datetime
+try: from cStringIO import StringIO
+except ImportError: from StringIO import StringIO
+
+from nose.tools import assert_equal
+
+from ckanext.spatial.lib.report import ReportTable, StreamingReportTable
+
+class TestReportTable:
+    column_names = ['Name', 'Date', 'Count']
+
+    def _row_dicts(self, n):
+        for i in xrange(n):
+            yield {'Name': u'dataset <%i>' % i,
+                   'Date': datetime.datetime(2013, 1, 1, 12, 30),
+                   'Count': i}
+
+    def _report(self, n):
+        report = ReportTable(self.column_names)
+        for row_dict in self._row_dicts(n):
+            report.add_row_dict(row_dict)
+        return report
+
+    def test_csv(self):
+        csv = self._report(2).get_csv()
+        assert_equal(csv.splitlines(), [
+            '"Name","Date","Count"',
+            '"dataset <0>","2013-01-01 12:30","0"',
+            '"dataset <1>","2013-01-01 12:30","1"'])
+
+    def test_csv_from_row_dicts(self):
+        report = ReportTable(self.column_names, self._row_dicts(2))
+        assert_equal(report.get_csv(), self._report(2).get_csv())
+
+    def test_iter_csv(self):
+        expected = self._report(5).get_csv()
+        for chunk_size, num_chunks in ((1, 5), (2, 3), (5, 1), (10, 1)):
+            chunks = list(self._report(5).iter_csv(chunk_size=chunk_size))
+            assert_equal(len(chunks), num_chunks)
+            assert_equal(''.join(chunks), expected)
+
+        chunks = list(self._report(0).iter_csv())
+        assert_equal(chunks, ['"Name","Date","Count"\r\n'])
+
+    def test_iter_html(self):
+        report = ReportTable(self.column_names)
+        report.add_row_dict({'Name': u'dataset <0>'})
+        report.add_row_dict({'Name': u'dataset 1', 'Count': 1})
+        chunks = list(report.iter_html(blank_cell_html='&nbsp;', chunk_size=1))
+        assert_equal(chunks, [
+            '<tr><th>Name</th><th>Date</th><th>Count</th></tr>\n'
+            '<tr><td>dataset &lt;0&gt;</td><td>&nbsp;</td><td>&nbsp;</td></tr>\n',
+            '<tr><td>dataset 1</td><td>&nbsp;</td><td>1</td></tr>\n'])
+
+    def test_streaming(self):
+        f = StringIO()
+        report = StreamingReportTable(self.column_names, f)
+        report.add_row_dicts(self._row_dicts(3))
+        assert_equal(report.row_count, 3)
+        assert_equal(f.getvalue(), self._report(3).get_csv())
@@ -0,0 +1,96 @@
+import os
+
+from nose.tools import assert_equal
+
+from ckanext.spatial.lib import reports
+from ckanext.spatial.lib.reports import (_chunks, _init_validation_worker,
+                                         _validate_content,
+                                         _validation_report_rows)
+
+def _get_content(file_name):
+    file_path = os.path.join(os.path.dirname(__file__), '..', 'xml',
+                             'iso19139', file_name)
+    with open(file_path, 'rb') as f:
+        return f.read().decode('utf-8')
+
+class _Object(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class _Package(_Object):
+    def get_groups(self):
+        return []
+
+class _Query(object):
+    '''Iterates over the given harvest objects, like a SQLAlchemy query'''
+    def __init__(self, harvest_objects):
+        self.harvest_objects = harvest_objects
+
+    def execution_options(self, **kwargs):
+        return self
+
+    def yield_per(self, count):
+        return self
+
+    def __iter__(self):
+        return iter(self.harvest_objects)
+
+def _harvest_object(i, content):
+    return _Object(id='object-%i' % i, guid='guid-%i' % i, fetch_finished=None,
+                   content=content, errors=[],
+                   package=_Package(name='dataset-%i' % i),
+                   source=_Object(url='http://example.com/csw'))
+
+
+def test_chunks():
+    assert_equal(list(_chunks(xrange(5), 2)), [[0, 1], [2, 3], [4]])
+    assert_equal(list(_chunks(xrange(4), 2)), [[0, 1], [2, 3]])
+    assert_equal(list(_chunks([], 2)), [])
+
+class TestValidateContent:
+
+    def setup(self):
+        _init_validation_worker(['iso19139'])
+
+    def teardown(self):
+        reports._worker_validators = None
+
+    def test_valid(self):
+        assert_equal(_validate_content(_get_content('dataset.xml')), (True, []))
+
+    def test_invalid(self):
+        valid, errors = _validate_content(_get_content('dataset-invalid.xml'))
+        assert not valid
+        assert len(errors) > 0
+        assert all(isinstance(error, basestring) for error in errors)
+
+    def test_not_xml(self):
+        valid, errors = _validate_content(u'Not XML')
+        assert not valid
+        assert errors[0].startswith('Could not parse XML')
+
+        valid, errors = _validate_content(None)
+        assert not valid
+
+class TestValidationReportRows:
+
+    def _harvest_objects(self):
+        contents = [_get_content('dataset.xml'), _get_content('dataset-invalid.xml'),
+                    None, _get_content('dataset.xml'), _get_content('dataset-invalid.xml')]
+        return [_harvest_object(i, content) for i, content in enumerate(contents)]
+
+    def teardown(self):
+        reports._worker_validators = None
+
+    def test_processes(self):
+        serial = list(_validation_report_rows(
+            _Query(self._harvest_objects()), ['iso19139'], processes=1, chunk_size=2))
+        parallel = list(_validation_report_rows(
+            _Query(self._harvest_objects()), ['iso19139'], processes=2, chunk_size=2))
+
+        assert_equal(parallel, serial)
+        # The rows are in the same order as the objects
+        assert_equal([row_dict['GEMINI2 id'] for row_dict in parallel],
+                     ['guid-%i' % i for i in xrange(5)])
+        assert_equal([bool(row_dict['New validation errors']) for row_dict in parallel],
+                     [False, True, True, False, True])
@@ -5,11 +5,16 @@ from nose.tools import assert_equal
 
 from ckan import model
 from ckan import plugins
+from ckan.lib.base import config
 from ckan.lib.helpers import json
 from ckan.logic.schema import default_create_package_schema
 from ckan.logic.action.create import package_create
 from ckan.lib.munge import munge_title_to_name
-from ckanext.spatial.lib import validate_bbox, bbox_query, bbox_query_ordered
+from ckanext.spatial.lib import (validate_bbox, bbox_query, bbox_query_ordered,
+                                 iter_bbox_query, save_package_extent,
+                                 rebuild_package_extents)
+from ckanext.spatial.lib.grid import rebuild_grid_counts
+from ckanext.spatial.model import get_extents_version
 from ckanext.spatial.tests.base import SpatialTestBase
 
 class TestValidateBbox:
@@ -82,6 +87,32 @@ class TestBboxQuery(SpatialQueryTestBase):
         assert_equal(set(package_titles),
                      set(('(0, 3)', '(0, 4)', '(4, 5)')))
 
+    def test_query_page(self):
+        bbox_dict = self.x_values_to_bbox((2, 5))
+        package_ids = sorted(res.package_id for res in bbox_query(bbox_dict))
+
+        assert_equal([res.package_id for res in bbox_query(bbox_dict, limit=2)],
+                     package_ids[:2])
+        assert_equal([res.package_id for res in bbox_query(bbox_dict, limit=2, offset=2)],
+                     package_ids[2:])
+
+    def test_iter_query(self):
+        bbox_dict = self.x_values_to_bbox((2, 5))
+        package_ids = sorted(res.package_id for res in bbox_query(bbox_dict))
+
+        # Read in chunks of one row
+        results = list(iter_bbox_query(bbox_dict, chunk_size=1))
+        assert_equal(results, [(package_id, None) for package_id in package_ids])
+
+        results = list(iter_bbox_query(bbox_dict, limit=1, offset=1, chunk_size=1))
+        assert_equal([package_id for package_id, geometry in results], package_ids[1:2])
+
+        results = list(iter_bbox_query(bbox_dict, after=package_ids[0], chunk_size=1))
+        assert_equal([package_id for package_id, geometry in results], package_ids[1:])
+
+        results = list(iter_bbox_query(bbox_dict, limit=1, geojson=True))
+        assert_equal(json.loads(results[0][1])['type'], 'Polygon')
+
 class TestBboxQueryOrdered(SpatialQueryTestBase):
     # x values for the fixtures
     fixtures_x = [(0, 9), (1, 8), (2, 7), (3, 6), (4, 5),
@@ -99,6 +130,132 @@ class TestBboxQueryOrdered(SpatialQueryTestBase):
         assert_equal(package_titles,
                      ['(2, 7)', '(1, 8)', '(3, 6)', '(0, 9)', '(4, 5)'])
 
+    def test_query_page(self):
+        bbox_dict = self.x_values_to_bbox((2, 7))
+        q = bbox_query_ordered(bbox_dict, limit=2, offset=1)
+        package_titles = [model.Package.get(res.package_id).title for res in q]
+        assert_equal(package_titles, ['(1, 8)', '(3, 6)'])
+        # the count includes all the results
+        assert_equal([res.total_count for res in q], [5, 5])
+
+        assert_equal(bbox_query_ordered(bbox_dict, limit=2, offset=10), [])
+
+
+class TestSavePackageExtent(SpatialTestBase):
+
+    def setup(self):
+        self.package_id = SpatialQueryTestBase.create_package(name='test-extent')
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def _get_extent(self):
+        return model.Session.execute(
+            'SELECT ST_AsText(the_geom) FROM package_extent WHERE package_id = :package_id',
+            {'package_id': self.package_id}).fetchone()
+
+    def test_save(self):
+        save_package_extent(self.package_id, json.loads(self.geojson_examples['point']))
+        assert_equal(self._get_extent(), ('POINT(100 0)',))
+
+        # Same geometry, with another GeoJSON formatting
+        save_package_extent(self.package_id, {'type': 'Point', 'coordinates': [100, 0.0]})
+        assert_equal(self._get_extent(), ('POINT(100 0)',))
+
+        save_package_extent(self.package_id, json.loads(self.geojson_examples['line']))
+        assert_equal(self._get_extent(), ('LINESTRING(100 0,101 1)',))
+
+        save_package_extent(self.package_id, None)
+        assert_equal(self._get_extent(), None)
+
+    def test_version_after_commit(self):
+        version = get_extents_version()
+        save_package_extent(self.package_id, json.loads(self.geojson_examples['point']))
+        # Other processes would still see the old extents
+        assert_equal(get_extents_version(), version)
+
+        model.Session.commit()
+        assert get_extents_version() > version
+
+    def test_save_with_tolerance(self):
+        save_package_extent(self.package_id, json.loads(self.geojson_examples['point']))
+
+        config['ckanext.spatial.extent_tolerance'] = '0.01'
+        try:
+            save_package_extent(self.package_id, {'type': 'Point', 'coordinates': [100.001, 0]})
+            assert_equal(self._get_extent(), ('POINT(100 0)',))
+
+            save_package_extent(self.package_id, {'type': 'Point', 'coordinates': [100.1, 0]})
+            assert_equal(self._get_extent(), ('POINT(100.1 0)',))
+        finally:
+            del config['ckanext.spatial.extent_tolerance']
+
+class TestGridCounts(SpatialTestBase):
+
+    def setup(self):
+        config['ckanext.spatial.grid.precomputed'] = 'lonlat'
+        self.package_id = SpatialQueryTestBase.create_package(name='test-grid')
+
+    def teardown(self):
+        del config['ckanext.spatial.grid.precomputed']
+        model.repo.rebuild_db()
+
+    def _get_count(self, x, y, level=2):
+        return model.Session.execute('''SELECT count FROM package_extent_grid
+                                        WHERE grid = 'lonlat' AND level = :level
+                                           AND x = :x AND y = :y''',
+                                     {'level': level, 'x': x, 'y': y}).scalar()
+
+    def test_update(self):
+        save_package_extent(self.package_id, json.loads(self.geojson_examples['point']))
+        assert_equal(self._get_count(6, 2), 1)
+
+        save_package_extent(self.package_id, json.loads(self.geojson_examples['point_2']))
+        assert_equal(self._get_count(6, 2), 0)
+        assert_equal(self._get_count(4, 2), 1)
+        model.Session.commit()
+
+        # The same counts as computing them again
+        rebuild_grid_counts()
+        assert_equal(self._get_count(6, 2), None)
+        assert_equal(self._get_count(4, 2), 1)
+
+        save_package_extent(self.package_id, None)
+        assert_equal(self._get_count(4, 2), 0)
+
+class TestRebuildPackageExtents(SpatialQueryTestBase):
+    # x values for the fixtures
+    fixtures_x = [(0, 1), (0, 3), (4, 5)]
+
+    def _get_extent_package_ids(self):
+        return set(row[0] for row in
+                   model.Session.execute('SELECT package_id FROM package_extent'))
+
+    def test_rebuild(self):
+        package_ids = self._get_extent_package_ids()
+        assert_equal(len(package_ids), 3)
+
+        # Add an extent to a dataset without 'spatial' extra and remove
+        # some of the others
+        other_id = self.create_package(name='no-extent')
+        save_package_extent(other_id,
+                            json.loads(bbox_2_geojson(self.x_values_to_bbox((2, 5)))))
+        model.Session.execute('''DELETE FROM package_extent WHERE package_id IN
+                                 (SELECT package_id FROM package_extent LIMIT 2)''')
+        model.Session.commit()
+
+        progress = []
+        count, read, errors = rebuild_package_extents(chunk_size=2,
+                                                      progress=progress.append)
+
+        assert_equal((count, read, errors), (3, 3, []))
+        assert_equal(progress, [2, 3])
+        assert_equal(self._get_extent_package_ids(), package_ids)
+
+        bbox_dict = self.x_values_to_bbox((2, 5))
+        package_titles = [model.Package.get(res.package_id).title
+                          for res in bbox_query(bbox_dict)]
+        assert_equal(set(package_titles), set(('(0, 3)', '(4, 5)')))
 
 class TestBboxQueryPerformance(SpatialQueryTestBase):
     # x values for the fixtures
@@ -0,0 +1,113 @@
+import random
+
+from nose.tools import assert_equal
+from shapely.geometry import box, Point, Polygon
+
+from ckanext.spatial.lib import spatial_index
+from ckanext.spatial.lib.spatial_index import STRTree, ExtentsIndex
+from ckanext.spatial.model import get_extents_version
+
+
+def _intersecting(items, bounds):
+    minx, miny, maxx, maxy = bounds
+    return sorted(value for (x1, y1, x2, y2), value in items
+                  if x1 <= maxx and x2 >= minx and y1 <= maxy and y2 >= miny)
+
+def test_str_tree():
+    random.seed(1)
+    items = []
+    for i in xrange(1000):
+        x, y = random.uniform(-180, 170), random.uniform(-90, 80)
+        items.append(((x, y, x + random.uniform(0, 10), y + random.uniform(0, 10)), i))
+    tree = STRTree(items, node_capacity=8)
+
+    assert_equal(tree.depth, 3)
+    for bounds in ((-10, -10, 10, 10), (-180, -90, 180, 90), (0, 0, 0, 0),
+                   (200, 0, 210, 10)):
+        assert_equal(sorted(tree.query(bounds)), _intersecting(items, bounds))
+
+def test_str_tree_empty():
+    assert_equal(STRTree([]).query((-180, -90, 180, 90)), [])
+
+class TestExtentsIndex:
+
+    def setup(self):
+        self.index = ExtentsIndex(max_pending=2)
+        self.index.load([
+            ('box', box(0, 0, 10, 10)),
+            ('point', Point(20, 20)),
+            # Its bounding box intersects (11, 11, 12, 12), but not the
+            # triangle itself
+            ('triangle', Polygon([(10, 20), (20, 10), (20, 20)])),
+        ])
+
+    def test_query(self):
+        assert_equal(sorted(self.index.query({'minx': 5, 'miny': 5, 'maxx': 30, 'maxy': 30})),
+                     ['box', 'point', 'triangle'])
+        assert_equal(self.index.query({'minx': 11, 'miny': 11, 'maxx': 12, 'maxy': 12}), [])
+        assert_equal(self.index.query({'minx': 1, 'miny': 1, 'maxx': 2, 'maxy': 2}), ['box'])
+
+    def test_update(self):
+        bbox = {'minx': 40, 'miny': 40, 'maxx': 50, 'maxy': 50}
+
+        self.index.update('point', {'type': 'Point', 'coordinates': [45, 45]})
+        assert_equal(self.index.query(bbox), ['point'])
+        assert_equal(self.index.query({'minx': 19, 'miny': 19, 'maxx': 21, 'maxy': 21}),
+                     ['triangle'])
+
+        # Packs the tree again
+        self.index.update('new', box(41, 41, 42, 42))
+        assert_equal(sorted(self.index.query(bbox)), ['new', 'point'])
+
+        self.index.update('point', None)
+        assert_equal(self.index.query(bbox), ['new'])
+        assert_equal(len(self.index), 3)
+
+class TestExtentsIndexReload:
+
+    def setup(self):
+        self.version = 1
+        self.extents = [('box', box(0, 0, 10, 10))]
+        spatial_index.get_extents_version = lambda: self.version
+
+    def teardown(self):
+        spatial_index.get_extents_version = get_extents_version
+
+    def test_new_version(self):
+        index = ExtentsIndex(check_interval=10)
+        index._get_extents = lambda: iter(self.extents)
+        bbox = {'minx': 0, 'miny': 0, 'maxx': 20, 'maxy': 20}
+        assert_equal(index.query(bbox), ['box'])
+
+        # Changed by another process
+        self.extents = [('point', Point(15, 15))]
+        self.version = 2
+        assert_equal(index.query(bbox), ['box'])
+
+        # Checked again after check_interval seconds
+        index.checked_at -= 11
+        assert_equal(index.query(bbox), ['point'])
+        assert_equal(index.version, 2)
+
+    def test_own_version(self):
+        index = ExtentsIndex(check_interval=10)
+        index._get_extents = lambda: iter(self.extents)
+        bbox = {'minx': 0, 'miny': 0, 'maxx': 20, 'maxy': 20}
+        assert_equal(index.query(bbox), ['box'])
+
+        # Changed by this process, which updates the index itself
+        self.extents = []
+        self.version = 2
+        index.update('point', Point(15, 15))
+        index.add_version(2)
+
+        index.checked_at -= 11
+        assert_equal(sorted(index.query(bbox)), ['box', 'point'])
+        assert_equal(index.version, 2)
+
+        # Also changed by another process
+        index.add_version(3)
+        self.version = 4
+        index.checked_at -= 11
+        assert_equal(index.query(bbox), [])
+        assert_equal(index.version, 4)
@@ -0,0 +1,46 @@
+from nose.tools import assert_equal
+
+from ckan.model import Session
+
+from ckanext.spatial.lib.transaction import on_commit
+
+
+class TestOnCommit:
+
+    def setup(self):
+        self.calls = []
+
+    def _callback(self, value):
+        self.calls.append(value)
+
+    def test_commit(self):
+        Session.execute('SELECT 1')
+        on_commit(self._callback, 'a')
+        assert_equal(self.calls, [])
+
+        Session.commit()
+        assert_equal(self.calls, ['a'])
+
+        # Only once
+        Session.execute('SELECT 1')
+        Session.commit()
+        assert_equal(self.calls, ['a'])
+
+    def test_rollback(self):
+        Session.execute('SELECT 1')
+        on_commit(self._callback, 'a')
+        Session.rollback()
+
+        Session.execute('SELECT 1')
+        Session.commit()
+        assert_equal(self.calls, [])
+
+    def test_remove(self):
+        Session.execute('SELECT 1')
+        on_commit(self._callback, 'a')
+        # Discarded without a rollback event, eg at the end of a request
+        Session.remove()
+
+        Session.execute('SELECT 1')
+        Session.commit()
+        assert_equal(self.calls, [])
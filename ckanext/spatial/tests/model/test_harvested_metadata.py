@@ -1,8 +1,13 @@
 import os
 
-from nose.tools import assert_equal
+from lxml import etree
+from nose.tools import assert_equal, assert_raises
 
-from ckanext.spatial.model import ISODocument
+from ckanext.spatial.model import ISODocument, MappedXmlParseError
+from ckanext.spatial.model.harvested_metadata import (MappedXmlElement,
+                                                      SinglePassXmlReader)
+from ckanext.spatial.tests.benchmarks.fixtures import (
+    read_values_with_uncompiled_xpaths, get_iso_fixtures, get_large_iso_record)
 
 def open_xml_fixture(xml_filename):
     xml_filepath = os.path.join(os.path.dirname(__file__),
@@ -32,3 +37,85 @@ def test_multiplicity_warning():
     iso_document = ISODocument(xml_string)
     iso_values = iso_document.read_values()
     assert_equal(iso_values['guid'], 'B8A22DF4-B0DC-4F0B-A713-0CF5F8784A28')
+
+def test_compiled_xpaths():
+    for xml_string in get_iso_fixtures():
+        assert_equal(ISODocument(xml_string).read_values(),
+                     read_values_with_uncompiled_xpaths(xml_string))
+
+def test_single_pass_reader():
+    for xml_string in get_iso_fixtures() + [get_large_iso_record()]:
+        assert_equal(ISODocument(xml_string).read_values(single_pass=True),
+                     ISODocument(xml_string).read_values())
+
+def test_single_pass_reader_fallback():
+    elements = [
+        MappedXmlElement(name='first', search_paths=['a/b[1]/text()']),
+        MappedXmlElement(name='all', search_paths=['c/text()', 'a//b/text()']),
+        MappedXmlElement(name='attribute', search_paths=['a/@id'],
+                         multiplicity='0..1'),
+    ]
+    reader = SinglePassXmlReader(elements)
+    # The search path with a predicate is not supported
+    assert_equal(sorted(reader.path_indexes.keys()), [1, 2])
+
+    tree = etree.fromstring('<r><a id="x"><b>1</b><d><b>2</b></d></a></r>')
+    assert_equal(reader.read_values(tree),
+                 {'first': ['1'], 'all': ['1', '2'], 'attribute': 'x'})
+
+def test_lazy_values():
+    for xml_string in get_iso_fixtures():
+        assert_equal(dict(ISODocument(xml_string).read_values(lazy=True)),
+                     ISODocument(xml_string).read_values())
+
+def test_lazy_values_single_pass():
+    xml_string = open_xml_fixture('gemini_dataset.xml')
+    assert_raises(ValueError, ISODocument(xml_string).read_values,
+                  single_pass=True, lazy=True)
+
+def test_lazy_values_read_on_access():
+    xml_string = open_xml_fixture('gemini_dataset.xml')
+    iso_values = ISODocument(xml_string).read_values(lazy=True)
+
+    assert_equal(iso_values['guid'], 'test-dataset-1')
+    assert_equal(iso_values._read.keys(), ['guid'])
+    assert_equal(iso_values._inferred, None)
+
+    # Inferred values are computed from the elements they need
+    assert_equal(iso_values['tags'], ISODocument(xml_string).read_values()['tags'])
+    assert 'title' not in iso_values._read
+    assert 'keyword-free-text' in iso_values._read
+
+def test_lazy_values_changes():
+    xml_string = open_xml_fixture('gemini_dataset.xml')
+    iso_values = ISODocument(xml_string).read_values(lazy=True)
+    tags = iso_values['tags']
+
+    iso_values['guid'] = 'changed'
+    iso_values['new-key'] = 'new'
+    del iso_values['tags']
+    del iso_values['title']
+
+    assert_equal(iso_values['guid'], 'changed')
+    assert_equal(iso_values.get('new-key'), 'new')
+    assert 'tags' not in iso_values
+    assert not iso_values.has_key('title')
+    assert_raises(KeyError, lambda: iso_values['title'])
+
+    iso_values['tags'] = tags
+    assert_equal(iso_values['tags'], tags)
+
+def test_lazy_values_parse_error():
+    class FailingElement(object):
+        name = 'failing'
+        def read_value(self, tree):
+            raise ValueError('Wrong value')
+
+    class Document(ISODocument):
+        elements = ISODocument.elements + [FailingElement()]
+
+    xml_string = open_xml_fixture('gemini_dataset.xml')
+    iso_values = Document(xml_string).read_values(lazy=True)
+
+    assert_equal(iso_values['guid'], 'test-dataset-1')
+    assert_raises(MappedXmlParseError, lambda: iso_values['failing'])
@@ -1,6 +1,8 @@
 import logging
 from pprint import pprint
 
+from nose.tools import assert_equal
+
 from geoalchemy import WKTSpatialElement
 
 from shapely.geometry import asShape
@@ -8,7 +10,10 @@ from ckan.model import Session, Package
 from ckan import model
 from ckan.lib.helpers import json
 from ckan.tests import CreateTestData
-from ckanext.spatial.model import PackageExtent
+from ckanext.spatial.model import (PackageExtent, SPATIAL_INDEX_NAME,
+                                   get_spatial_indexes, create_spatial_index,
+                                   get_spatial_index_usage,
+                                   explain_spatial_query)
 
 from ckanext.spatial.tests.base import SpatialTestBase
 
@@ -59,3 +64,32 @@ class TestPackageExtent(SpatialTestBase):
         assert package_extent.package_id == package.id
         assert Session.scalar(package_extent.the_geom.geometry_type) == 'ST_Polygon'
         assert Session.scalar(package_extent.the_geom.srid) == self.db_srid
+
+
+class TestSpatialIndex(SpatialTestBase):
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def test_create_spatial_index(self):
+        # The index is created along with the table
+        assert_equal(get_spatial_indexes(), [SPATIAL_INDEX_NAME])
+        assert_equal(create_spatial_index(), False)
+
+        Session.execute('DROP INDEX %s' % SPATIAL_INDEX_NAME)
+        Session.commit()
+        assert_equal(get_spatial_indexes(), [])
+
+        assert_equal(create_spatial_index(), True)
+        assert_equal(get_spatial_indexes(), [SPATIAL_INDEX_NAME])
+        assert SPATIAL_INDEX_NAME in [index['name'] for index in get_spatial_index_usage()]
+
+    def test_explain_spatial_query(self):
+        uses_index, plan = explain_spatial_query()
+        assert uses_index, plan
+
+        Session.execute('DROP INDEX %s' % SPATIAL_INDEX_NAME)
+        Session.commit()
+
+        uses_index, plan = explain_spatial_query()
+        assert not uses_index, plan
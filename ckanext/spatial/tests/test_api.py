@@ -1,5 +1,6 @@
 import logging
 import json
+from collections import namedtuple
 from pprint import pprint
 from nose.plugins.skip import SkipTest
 from nose.tools import assert_equal, assert_raises
@@ -14,6 +15,10 @@ from ckan.tests import CreateTestData, setup_test_search_index,WsgiAppCase
 from ckan.tests.functional.api.base import ApiTestCase
 from ckan.tests import TestController as ControllerTestCase
 from ckanext.spatial.tests.base import SpatialTestBase
+from pylons import config
+from ckanext.spatial import plugin as plugin_module
+from ckanext.spatial.plugin import SpatialQuery, POSTGIS_IDS_CHUNK_SIZE
+from ckanext.spatial.lib import bbox_query, bbox_query_ordered
 
 log = logging.getLogger(__name__)
 
@@ -76,6 +81,73 @@ class TestSpatialApi(ApiTestCase,SpatialTestBase,ControllerTestCase):
         assert res_dict['count'] == 0
         assert res_dict['results'] == []
 
+    def test_paged_query(self):
+        schema = default_create_package_schema()
+        context = {'model':model,'session':Session,'user':'tester','extras_as_string':True,'schema':schema,'api_version':2}
+        package_ids = []
+        for name in ('paged-1', 'paged-2', 'paged-3'):
+            package_create(context, {'name': name,
+                                     'extras': [{'key':'spatial','value':self.geojson_examples['point']}]})
+            package_ids.append(context.pop('id'))
+            del context['package']
+        package_ids.sort()
+
+        res_dict = self.data_from_res(self.app.get(self._offset_with_bbox() + '&limit=2', status=200))
+        assert_equal(res_dict['count'], 3)
+        assert_equal(res_dict['results'], package_ids[:2])
+
+        res_dict = self.data_from_res(self.app.get(self._offset_with_bbox() +
+                                                   '&limit=2&cursor=%s' % res_dict['cursor'],
+                                                   status=200))
+        assert_equal(res_dict['results'], package_ids[2:])
+        assert 'cursor' not in res_dict
+
+        res_dict = self.data_from_res(self.app.get(self._offset_with_bbox() +
+                                                   '&offset=1&format=geojson',
+                                                   status=200))
+        assert_equal(res_dict['type'], 'FeatureCollection')
+        assert_equal([feature['id'] for feature in res_dict['features']], package_ids[1:])
+        assert_equal(res_dict['features'][0]['geometry'],
+                     json.loads(self.geojson_examples['point']))
+
+        self.app.get(self._offset_with_bbox() + '&limit=a', status=400)
+
+        res = self.app.get(self._offset_with_bbox() + '&limit=2&callback=cb', status=200)
+        assert res.body.startswith('cb(') and res.body.endswith(');')
+        assert_equal(json.loads(res.body[3:-2])['results'], package_ids[:2])
+
+        for package_id in package_ids:
+            package_delete(context, {'id': package_id})
+
+    def test_grid_query(self):
+        schema = default_create_package_schema()
+        context = {'model':model,'session':Session,'user':'tester','extras_as_string':True,'schema':schema,'api_version':2}
+        package_ids = []
+        for name, example in (('grid-1', 'point'), ('grid-2', 'point'), ('grid-3', 'point_2')):
+            package_create(context, {'name': name,
+                                     'extras': [{'key':'spatial','value':self.geojson_examples[example]}]})
+            package_ids.append(context.pop('id'))
+            del context['package']
+
+        offset = self.offset('/spatial/grid') + '?bbox=0,-90,180,90&zoom=0'
+        res_dict = self.data_from_res(self.app.get(offset, status=200))
+        assert_equal(res_dict['grid'], 'lonlat')
+        assert_equal(res_dict['level'], 2)
+        assert_equal(res_dict['cells'], [
+            {'id': '2/4/2', 'bbox': [0, 0, 45, 45], 'count': 1},
+            {'id': '2/6/2', 'bbox': [90, 0, 135, 45], 'count': 2},
+        ])
+
+        res_dict = self.data_from_res(self.app.get(offset + '&grid=geohash&format=geojson',
+                                                   status=200))
+        assert_equal(res_dict['type'], 'FeatureCollection')
+        assert_equal([(feature['id'], feature['properties']['count'])
+                      for feature in res_dict['features']], [('s', 1), ('w', 2)])
+
+        self.app.get(offset + '&grid=hexagons', status=400)
+
+        for package_id in package_ids:
+            package_delete(context, {'id': package_id})
 
 
 class TestActionPackageSearch(SpatialTestBase,WsgiAppCase):
@@ -127,6 +199,87 @@ class TestActionPackageSearch(SpatialTestBase,WsgiAppCase):
         assert_equal(result['results'][0]['name'], 'test-spatial-dataset-search-point-2')
 
 
+class TestPostgisIdsFilter(object):
+
+    def setup(self):
+        self.plugin = SpatialQuery()
+        self.id_filter = self.plugin.postgis_id_filter
+
+    def teardown(self):
+        self.plugin.postgis_id_filter = self.id_filter
+
+    def test_boolean(self):
+        self.plugin.postgis_id_filter = 'boolean'
+        ids = ['id-%i' % i for i in range(POSTGIS_IDS_CHUNK_SIZE + 2)]
+        search_params = self.plugin._filter_by_ids(ids, {'q': 'test'})
+
+        fq = search_params['fq_list'][0]
+        assert_equal(fq.count('id:('), 2)
+        assert fq.endswith(' OR id:(id-%i OR id-%i)' % (len(ids) - 2, len(ids) - 1))
+        assert_equal(search_params['q'], 'test')
+
+    def test_terms(self):
+        self.plugin.postgis_id_filter = 'terms'
+        search_params = self.plugin._filter_by_ids(['a', 'b'], {'fq_list': ['x']})
+
+        assert_equal(search_params['fq_list'], ['x', '{!terms f=id}a,b'])
+
+
+class TestPostgisSorting(object):
+
+    def setup(self):
+        self.plugin = SpatialQuery()
+        self.use_postgis_sorting = config.get('ckanext.spatial.use_postgis_sorting')
+        config['ckanext.spatial.use_postgis_sorting'] = 'true'
+
+    def teardown(self):
+        plugin_module.bbox_query_ordered = bbox_query_ordered
+        plugin_module.bbox_query = bbox_query
+        if self.use_postgis_sorting is None:
+            del config['ckanext.spatial.use_postgis_sorting']
+        else:
+            config['ckanext.spatial.use_postgis_sorting'] = self.use_postgis_sorting
+
+    def _search_params(self):
+        return {'q': '', 'fq': '', 'rows': 2, 'start': 0, 'extras': {},
+                'sort': 'spatial desc'}
+
+    def test_facets_of_bbox(self):
+        Extent = namedtuple('Extent', ['package_id', 'spatial_ranking', 'total_count'])
+        plugin_module.bbox_query_ordered = lambda bbox, limit=None, offset=0: \
+            [Extent('a', 0.9, 4), Extent('b', 0.5, 4)]
+
+        class Query(object):
+            def with_entities(self, *args):
+                return self
+
+            def limit(self, limit):
+                return self
+
+            def __iter__(self):
+                return iter([('a',), ('b',), ('c',), ('d',)])
+        plugin_module.bbox_query = lambda bbox: Query()
+
+        bbox = {'minx': -180, 'miny': -90, 'maxx': 180, 'maxy': 90}
+        search_params = self.plugin._params_for_postgis_search(bbox, self._search_params())
+
+        # Only the page is retrieved by after_search
+        assert_equal(search_params['extras']['ext_spatial'], [('a', 0.9), ('b', 0.5)])
+        assert_equal(search_params['extras']['ext_spatial_count'], 4)
+        assert_equal(search_params['rows'], 0)
+        # But the facets are computed for all the datasets within the bbox
+        assert_equal(search_params['fq_list'], ['id:(a OR b OR c OR d)'])
+
+    def test_no_results(self):
+        plugin_module.bbox_query_ordered = lambda bbox, limit=None, offset=0: []
+
+        bbox = {'minx': -180, 'miny': -90, 'maxx': 180, 'maxy': 90}
+        search_params = self.plugin._params_for_postgis_search(bbox, self._search_params())
+
+        assert search_params['abort_search']
+        assert_equal(search_params['extras']['ext_spatial_count'], 0)
+
+
 class TestHarvestedMetadataAPI(WsgiAppCase):
 
 
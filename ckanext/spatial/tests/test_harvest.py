@@ -1,3 +1,4 @@
+import time
 from datetime import datetime, date
 import lxml
 from nose.plugins.skip import SkipTest
@@ -12,18 +13,23 @@ from ckan.logic import get_action
 from ckanext.harvest.model import (setup as harvest_model_setup,
                                    HarvestSource, HarvestJob, HarvestObject,
                                    HarvestCoupledResource)
+from ckanext.harvest.model import HarvestObjectExtra as HOExtra
 from ckanext.spatial.validation import Validators, SchematronValidator
 from ckanext.spatial.harvesters.gemini import (GeminiDocHarvester,
                                         GeminiWafHarvester,
                                         GeminiHarvester)
-from ckanext.spatial.harvesters.base import SpatialHarvester
+from ckanext.spatial.harvesters import base as harvester_base
+from ckanext.spatial.harvesters.base import SpatialHarvester, content_digest
+from ckanext.spatial.harvesters.csw import CSWHarvester
 from ckanext.spatial.model.package_extent import setup as spatial_db_setup
 from ckanext.spatial.tests.base import SpatialTestBase
 
-from xml_file_server import serve
+from xml_file_server import serve, ConditionalRequestHandler, CONDITIONAL_PORT
 
 # Start simple HTTP server that serves XML test files
 serve()
+# And another one that supports conditional requests
+serve(CONDITIONAL_PORT, ConditionalRequestHandler)
 
 class HarvestFixtureBase(SpatialTestBase):
 
@@ -534,6 +540,41 @@ class TestHarvest(HarvestFixtureBase):
         assert second_obj.current == False
         assert first_obj.current == False
 
+    def test_harvest_not_modified(self):
+
+        # Create source
+        source_fixture = {
+			'title': 'Test Source',
+			'name': 'test-source',
+            'url': u'http://127.0.0.1:%i/gemini2.1/dataset1.xml' % CONDITIONAL_PORT,
+            'source_type': u'gemini-single'
+        }
+
+        source, first_job = self._create_source_and_job(source_fixture)
+
+        first_obj = self._run_job_for_single_document(first_job)
+
+        assert first_obj.current == True
+        assert_in('last_modified', [extra.key for extra in first_obj.extras])
+
+        # Create and run a second job, the document has not been modified
+        # so no objects should be created
+        second_job = self._create_job(source.id)
+
+        harvester = GeminiDocHarvester()
+        object_ids = harvester.gather_stage(second_job)
+
+        assert_equal(object_ids, [])
+        assert_equal(len(second_job.gather_errors), 0)
+
+        # Create and run a third job, forcing the importing, the document
+        # should be requested again
+        third_job = self._create_job(source.id)
+        third_obj = self._run_job_for_single_document(third_job,force_import=True)
+
+        assert third_obj.current == True
+        assert_equal(third_obj.package_id, first_obj.package_id)
+
     def test_harvest_deleted_record(self):
 
         # Create source
@@ -864,6 +905,102 @@ class TestGatherMethods(HarvestFixtureBase):
         content = ''
         assert_raises(lxml.etree.XMLSyntaxError, self.harvester.get_gemini_string_and_guid, content)
 
+class _FailingCsw(object):
+    '''Returns a record on the first page of GetRecords and fails on the second one'''
+
+    def getfullrecords(self, page=10, outputschema='gmd'):
+        yield 'record-1', BASIC_GEMINI
+        raise Exception('Error on the second page')
+
+class TestCSWHarvesterBulk(HarvestFixtureBase):
+
+    def setup(self):
+        HarvestFixtureBase.setup(self)
+        source_fixture = {
+            'title': 'Test Source',
+            'name': 'test-source',
+            'url': u'http://127.0.0.1:8999/csw',
+            'source_type': u'gemini-csw'
+        }
+        source, self.job = self._create_source_and_job(source_fixture)
+        source.config = '{"bulk_records": true}'
+        source.save()
+
+    def test_error_on_page(self):
+        harvester = CSWHarvester()
+        harvester._setup_csw_client = lambda url: setattr(harvester, 'csw', _FailingCsw())
+
+        assert_equal(harvester.gather_stage(self.job), None)
+        assert_equal(len(self.job.gather_errors), 1)
+        # No objects are left behind without being queued
+        assert_equal(Session.query(HarvestObject)
+                     .filter(HarvestObject.harvest_job_id == self.job.id).count(), 0)
+
+    def test_validate_config(self):
+        harvester = CSWHarvester()
+        assert_equal(harvester.validate_config('{"page_size": 50}'), '{"page_size": 50}')
+        assert_raises(ValueError, harvester.validate_config, '{"page_size": true}')
+        assert_raises(ValueError, harvester.validate_config, '{"fetch_retries": false}')
+
+class _FakeFetcher(object):
+    closed = False
+
+    def __init__(self, url, **kwargs):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class TestCSWHarvesterFetch(HarvestFixtureBase):
+
+    def setup(self):
+        HarvestFixtureBase.setup(self)
+        source_fixture = {
+            'title': 'Test Source',
+            'name': 'test-source',
+            'url': u'http://127.0.0.1:8999/csw',
+            'source_type': u'gemini-csw'
+        }
+        source, self.job = self._create_source_and_job(source_fixture)
+        self.objects = []
+        for guid, status in (('a', 'new'), ('b', 'new'), ('c', 'change'), ('d', 'delete')):
+            obj = HarvestObject(guid=guid, job=self.job,
+                                extras=[HOExtra(key='status', value=status)])
+            obj.save()
+            self.objects.append(obj)
+
+    def test_claim_objects(self):
+        harvester = CSWHarvester()
+        claimed = harvester._claim_csw_objects(self.objects[0], 10)
+        assert_equal(sorted(obj.guid for obj in claimed), ['b', 'c'])
+        assert all(obj.fetch_started for obj in claimed)
+
+        # Other fetch stages do not get them again
+        assert_equal(harvester._claim_csw_objects(self.objects[1], 10), [])
+
+    def test_claim_objects_limit(self):
+        harvester = CSWHarvester()
+        assert_equal(len(harvester._claim_csw_objects(self.objects[0], 1)), 1)
+        assert_equal(len(harvester._claim_csw_objects(self.objects[0], 1)), 1)
+        assert_equal(harvester._claim_csw_objects(self.objects[0], 1), [])
+
+    def test_fetchers_closed(self):
+        original_fetcher = harvester_base.CswRecordFetcher
+        harvester_base.CswRecordFetcher = _FakeFetcher
+        try:
+            harvester = CSWHarvester()
+            harvester.source_config = {}
+            fetcher = harvester._get_csw_fetcher('http://a')
+            assert harvester._get_csw_fetcher('http://a') is fetcher
+
+            key = harvester._csw_fetchers.keys()[0]
+            harvester._csw_fetchers[key] = (fetcher, time.time() -
+                                            harvester_base.FETCHER_MAX_IDLE_TIME - 1)
+            assert harvester._get_csw_fetcher('http://a') is not fetcher
+            assert fetcher.closed
+        finally:
+            harvester_base.CswRecordFetcher = original_fetcher
+
 class TestImportStageTools:
     def test_licence_url_normal(self):
         assert_equal(GeminiHarvester._extract_first_licence_url(
@@ -954,6 +1091,29 @@ class TestImportStageTools:
         assert_equal(GeminiHarvester._process_responsible_organisation(responsible_organisation),
                      ('', []))
 
+class TestContentDigest:
+    def test_formatting_ignored(self):
+        document = u'''<?xml version="1.0" encoding="UTF-8"?>
+<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd" xmlns:gco="http://www.isotc211.org/2005/gco">
+  <!-- A comment -->
+  <gmd:fileIdentifier>
+    <gco:CharacterString>
+      test-guid
+    </gco:CharacterString>
+  </gmd:fileIdentifier>
+  <gmd:language codeList="a" codeListValue='eng'/>
+</gmd:MD_Metadata>'''
+        reformatted = u'''<gmd:MD_Metadata xmlns:gco="http://www.isotc211.org/2005/gco" xmlns:gmd="http://www.isotc211.org/2005/gmd"><gmd:fileIdentifier><gco:CharacterString>test-guid</gco:CharacterString></gmd:fileIdentifier><gmd:language codeListValue="eng" codeList="a"></gmd:language></gmd:MD_Metadata>'''
+        assert_equal(content_digest(document), content_digest(reformatted))
+
+    def test_content_changed(self):
+        document = u'<a xmlns="http://b"><c>Some text</c></a>'
+        assert content_digest(document) != content_digest(u'<a xmlns="http://b"><c>Other text</c></a>')
+        assert content_digest(document) != content_digest(u'<a xmlns="http://b"><c d="e">Some text</c></a>')
+
+    def test_not_xml(self):
+        assert_equal(content_digest(u'Not  XML\n'), content_digest(u'Not XML'))
+
 class TestValidation(HarvestFixtureBase):
 
     @classmethod
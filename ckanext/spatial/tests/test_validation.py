@@ -1,4 +1,8 @@
 import os
+import stat
+import shutil
+import tempfile
+import threading
 
 from lxml import etree
 from nose.tools import assert_equal, assert_in
@@ -163,3 +167,114 @@ class TestValidation:
         message, line = errors[1]
         assert 'This element is not expected' in message
         assert line == 3
+
+    def test_validate_all_profiles(self):
+        xml = etree.parse(self._get_file_path(
+            'gemini2.1/validation/03_Dataset_Invalid_GEMINI_Missing_Keyword.xml'))
+        profiles = ['iso19139eden', 'gemini2', 'constraints-1.4']
+
+        results = validation.Validators(profiles=profiles).validate(xml)
+        assert_equal([r[0] for r in results], profiles)
+        assert_equal([r[1] for r in results], [True, False, True])
+        assert_in('Descriptive keywords are mandatory', results[1][2][0][0])
+
+        results = validation.Validators(profiles=profiles).validate(
+            xml, stop_on_failure=True)
+        assert_equal([r[0] for r in results], ['iso19139eden', 'gemini2'])
+
+    def test_parallel_validation(self):
+        profiles = ['iso19139eden', 'constraints-1.4', 'gemini2']
+        serial = validation.Validators(profiles=profiles)
+        parallel = validation.Validators(profiles=profiles, parallel=True)
+        for file_name in ('01_Dataset_Invalid_XSD_No_Such_Element.xml',
+                          '02_Dataset_Invalid_19139_Missing_Data_Format.xml',
+                          '03_Dataset_Invalid_GEMINI_Missing_Keyword.xml',
+                          '04_Dataset_Valid.xml'):
+            xml = etree.parse(self._get_file_path('gemini2.1/validation/' + file_name))
+            assert_equal(parallel.is_valid(xml), serial.is_valid(xml))
+            assert_equal(parallel.validate(xml), serial.validate(xml))
+
+    def test_parallel_threads_shared(self):
+        xml = etree.parse(self._get_file_path('gemini2.1/validation/04_Dataset_Valid.xml'))
+        validation.Validators(profiles=['iso19139eden', 'constraints'], parallel=True).is_valid(xml)
+        threads = threading.active_count()
+        for i in xrange(3):
+            validation.Validators(profiles=['iso19139eden', 'constraints'], parallel=True).is_valid(xml)
+        assert_equal(threading.active_count(), threads)
+
+    def test_schema_compiled_once(self):
+        validation.XsdValidator.clear_schemas()
+        xsd_filepath = validation.ISO19139Schema.gmx_xsd_filepath
+
+        errors = self.get_validation_errors(validation.ISO19139Schema,
+                                            'iso19139/dataset.xml')
+        assert_equal(errors, '')
+        schema = validation.XsdValidator.get_schema(xsd_filepath)
+
+        errors = self.get_validation_errors(validation.ISO19139Schema,
+                                            'iso19139/dataset-invalid.xml')
+        assert len(errors) > 0
+        assert validation.XsdValidator.get_schema(xsd_filepath) is schema
+
+    def test_schematron_cache(self):
+        base_dir = tempfile.mkdtemp()
+        cache_dir = os.path.join(base_dir, 'schematron')
+        original_cache_dir = validation.SchematronValidator.cache_dir
+        validation.SchematronValidator.cache_dir = cache_dir
+        try:
+            schematron = validation.Gemini2Schematron.get_schematrons()[0]
+            # Only the CKAN user can change the cached stylesheets
+            assert_equal(stat.S_IMODE(os.stat(cache_dir).st_mode), 0700)
+            cached_files = os.listdir(cache_dir)
+            assert_equal(len(cached_files), 1)
+            assert cached_files[0].startswith('gemini2.')
+
+            # The second time it is loaded from the cache
+            cached_schematron = validation.Gemini2Schematron.get_schematrons()[0]
+            assert_equal(os.listdir(cache_dir), cached_files)
+
+            xml = etree.parse(self._get_file_path(
+                'gemini2.1/validation/03_Dataset_Invalid_GEMINI_Missing_Keyword.xml'))
+            assert_equal(etree.tostring(schematron(xml)),
+                         etree.tostring(cached_schematron(xml)))
+
+            # No temporary files are left behind if the file can not be saved
+            validation.SchematronValidator._write_cache_file(
+                os.path.join(cache_dir, 'missing', 'gemini2.xsl'), etree.XML('<a/>'))
+            assert_equal(os.listdir(cache_dir), cached_files)
+        finally:
+            validation.SchematronValidator.cache_dir = original_cache_dir
+            shutil.rmtree(base_dir)
+
+    def test_schematron_cache_includes(self):
+        base_dir = tempfile.mkdtemp()
+        original_cache_dir = validation.SchematronValidator.cache_dir
+        validation.SchematronValidator.cache_dir = os.path.join(base_dir, 'schematron')
+
+        def write(file_name, content):
+            with open(os.path.join(base_dir, file_name), 'w') as f:
+                f.write(content)
+
+        def cached_files():
+            with open(os.path.join(base_dir, 'main.sch')) as schema:
+                validation.SchematronValidator.schematron(schema)
+            return sorted(os.listdir(validation.SchematronValidator.cache_dir))
+
+        try:
+            write('main.sch', '''<sch:schema xmlns:sch="http://purl.oclc.org/dsdl/schematron">
+                <sch:pattern><sch:include href="rule.sch"/></sch:pattern></sch:schema>''')
+            write('rule.sch', '''<sch:rule xmlns:sch="http://purl.oclc.org/dsdl/schematron"
+                context="/"><sch:assert test="a">Missing a</sch:assert></sch:rule>''')
+            files = cached_files()
+            assert_equal(len(files), 1)
+
+            # Changes in the included documents are a new version
+            write('rule.sch', '''<sch:rule xmlns:sch="http://purl.oclc.org/dsdl/schematron"
+                context="/"><sch:assert test="b">Missing b</sch:assert></sch:rule>''')
+            assert_equal(len(cached_files()), 2)
+        finally:
+            validation.SchematronValidator.cache_dir = original_cache_dir
+            shutil.rmtree(base_dir)
+
+    def test_schematron_cache_disabled(self):
+        assert_equal(validation.SchematronValidator.cache_dir, None)
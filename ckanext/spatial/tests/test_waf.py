@@ -0,0 +1,144 @@
+import threading
+import time
+
+from nose.tools import assert_equal
+
+from ckanext.spatial.harvesters.waf import (_crawl_waf, _extract_waf,
+                                            _parse_waf, fast_scrapers)
+from ckanext.spatial.tests.benchmarks.fixtures import (waf_index, iis_waf_index,
+                                                       pyparsing_records)
+
+class _Response(object):
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+class FakeSession(object):
+    '''
+    Serves a WAF with `folders` sub-folders per folder, `depth` levels deep,
+    and two documents on each folder.
+    '''
+    def __init__(self, base_url, folders=3, depth=2, delay=0):
+        self.base_url = base_url
+        self.folders = folders
+        self.depth = depth
+        self.delay = delay
+        self.requested = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def index(self, url):
+        level = url[len(self.base_url):].count('/')
+        links = ['doc1.xml', 'doc2.xml', '../', 'mailto:a@b.c']
+        if level < self.depth:
+            links.extend('folder%i/' % i for i in range(self.folders))
+        return waf_index(links)
+
+    def get(self, url, timeout=None):
+        with self._lock:
+            self.requested.append(url)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.delay)
+        with self._lock:
+            self.active -= 1
+        return _Response(self.index(url))
+
+def test_crawl_waf():
+    base_url = 'http://waf.example.com/'
+    session = FakeSession(base_url, folders=3, depth=2)
+    content = session.index(base_url)
+
+    documents = list(_crawl_waf(content, base_url, 'apache', session=session))
+
+    # 1 + 3 + 9 folders, with two documents each
+    assert_equal(len(documents), 26)
+    assert_equal(len(set(url for url, date in documents)), 26)
+    assert_equal(len(session.requested), 12)
+    assert ('http://waf.example.com/folder1/folder2/doc1.xml',
+            '2013-09-17 10:11:00') in documents
+
+    # Breadth first
+    assert_equal(documents[0][0], 'http://waf.example.com/doc1.xml')
+    assert session.requested.index('http://waf.example.com/folder2/') < \
+        session.requested.index('http://waf.example.com/folder0/folder0/')
+
+def test_crawl_waf_concurrency():
+    base_url = 'http://waf.example.com/'
+    session = FakeSession(base_url, folders=8, depth=1, delay=0.05)
+    content = session.index(base_url)
+
+    documents = list(_crawl_waf(content, base_url, 'apache',
+                                session=session, workers=4))
+
+    assert_equal(len(documents), 18)
+    assert_equal(session.max_active, 4)
+
+def test_crawl_waf_max_depth():
+    base_url = 'http://waf.example.com/'
+    session = FakeSession(base_url, folders=1, depth=20)
+    content = session.index(base_url)
+
+    documents = list(_crawl_waf(content, base_url, 'apache',
+                                session=session, max_depth=3))
+
+    # Pages up to depth 4 are read, as their parents are not deeper than 3
+    assert_equal(len(session.requested), 4)
+    assert_equal(len(documents), 10)
+
+def test_extract_waf():
+    base_url = 'http://waf.example.com/'
+    content = waf_index(['doc1.xml', 'doc2.xml', 'notes.txt', 'folder/'])
+
+    documents = _extract_waf(content, base_url, 'apache', depth=11)
+
+    assert_equal(sorted(url for url, date in documents),
+                 ['http://waf.example.com/doc1.xml',
+                  'http://waf.example.com/doc2.xml'])
+
+def test_fast_scrapers():
+    apache_pre = ''.join('<a href="%s">%s</a>    17-Sep-2013 10:11  1.2K\n' % (link, link)
+                         for link in ('doc1.xml', 'folder/'))
+    for content in (waf_index(['doc1.xml', 'doc2.xml', '../', 'folder/']),
+                    '<pre>%s</pre>' % apache_pre,
+                    iis_waf_index(['doc1.xml', 'doc2.xml', 'folder/'])):
+        for scraper in ('apache', 'iis', 'other'):
+            try:
+                expected = pyparsing_records(content, scraper)
+            except Exception:
+                expected = []
+            assert_equal(fast_scrapers[scraper](content), expected)
+
+def test_parse_waf_iis():
+    base_url = 'http://waf.example.com/waf/'
+    documents, folders = _parse_waf(iis_waf_index(['doc1.xml', 'doc2.xml']),
+                                    base_url, 'iis')
+    assert_equal(documents, [('http://waf.example.com/waf/doc1.xml', '2013-09-17 10:11:00'),
+                             ('http://waf.example.com/waf/doc2.xml', '2013-09-17 10:11:00')])
+
+def test_parse_waf_json_listing():
+    content = '''[
+{ "name":"folder", "type":"directory", "mtime":"Tue, 17 Sep 2013 10:11:00 GMT" },
+{ "name":"doc 1.xml", "type":"file", "mtime":"Tue, 17 Sep 2013 10:11:00 GMT", "size":1234 },
+{ "name":"notes.txt", "type":"file", "mtime":"Tue, 17 Sep 2013 10:11:00 GMT", "size":12 }
+]'''
+    documents, folders = _parse_waf(content, 'http://waf.example.com/', 'apache')
+
+    assert_equal(documents, [('http://waf.example.com/doc%201.xml',
+                              '2013-09-17 10:11:00+00:00')])
+    assert_equal(folders, ['http://waf.example.com/folder/'])
+
+def test_parse_waf_xml_listing():
+    content = '''<?xml version="1.0"?>
+<list>
+<directory mtime="2013-09-17T10:11:00Z">folder</directory>
+<file mtime="2013-09-17T10:11:00Z" size="1234">doc1.xml</file>
+</list>'''
+    documents, folders = _parse_waf(content, 'http://waf.example.com/', 'apache')
+
+    assert_equal(documents, [('http://waf.example.com/doc1.xml',
+                              '2013-09-17 10:11:00+00:00')])
+    assert_equal(folders, ['http://waf.example.com/folder/'])
@@ -7,21 +7,36 @@ from threading import Thread
 
 PORT = 8999
 
-def serve(port=PORT):
+CONDITIONAL_PORT = 8998
+
+class ConditionalRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    '''
+    Answers 304 Not Modified to requests for files not modified since the
+    date of their If-Modified-Since header
+    '''
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isfile(path) and self.headers.get('If-Modified-Since') == \
+                self.date_time_string(os.stat(path).st_mtime):
+            self.send_response(304)
+            self.end_headers()
+            return None
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+def serve(port=PORT, handler=SimpleHTTPServer.SimpleHTTPRequestHandler):
     '''Serves test XML files over HTTP'''
     
     # Make sure we serve from the tests' XML directory
     os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)),
                           'xml'))
 
-    Handler = SimpleHTTPServer.SimpleHTTPRequestHandler
-    
     class TestServer(SocketServer.TCPServer):
         allow_reuse_address = True
     
-    httpd = TestServer(("", PORT), Handler)
+    httpd = TestServer(("", port), handler)
     
-    print 'Serving test HTTP server at port', PORT
+    print 'Serving test HTTP server at port', port
 
     httpd_thread = Thread(target=httpd.serve_forever)
     httpd_thread.setDaemon(True)
@@ -1,11 +1,17 @@
 import os
-from pkg_resources import resource_stream
+import hashlib
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+from pkg_resources import resource_stream, resource_string, resource_listdir
 from ckanext.spatial.model import ISODocument
 
 from lxml import etree
 
 log = __import__("logging").getLogger(__name__)
 
+DEFAULT_VALIDATOR_PROFILES = ['iso19139']
+
 class BaseValidator(object):
     '''Base class for a validator.'''
     name = None
@@ -24,9 +30,63 @@ class BaseValidator(object):
         '''
         raise NotImplementedError
 
+    @classmethod
+    def prepare(cls):
+        '''
+        Compiles whatever the validator needs (schemas, stylesheets), so the
+        cost is not paid on the first document validated. Subclasses should
+        override it if they have anything to compile.
+        '''
+        pass
+
 class XsdValidator(BaseValidator):
     '''Base class for validators that use an XSD schema.'''
 
+    # Compiled schemas are shared by all validators in the process, keyed
+    # by the XSD file path. lxml keeps the error log of the last validation
+    # on the schema object, so each schema also gets a lock that must be
+    # held while validating against it.
+    _schemas = {}
+    _schema_locks = {}
+    _schemas_lock = threading.Lock()
+
+    @classmethod
+    def get_xsd_filepaths(cls):
+        '''Returns the paths of all the XSD files used by this validator.
+        Subclasses should override it so the schemas can be precompiled.'''
+        return []
+
+    @classmethod
+    def prepare(cls):
+        for xsd_filepath in cls.get_xsd_filepaths():
+            cls.get_schema(xsd_filepath)
+
+    @classmethod
+    def get_schema(cls, xsd_filepath):
+        '''Returns the compiled XMLSchema object for the given XSD file.
+
+        The XSD is only parsed and compiled the first time it is requested,
+        subsequent calls (from any thread) get the same object.
+        '''
+        schema = cls._schemas.get(xsd_filepath)
+        if schema is None:
+            with cls._schemas_lock:
+                schema = cls._schemas.get(xsd_filepath)
+                if schema is None:
+                    log.info('Compiling XSD schema %s', xsd_filepath)
+                    xsd = etree.parse(xsd_filepath)
+                    schema = etree.XMLSchema(xsd)
+                    cls._schema_locks[xsd_filepath] = threading.Lock()
+                    cls._schemas[xsd_filepath] = schema
+        return schema
+
+    @classmethod
+    def clear_schemas(cls):
+        '''Forgets all the compiled schemas (mostly useful for tests).'''
+        with cls._schemas_lock:
+            XsdValidator._schemas.clear()
+            XsdValidator._schema_locks.clear()
+
     @classmethod
     def _is_valid(cls, xml, xsd_filepath, xsd_name):
         '''Returns whether or not an XML file is valid according to
@@ -42,21 +102,20 @@ class XsdValidator(BaseValidator):
         Returns:
           (is_valid, [(error_message_string, error_line_number)])
         '''
-        xsd = etree.parse(xsd_filepath)
-        schema = etree.XMLSchema(xsd)
+        schema = cls.get_schema(xsd_filepath)
         # With libxml2 versions before 2.9, this fails with this error:
         #    gmx_schema = etree.XMLSchema(gmx_xsd)
         #  File "xmlschema.pxi", line 103, in lxml.etree.XMLSchema.__init__ (src/lxml/lxml.etree.c:116069)
         # XMLSchemaParseError: local list type: A type, derived by list or union, must have the simple ur-type definition as base type, not '{http://www.opengis.net/gml/3.2}doubleList'., line 118
-        try:
-            schema.assertValid(xml)
-        except etree.DocumentInvalid:
-            log.info('Validation errors found using schema {0}'.format(xsd_name))
-            errors = []
-            for error in schema.error_log:
-                errors.append((error.message, error.line))
-            errors.insert
-            return False, errors
+        with cls._schema_locks[xsd_filepath]:
+            try:
+                schema.assertValid(xml)
+            except etree.DocumentInvalid:
+                log.info('Validation errors found using schema {0}'.format(xsd_name))
+                errors = []
+                for error in schema.error_log:
+                    errors.append((error.message, error.line))
+                return False, errors
         return True, []
 
 
@@ -64,13 +123,17 @@ class ISO19139Schema(XsdValidator):
     name = 'iso19139'
     title = 'ISO19139 XSD Schema'
 
+    gmx_xsd_filepath = os.path.join(os.path.dirname(__file__),
+                                    'xml/iso19139', 'gmx/gmx.xsd')
+
+    @classmethod
+    def get_xsd_filepaths(cls):
+        return [cls.gmx_xsd_filepath]
+
     @classmethod
     def is_valid(cls, xml):
-        xsd_path = 'xml/iso19139'
-        gmx_xsd_filepath = os.path.join(os.path.dirname(__file__),
-                                            xsd_path, 'gmx/gmx.xsd')
         xsd_name = 'Dataset schema (gmx.xsd)'
-        is_valid, errors = cls._is_valid(xml, gmx_xsd_filepath, xsd_name)
+        is_valid, errors = cls._is_valid(xml, cls.gmx_xsd_filepath, xsd_name)
         if not is_valid:
             #TODO: not sure if we need this one, keeping for backwards compatibility
             errors.insert(0, ('{0} Validation Error'.format(xsd_name), None))
@@ -80,25 +143,28 @@ class ISO19139EdenSchema(XsdValidator):
     name = 'iso19139eden'
     title = 'ISO19139 XSD Schema (EDEN 2009-03-16)'
 
+    gmx_xsd_filepath = os.path.join(os.path.dirname(__file__),
+                                    'xml/iso19139eden', 'gmx/gmx.xsd')
+    gmx_and_srv_xsd_filepath = os.path.join(os.path.dirname(__file__),
+                                            'xml/iso19139eden', 'gmx_and_srv.xsd')
+
     @classmethod
-    def is_valid(cls, xml):
-        xsd_path = 'xml/iso19139eden'
+    def get_xsd_filepaths(cls):
+        return [cls.gmx_xsd_filepath, cls.gmx_and_srv_xsd_filepath]
 
+    @classmethod
+    def is_valid(cls, xml):
         metadata_type = cls.get_record_type(xml)
 
         if metadata_type in ('dataset', 'series'):
-            gmx_xsd_filepath = os.path.join(os.path.dirname(__file__),
-                                            xsd_path, 'gmx/gmx.xsd')
             xsd_name = 'Dataset schema (gmx.xsd)'
-            is_valid, errors = cls._is_valid(xml, gmx_xsd_filepath, xsd_name)
+            is_valid, errors = cls._is_valid(xml, cls.gmx_xsd_filepath, xsd_name)
             if not is_valid:
                 #TODO: not sure if we need this one, keeping for backwards compatibility
                 errors.insert(0, ('{0} Validation Error'.format(xsd_name), None))
         elif metadata_type == 'service':
-            gmx_and_srv_xsd_filepath = os.path.join(os.path.dirname(__file__),
-                                                    xsd_path, 'gmx_and_srv.xsd')
             xsd_name = 'Service schemas (gmx.xsd & srv.xsd)'
-            is_valid, errors = cls._is_valid(xml, gmx_and_srv_xsd_filepath, xsd_name)
+            is_valid, errors = cls._is_valid(xml, cls.gmx_and_srv_xsd_filepath, xsd_name)
             if not is_valid:
                 #TODO: not sure if we need this one, keeping for backwards compatibility
                 errors.insert(0, ('{0} Validation Error'.format(xsd_name), None))
@@ -134,13 +200,16 @@ class ISO19139NGDCSchema(XsdValidator):
     name = 'iso19139ngdc'
     title = 'ISO19139 XSD Schema (NGDC)'
 
+    xsd_filepath = os.path.join(os.path.dirname(__file__),
+                                'xml/iso19139ngdc', 'schema.xsd')
+
     @classmethod
-    def is_valid(cls, xml):
-        xsd_path = 'xml/iso19139ngdc'
+    def get_xsd_filepaths(cls):
+        return [cls.xsd_filepath]
 
-        xsd_filepath = os.path.join(os.path.dirname(__file__),
-                                        xsd_path, 'schema.xsd')
-        return cls._is_valid(xml, xsd_filepath, 'NGDC Schema (schema.xsd)')
+    @classmethod
+    def is_valid(cls, xml):
+        return cls._is_valid(xml, cls.xsd_filepath, 'NGDC Schema (schema.xsd)')
 
 class FGDCSchema(XsdValidator):
     '''
@@ -155,25 +224,48 @@ class FGDCSchema(XsdValidator):
     name = 'fgdc'
     title = 'FGDC XSD Schema'
 
+    xsd_filepath = os.path.join(os.path.dirname(__file__),
+                                'xml/fgdc', 'fgdc-std-001-1998.xsd')
+
     @classmethod
-    def is_valid(cls, xml):
-        xsd_path = 'xml/fgdc'
+    def get_xsd_filepaths(cls):
+        return [cls.xsd_filepath]
 
-        xsd_filepath = os.path.join(os.path.dirname(__file__),
-                                        xsd_path, 'fgdc-std-001-1998.xsd')
-        return cls._is_valid(xml, xsd_filepath, 'FGDC Schema (fgdc-std-001-1998.xsd)')
+    @classmethod
+    def is_valid(cls, xml):
+        return cls._is_valid(xml, cls.xsd_filepath, 'FGDC Schema (fgdc-std-001-1998.xsd)')
 
 
 class SchematronValidator(BaseValidator):
     '''Base class for a validator that uses Schematron.'''
     has_init = False
 
+    # Directory where the compiled schematrons (the SVRL stylesheets) are
+    # stored, so other processes can load them directly instead of
+    # compiling them again. Files are named after a hash of the schematron
+    # (once the documents it includes are expanded) and the stylesheets used
+    # to compile it, so changes in any of them invalidate the cached version. It is disabled by default, as the
+    # cached stylesheets are run as the CKAN user: the directory must only be
+    # writable by it (it is created with 0700 permissions if missing).
+    cache_dir = None
+
+    # The compiled schematrons only need to read the validated document
+    _access_control = etree.XSLTAccessControl.DENY_WRITE
+
+    _compiler_digest = None
+
     @classmethod
     def get_schematrons(cls):
         '''Subclasses should override this method to implement
         their validation.'''
         raise NotImplementedError
 
+    @classmethod
+    def prepare(cls):
+        if not hasattr(cls, 'schematrons'):
+            log.info('Compiling schematron "%s"', cls.title)
+            cls.schematrons = cls.get_schematrons()
+
     @classmethod
     def is_valid(cls, xml):
         '''Returns whether or not an XML file is valid according to
@@ -189,9 +281,7 @@ class SchematronValidator(BaseValidator):
           (is_valid, [(error_message_string, error_line_number)])
         '''
 
-        if not hasattr(cls, 'schematrons'):
-            log.info('Compiling schematron "%s"', cls.title)
-            cls.schematrons = cls.get_schematrons()
+        cls.prepare()
         for schematron in cls.schematrons:
             result = schematron(xml)
             errors = []
@@ -237,12 +327,78 @@ class SchematronValidator(BaseValidator):
             compiled = etree.parse(schema)
         else:
             compiled = schema
-        for filename in transforms:
+
+        def transform(filename, tree):
             with resource_stream("ckanext.spatial", filename) as stream:
                 xform_xml = etree.parse(stream)
                 xform = etree.XSLT(xform_xml)
-                compiled = xform(compiled)
-        return etree.XSLT(compiled)
+                return xform(tree)
+
+        # The included documents are expanded first, so they are part of the
+        # cache key
+        compiled = transform(transforms[0], compiled)
+
+        cache_filepath = cls._get_cache_filepath(compiled)
+        if cache_filepath and os.path.exists(cache_filepath):
+            try:
+                xslt = etree.XSLT(etree.parse(cache_filepath),
+                                  access_control=cls._access_control)
+                log.debug('Loaded compiled schematron from %s', cache_filepath)
+                return xslt
+            except (etree.XMLSyntaxError, etree.XSLTParseError), e:
+                log.warning('Ignoring invalid compiled schematron %s: %s',
+                            cache_filepath, e)
+
+        for filename in transforms[1:]:
+            compiled = transform(filename, compiled)
+        xslt = etree.XSLT(compiled, access_control=cls._access_control)
+
+        if cache_filepath:
+            cls._write_cache_file(cache_filepath, compiled)
+        return xslt
+
+    @classmethod
+    def _get_cache_filepath(cls, schema):
+        '''Returns the path where the compiled version of the given
+        schematron tree (with the included documents already expanded) is
+        cached, or None if the cache is disabled.'''
+        if not cls.cache_dir:
+            return None
+        if SchematronValidator._compiler_digest is None:
+            digest = hashlib.sha1()
+            for filename in sorted(resource_listdir("ckanext.spatial",
+                                                    "validation/xml/schematron")):
+                if filename.endswith('.xsl'):
+                    digest.update(resource_string("ckanext.spatial",
+                        "validation/xml/schematron/" + filename))
+            SchematronValidator._compiler_digest = digest.hexdigest()
+        digest = hashlib.sha1(SchematronValidator._compiler_digest)
+        digest.update(etree.tostring(schema))
+        return os.path.join(cls.cache_dir,
+                            '{0}.{1}.xsl'.format(cls.name, digest.hexdigest()))
+
+    @classmethod
+    def _write_cache_file(cls, cache_filepath, compiled):
+        '''Writes the compiled schematron atomically, so concurrent workers
+        never read a partially written file. Failing to write it is not an
+        error, the schematron will just be compiled again next time.'''
+        tmp_filepath = None
+        try:
+            if not os.path.exists(cls.cache_dir):
+                os.makedirs(cls.cache_dir, 0700)
+            fd, tmp_filepath = tempfile.mkstemp(dir=cls.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(etree.tostring(compiled))
+            os.rename(tmp_filepath, cache_filepath)
+            log.debug('Saved compiled schematron to %s', cache_filepath)
+        except (IOError, OSError), e:
+            log.warning('Could not save compiled schematron to %s: %s',
+                        cache_filepath, e)
+            if tmp_filepath and os.path.exists(tmp_filepath):
+                try:
+                    os.remove(tmp_filepath)
+                except OSError:
+                    pass
 
 
 class ConstraintsSchematron(SchematronValidator):
@@ -295,13 +451,31 @@ all_validators = (ISO19139Schema,
                   Gemini2Schematron,
                   Gemini2Schematron13)
 
+# Threads used by all the Validators validating in parallel, one for each of
+# the available profiles, created the first time they are needed
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(len(all_validators))
+    return _pool
+
 
 class Validators(object):
     '''
     Validates XML against one or more profiles (i.e. validators).
+
+    If `parallel` is True, the document is validated against all the profiles
+    at the same time in different threads (lxml releases the GIL while
+    running the XSD and XSLT validations). The threads are shared by all
+    the instances.
     '''
-    def __init__(self, profiles=["iso19139", "constraints", "gemini2"]):
+    def __init__(self, profiles=["iso19139", "constraints", "gemini2"], parallel=False):
         self.profiles = profiles
+        self.parallel = parallel
         
         self.validators = {} # name: class
         for validator_class in all_validators:
@@ -310,6 +484,13 @@ class Validators(object):
     def add_validator(self, validator_class):
             self.validators[validator_class.name] = validator_class
 
+    def prepare(self):
+        '''Compiles in advance the schemas and schematrons used by all the
+        profiles, so they are not compiled when validating the first
+        document.'''
+        for name in self.profiles:
+            self.validators[name].prepare()
+
     def isvalid(self, xml):
         '''For backward compatibility'''
         return self.is_valid(xml)
@@ -321,6 +502,9 @@ class Validators(object):
         that failed and the third is a list of tuples,
         each containing the error message and the error line if present.
 
+        Profiles are checked in order and the first one that fails is
+        returned, regardless of whether they are run in parallel or not.
+
         Params:
           xml - etree of the XML to be validated
 
@@ -330,18 +514,53 @@ class Validators(object):
 
 
         log.debug('Starting validation against profile(s) %s' % ','.join(self.profiles))
-        for name in self.profiles:
-            validator = self.validators[name]
-            is_valid, error_message_list = validator.is_valid(xml)
+        for name, is_valid, error_message_list in self.validate(xml, stop_on_failure=True):
             if not is_valid:
-                #error_message_list.insert(0, 'Validating against "%s" profile failed' % validator.title)
-                log.info('Validating against "%s" profile failed' % validator.title)
-                log.debug('%r', error_message_list)
-                return False, validator.name, error_message_list
-            log.debug('Validated against "%s"', validator.title)
+                return False, name, error_message_list
         log.info('Validation passed')
         return True, None, []
 
+    def validate(self, xml, stop_on_failure=False):
+        '''Validates an XML file against all the profiles and returns the
+        result for each one of them, in the same order as the profiles.
+
+        If `stop_on_failure` is True, no results are returned after the
+        first profile that fails (when running in parallel, the validations
+        against the remaining profiles may still run, but are ignored).
+
+        Params:
+          xml - etree of the XML to be validated
+
+        Returns:
+          [(profile_name, is_valid, [(error_message_string, error_line_number)])]
+        '''
+        if self.parallel and len(self.profiles) > 1:
+            # Compile everything first, so threads don't compile the same
+            # schematron at the same time
+            self.prepare()
+            results = _get_pool().imap(
+                lambda name: self._validate_profile(name, xml), self.profiles)
+        else:
+            results = (self._validate_profile(name, xml) for name in self.profiles)
+
+        all_results = []
+        for name, is_valid, error_message_list in results:
+            all_results.append((name, is_valid, error_message_list))
+            if not is_valid and stop_on_failure:
+                break
+        return all_results
+
+    def _validate_profile(self, name, xml):
+        validator = self.validators[name]
+        is_valid, error_message_list = validator.is_valid(xml)
+        if not is_valid:
+            #error_message_list.insert(0, 'Validating against "%s" profile failed' % validator.title)
+            log.info('Validating against "%s" profile failed' % validator.title)
+            log.debug('%r', error_message_list)
+        else:
+            log.debug('Validated against "%s"', validator.title)
+        return validator.name, is_valid, error_message_list
+
 if __name__ == '__main__':
     from sys import argv
     import logging